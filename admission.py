@@ -0,0 +1,147 @@
+# admission.py
+"""
+Control de admisión: presupuesto de tareas (global) y de bytes en vuelo (por proceso).
+
+- Tareas: PENDING + PROCESSING según los contadores de estadísticas (compartidos
+  entre procesos, así que el límite es global). Si una subida lo superaría, se
+  rechaza con 503 y Retry-After en lugar de acumular trabajo que no se va a poder atender.
+- Bytes: cuerpos de subidas que se están recibiendo (según su Content-Length) y
+  archivos originales que los workers tienen cargados en memoria. Cada proceso
+  (worker de uvicorn o de cola) lleva su propia cuenta, así que ADMISSION_MAX_MB
+  limita la memoria de cada proceso, no la del conjunto. Las subidas que
+  no caben se rechazan antes de leer el cuerpo; los workers esperan a que haya
+  sitio antes de cargar el archivo (contrapresión sobre la cola, que vive en disco).
+"""
+
+import asyncio
+from typing import Optional
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import StatsCounter
+from config import settings
+
+IN_FLIGHT_STATUSES = ("status:PENDING", "status:PROCESSING")
+
+
+class AdmissionRejected(Exception):
+    """La petición superaría el presupuesto de tareas o de bytes."""
+
+    def __init__(self, reason: str, retry_after: Optional[int] = None):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after if retry_after is not None else settings.admission_retry_after_seconds
+
+
+class AdmissionController:
+    """
+    Presupuesto de tareas en vuelo (global) y de bytes en vuelo de este proceso (0 = sin límite).
+    """
+
+    def __init__(self, max_tasks: int, max_bytes: int):
+        self.max_tasks = max_tasks
+        self.max_bytes = max_bytes
+        self.upload_bytes = 0
+        self.worker_bytes = 0
+        self.rejected_count = 0
+        self._released: Optional[asyncio.Condition] = None
+
+    @property
+    def in_flight_bytes(self) -> int:
+        return self.upload_bytes + self.worker_bytes
+
+    async def in_flight_tasks(self, session: AsyncSession) -> int:
+        """
+        Tareas PENDING + PROCESSING (dos filas de StatsCounter). Se lee con la sesión
+        asíncrona para no bloquear el event loop justo cuando el sistema está cargado.
+        Sin presupuesto de tareas no se consulta.
+        """
+        if self.max_tasks <= 0:
+            return 0
+        rows = (await session.exec(
+            select(StatsCounter.value).where(StatsCounter.name.in_(IN_FLIGHT_STATUSES))
+        )).all()
+        return sum(rows)
+
+    def check_tasks(self, in_flight: int, new_tasks: int = 1) -> None:
+        """
+        Lanza AdmissionRejected si `new_tasks` tareas más superarían el presupuesto.
+        `in_flight` es el resultado de in_flight_tasks, leído una vez por petición.
+        """
+        if self.max_tasks <= 0:
+            return
+        if in_flight + new_tasks > self.max_tasks:
+            self.rejected_count += 1
+            raise AdmissionRejected(
+                f"Cola llena: {in_flight} tareas en curso de un máximo de {self.max_tasks}"
+            )
+
+    def reserve_upload(self, size: int) -> None:
+        """
+        Reserva los bytes de una subida antes de leer su cuerpo. El llamador los
+        devuelve con release_upload cuando la petición termina. Como en los workers,
+        una subida mayor que todo el presupuesto se admite si no hay nada más en vuelo.
+        """
+        if self.max_bytes > 0 and self.in_flight_bytes > 0 and self.in_flight_bytes + size > self.max_bytes:
+            self.rejected_count += 1
+            raise AdmissionRejected(
+                f"Memoria de subidas agotada: {self.in_flight_bytes} de {self.max_bytes} bytes en uso"
+            )
+        self.upload_bytes += size
+
+    def release_upload(self, size: int) -> None:
+        self.upload_bytes -= size
+        self._notify()
+
+    async def acquire_worker_bytes(self, size: int) -> None:
+        """
+        Espera a que quepan `size` bytes antes de que un worker cargue un archivo.
+        Un archivo mayor que todo el presupuesto pasa cuando no hay nada más en vuelo.
+        """
+        if self.max_bytes <= 0:
+            self.worker_bytes += size
+            return
+        if self._released is None:
+            self._released = asyncio.Condition()
+        async with self._released:
+            await self._released.wait_for(
+                lambda: self.in_flight_bytes == 0 or self.in_flight_bytes + size <= self.max_bytes
+            )
+            self.worker_bytes += size
+
+    def release_worker_bytes(self, size: int) -> None:
+        self.worker_bytes -= size
+        self._notify()
+
+    def _notify(self) -> None:
+        if self._released is None:
+            return
+        condition = self._released
+
+        async def wake_up():
+            async with condition:
+                condition.notify_all()
+
+        asyncio.get_running_loop().create_task(wake_up())
+
+    def get_stats(self, counters: dict) -> dict:
+        """Uso del presupuesto para el health check."""
+        in_flight_tasks = sum(counters.get(name, 0) for name in IN_FLIGHT_STATUSES)
+        tasks_full = self.max_tasks > 0 and in_flight_tasks >= self.max_tasks
+        bytes_full = self.max_bytes > 0 and self.in_flight_bytes >= self.max_bytes
+        return {
+            "accepting": not (tasks_full or bytes_full),
+            "tasks_in_flight": in_flight_tasks,
+            "tasks_limit": self.max_tasks,
+            "upload_bytes": self.upload_bytes,
+            "worker_bytes": self.worker_bytes,
+            "bytes_in_flight": self.in_flight_bytes,
+            "bytes_limit": self.max_bytes,
+            "rejected_since_start": self.rejected_count,
+        }
+
+
+# Instancia global del control de admisión
+admission = AdmissionController(
+    settings.admission_max_tasks,
+    settings.admission_max_mb * 1024 * 1024,
+)
@@ -1,81 +1,264 @@
 # background_processor.py
 import json
+import random
 import uuid
 from datetime import datetime
+from typing import Optional
+from sqlalchemy import update
 from sqlmodel import Session, select
 from models import ApiTrackingLog
 from database import engine
-from convert_toimage import convert_pdf_to_images
-from gedata import get_invoice_data_from_gemini 
+from convert_toimage import prepare_pdf_pages_async, prepare_image_async, describe_processing_path
+from render_profiles import get_render_profile
+from validators import FileValidator
+from gedata import get_invoice_data_from_gemini, load_prompt
+from chunked_extraction import should_chunk, extract_in_chunks
+from config import settings
+import result_cache
+import near_duplicates
+import supplier_templates
+import stats
+import task_results
+from events import hub
 
 
-async def process_invoice_task(task_id: uuid.UUID, file_bytes: bytes, user_identifier: str, filename: str):
+def load_owned_task(session: Session, task_id: uuid.UUID, lease_owner: Optional[str]) -> Optional[ApiTrackingLog]:
+    """
+    Devuelve la fila de la tarea solo si sigue PROCESSING con el lease de lease_owner.
+
+    El UPDATE condicional bloquea la fila hasta el commit: si el reaper la devolvió a
+    PENDING y otro worker la reclamó, no coincide ninguna fila y se devuelve None, y el
+    llamador no debe escribir el estado final, el resultado ni las estadísticas.
+    Sin lease_owner solo se comprueba que la tarea exista.
+    """
+    if lease_owner is not None:
+        owned = session.execute(
+            update(ApiTrackingLog)
+            .where(
+                ApiTrackingLog.task_id == task_id,
+                ApiTrackingLog.status == "PROCESSING",
+                ApiTrackingLog.lease_owner == lease_owner
+            )
+            .values(lease_owner=lease_owner)
+        ).rowcount
+        if not owned:
+            return None
+    return session.exec(select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)).first()
+
+
+def _lease_lost(task_id: uuid.UUID, lease_owner: Optional[str]) -> bool:
+    print(f"AVISO: Tarea {task_id}: {lease_owner} ya no tiene el lease, se descarta su resultado")
+    return False
+
+
+async def process_invoice_task(task_id: uuid.UUID, file_bytes: bytes, user_identifier: str, filename: str,
+                               render_profile: Optional[str] = None, lease_owner: Optional[str] = None) -> bool:
     """
     Procesa una factura individual en segundo plano.
+
+    lease_owner es el worker que reclamó la tarea: cada escritura final se hace solo si
+    todavía tiene el lease. Devuelve True si esta ejecución dejó la tarea en su estado
+    final; con False el llamador no debe borrar el archivo original (lo necesita el
+    worker que la reclamó después).
     """
     print(f"Iniciando procesamiento de tarea {task_id} para archivo {filename}")
     
     # 1. Actualizar estado a PROCESSING en la BD
     with Session(engine) as session:
-        statement = select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)
-        log_entry = session.exec(statement).first()
+        log_entry = load_owned_task(session, task_id, lease_owner)
         if not log_entry:
+            if lease_owner is not None:
+                return _lease_lost(task_id, lease_owner)
             print(f"ERROR: Tarea {task_id} no encontrada en la base de datos")
-            return
-        log_entry.status = "PROCESSING"
-        session.add(log_entry)
+            return False
+        stats.set_status(session, log_entry, "PROCESSING")
         session.commit()
+        hub.publish_log_entry(log_entry)
 
     try:
-        # 2. Pre-procesar archivo a imágenes
-        if filename.lower().endswith('.pdf'):
-            images = convert_pdf_to_images(file_bytes)
+        # 2. Consultar la caché de resultados (otra subida idéntica pudo terminar mientras esperaba)
+        prompt = load_prompt()
+        cache_key = result_cache.build_cache_key(
+            result_cache.hash_content(file_bytes), prompt, settings.gemini_model
+        )
+        with Session(engine) as session:
+            cached = result_cache.lookup(session, cache_key, record_miss=False)
+            if cached:
+                log_entry = load_owned_task(session, task_id, lease_owner)
+                if not log_entry:
+                    return _lease_lost(task_id, lease_owner)
+                result_cache.apply_cached_result(session, log_entry, cached)
+                stats.set_status(session, log_entry, "COMPLETED")
+                session.commit()
+                hub.publish_log_entry(log_entry)
+                print(f"Tarea {task_id} completada desde la caché de resultados")
+                return True
+
+        # 3. Buscar una extracción COMPLETED casi idéntica (la misma factura escaneada o fotografiada)
+        mime_type = FileValidator.sniff_mime_type(file_bytes[:1024])
+        fingerprint = None
+        if settings.near_duplicate_mode != "off":
+            fingerprint = await near_duplicates.compute_fingerprint_async(file_bytes, mime_type or "image/png")
+        if fingerprint is not None:
+            with Session(engine) as session:
+                match = near_duplicates.find_match(session, fingerprint)
+                if match:
+                    log_entry = load_owned_task(session, task_id, lease_owner)
+                    if not log_entry:
+                        return _lease_lost(task_id, lease_owner)
+                    log_entry.near_duplicate_of = match["task_id"]
+                    log_entry.near_duplicate_distance = match["distance"]
+                    # Solo se reutiliza el resultado si la capa de texto coincide: el hash
+                    # perceptual no distingue facturas distintas de un mismo proveedor
+                    reused = (settings.near_duplicate_mode == "reuse" and match["text_match"]
+                              and near_duplicates.reuse_result(session, log_entry, match["task_id"]))
+                    stats.record_near_duplicate(session, reused)
+                    if reused:
+                        stats.set_status(session, log_entry, "COMPLETED")
+                    session.commit()
+                    if reused:
+                        hub.publish_log_entry(log_entry)
+                        print(f"Tarea {task_id} completada con el resultado de la factura casi "
+                              f"duplicada {match['task_id']} ({match['distance']} bits distintos)")
+                        return True
+                    print(f"Tarea {task_id}: casi duplicada de {match['task_id']} "
+                          f"({match['distance']} bits distintos)")
+
+        # 4. Plantilla del proveedor: los PDFs nativos de proveedores conocidos se extraen sin Gemini
+        layout = None
+        prediction = None
+        if settings.supplier_template_mode != "off" and mime_type == "application/pdf":
+            layout = await supplier_templates.read_layout_async(file_bytes)
+        if layout is not None:
+            with Session(engine) as session:
+                prediction = supplier_templates.predict(session, layout)
+                confident = prediction is not None and prediction["confidence"] >= settings.supplier_template_min_confidence
+                use_template = (confident and settings.supplier_template_mode == "extract"
+                                and random.random() >= settings.supplier_template_audit_rate)
+                if use_template:
+                    log_entry = load_owned_task(session, task_id, lease_owner)
+                    if not log_entry:
+                        return _lease_lost(task_id, lease_owner)
+                    task_results.store_result(session, task_id, json.dumps(prediction["document"], ensure_ascii=False))
+                    log_entry.prompt_tokens = 0
+                    log_entry.completion_tokens = 0
+                    log_entry.total_tokens = 0
+                    log_entry.processing_path = stats.SUPPLIER_TEMPLATE_PATH
+                    log_entry.page_count = layout["page_count"]
+                    log_entry.completion_utc_timestamp = datetime.utcnow()
+                    if fingerprint is not None:
+                        near_duplicates.index_task(session, task_id, fingerprint)
+                    supplier_templates.record_hit(session, prediction["template_id"])
+                    stats.record_supplier_template(session, "hit")
+                    stats.set_status(session, log_entry, "COMPLETED")
+                    session.commit()
+                    hub.publish_log_entry(log_entry)
+                    print(f"Tarea {task_id} completada con la plantilla del proveedor {prediction['issuer_tax_id']}")
+                    return True
+                if prediction is None:
+                    stats.record_supplier_template(session, "no_template")
+                else:
+                    stats.record_supplier_template(session, "shadow_hit" if confident else "low_confidence")
+                    if not confident:
+                        print(f"Tarea {task_id}: plantilla del proveedor {prediction['issuer_tax_id']} "
+                              f"con confianza {prediction['confidence']}, se llama a Gemini")
+                session.commit()
+
+        # 5. Pre-procesar archivo: páginas con capa de texto como texto, el resto como imagen
+        #    Las páginas en blanco y las duplicadas se descartan antes de llamar a Gemini.
+        profile = get_render_profile(render_profile)
+        if mime_type == "application/pdf":
+            use_text_layer = settings.pdf_text_mode == "auto"
+            filter_pages = settings.page_filter_blank or settings.page_filter_duplicates
+            prepared = await prepare_pdf_pages_async(file_bytes, use_text_layer, profile, filter_pages)
+            pages = prepared.parts
+            page_count = prepared.page_count
+            blank_removed, duplicate_removed = prepared.blank_removed, prepared.duplicate_removed
         else:
-            # Para imágenes JPG/PNG, usar directamente
-            images = [file_bytes]
+            # Para imágenes JPG/PNG, enviar con su tipo real (recodificadas si el perfil lo pide)
+            pages = [await prepare_image_async(file_bytes, mime_type or "image/png", profile)]
+            page_count, blank_removed, duplicate_removed = 1, 0, 0
         
-        if not images:
+        if not pages:
             raise Exception("Error converting file to image format")
-
-        # 3. Llamar a Gemini
-        with open("promp.txt", "r", encoding="utf-8") as f:
-            prompt = f.read()
         
-        gemini_result = await get_invoice_data_from_gemini(prompt, images)
+        processing_path = describe_processing_path(pages)
+        print(f"Tarea {task_id}: {len(pages)} de {page_count} páginas enviadas por la vía '{processing_path}' "
+              f"(perfil {profile.name}, {blank_removed} en blanco y {duplicate_removed} duplicadas descartadas)")
+
+        # Llamar a Gemini (las facturas largas, por grupos de páginas en paralelo)
+        if should_chunk(len(pages)):
+            print(f"Tarea {task_id}: extracción por grupos de {settings.chunk_pages} páginas")
+            gemini_result = await extract_in_chunks(prompt, pages)
+        else:
+            gemini_result = await get_invoice_data_from_gemini(prompt, pages)
 
-        # 4. Actualizar la BD con el resultado final
+        # 6. Actualizar la BD con el resultado final
         with Session(engine) as session:
-            statement = select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)
-            log_entry = session.exec(statement).first()
+            log_entry = load_owned_task(session, task_id, lease_owner)
             if not log_entry:
+                if lease_owner is not None:
+                    return _lease_lost(task_id, lease_owner)
                 print(f"ERROR: Tarea {task_id} no encontrada para actualizar resultado")
-                return
-                
+                return False
+            
+            log_entry.processing_path = processing_path
+            log_entry.page_count = page_count
+            log_entry.blank_pages_removed = blank_removed
+            log_entry.duplicate_pages_removed = duplicate_removed
+            stats.record_pages_removed(session, blank_removed, duplicate_removed)
+            
             if "error" in gemini_result:
-                log_entry.status = "FAILED"
-                log_entry.error_message = str(gemini_result["error"])
+                new_status = "FAILED"
+                task_results.store_error(session, task_id, str(gemini_result["error"]))
             else:
-                log_entry.status = "COMPLETED"
-                log_entry.final_json_response = gemini_result["json_text"]
+                new_status = "COMPLETED"
+                task_results.store_result(session, task_id, gemini_result["json_text"])
                 log_entry.prompt_tokens = gemini_result["usage"]["prompt_tokens"]
                 log_entry.completion_tokens = gemini_result["usage"]["completion_tokens"]
                 log_entry.total_tokens = gemini_result["usage"]["total_tokens"]
+                result_cache.store(session, cache_key, gemini_result)
+                if fingerprint is not None:
+                    near_duplicates.index_task(session, task_id, fingerprint)
                 
             log_entry.completion_utc_timestamp = datetime.utcnow()
-            session.add(log_entry)
+            stats.set_status(session, log_entry, new_status)
             session.commit()
+            hub.publish_log_entry(log_entry)
+
+        # 7. Aprender o verificar la plantilla del proveedor con el resultado de Gemini
+        if layout is not None and new_status == "COMPLETED":
+            _learn_supplier_template(task_id, layout, gemini_result["json_text"], prediction)
             
         print(f"Tarea {task_id} completada exitosamente")
+        return True
         
     except Exception as e:
         print(f"ERROR procesando tarea {task_id}: {str(e)}")
-        # Marcar como fallida en caso de error
+        # Marcar como fallida en caso de error (solo si la tarea sigue siendo de este worker)
+        with Session(engine) as session:
+            log_entry = load_owned_task(session, task_id, lease_owner)
+            if not log_entry:
+                return _lease_lost(task_id, lease_owner) if lease_owner is not None else False
+            task_results.store_error(session, task_id, str(e))
+            log_entry.completion_utc_timestamp = datetime.utcnow()
+            stats.set_status(session, log_entry, "FAILED")
+            session.commit()
+            hub.publish_log_entry(log_entry)
+            return True
+
+
+def _learn_supplier_template(task_id: uuid.UUID, layout: dict, json_text: str, prediction: Optional[dict]) -> None:
+    """
+    Actualiza la plantilla del proveedor en su propia transacción: la tarea ya está
+    COMPLETED y un error aquí no debe cambiarlo.
+    """
+    confident = prediction is not None and prediction["confidence"] >= settings.supplier_template_min_confidence
+    try:
         with Session(engine) as session:
-            statement = select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)
-            log_entry = session.exec(statement).first()
-            if log_entry:
-                log_entry.status = "FAILED"
-                log_entry.error_message = str(e)
-                log_entry.completion_utc_timestamp = datetime.utcnow()
-                session.add(log_entry)
-                session.commit()
\ No newline at end of file
+            agreed = supplier_templates.learn(session, layout, json_text)
+            if confident and agreed is not None:
+                stats.record_supplier_template(session, "audit_agreed" if agreed else "audit_mismatch")
+                session.commit()
+    except Exception as e:
+        print(f"Tarea {task_id}: no se pudo actualizar la plantilla del proveedor: {e}")
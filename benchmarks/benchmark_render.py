@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark de perfiles de renderizado.
+
+Para cada perfil muestra el tamaño enviado, el tiempo de renderizado y los tokens
+de entrada de uno o varios PDF. Con --extract llama además a Gemini con cada perfil
+y compara los campos extraídos con los del perfil 'standard'.
+
+Uso:
+    python -m benchmarks.benchmark_render factura1.pdf factura2.pdf [--profiles standard,compact] [--extract]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+import fitz  # PyMuPDF
+import google.generativeai as genai
+from config import settings
+from convert_toimage import _process_pages
+from gedata import get_invoice_data_from_gemini, load_prompt
+from gemini_scheduler import ESTIMATED_TOKENS_PER_IMAGE
+from render_profiles import RENDER_PROFILES, get_render_profile
+
+HEADER_FIELDS = [
+    "invoice_id", "issuer_name", "issuer_tax_id", "recipient_name", "recipient_tax_id",
+    "issue_date", "due_date", "total_amount", "tax_amount", "currency",
+]
+
+
+def count_tokens(prompt: str, pages: list) -> int:
+    """Cuenta los tokens con la API si hay API key; si no, los estima."""
+    if settings.gemini_api_key:
+        model = genai.GenerativeModel(settings.gemini_model)
+        return model.count_tokens([prompt] + pages).total_tokens
+    return len(prompt) // 4 + ESTIMATED_TOKENS_PER_IMAGE * len(pages)
+
+
+def render(pdf_bytes: bytes, profile) -> tuple:
+    """Renderiza todas las páginas con el perfil y devuelve (páginas, segundos)."""
+    page_count = len(fitz.open(stream=pdf_bytes, filetype="pdf"))
+    started = time.perf_counter()
+    pages = _process_pages(pdf_bytes, list(range(page_count)), False, profile)
+    return pages, time.perf_counter() - started
+
+
+def field_agreement(reference: dict, candidate: dict) -> float:
+    """Fracción de campos de cabecera que coinciden con la referencia."""
+    matches = sum(1 for field in HEADER_FIELDS if reference.get(field) == candidate.get(field))
+    return matches / len(HEADER_FIELDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de perfiles de renderizado")
+    parser.add_argument("pdfs", nargs="+", type=Path, help="Archivos PDF de prueba")
+    parser.add_argument("--profiles", default=",".join(list(RENDER_PROFILES) + ["custom"]),
+                        help="Perfiles a comparar, separados por comas")
+    parser.add_argument("--extract", action="store_true",
+                        help="Llamar a Gemini y comparar la extracción con el perfil 'standard'")
+    args = parser.parse_args()
+
+    prompt = load_prompt()
+    profiles = [get_render_profile(name.strip()) for name in args.profiles.split(",")]
+    if args.extract:
+        # La extracción con el perfil 'standard' es la referencia: se ejecuta primero
+        profiles = [RENDER_PROFILES["standard"]] + [p for p in profiles if p.name != "standard"]
+    references = {}
+
+    print(f"{'perfil':<10} {'archivo':<28} {'págs':>4} {'bytes':>12} {'render s':>9} {'tokens':>8} {'acierto':>8}")
+    print("-" * 85)
+    for profile in profiles:
+        for pdf_path in args.pdfs:
+            pages, seconds = render(pdf_path.read_bytes(), profile)
+            total_bytes = sum(len(page["data"]) for page in pages)
+            tokens = count_tokens(prompt, pages)
+
+            agreement = "-"
+            if args.extract:
+                result = asyncio.run(get_invoice_data_from_gemini(prompt, pages))
+                extracted = json.loads(result["json_text"]) if "json_text" in result else {}
+                if profile.name == "standard":
+                    references[pdf_path] = extracted
+                agreement = f"{field_agreement(references[pdf_path], extracted):.0%}"
+
+            print(f"{profile.name:<10} {pdf_path.name[:28]:<28} {len(pages):>4} {total_bytes:>12,} "
+                  f"{seconds:>9.3f} {tokens:>8} {agreement:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de la respuesta de /api/v1/invoices/status/{task_id} para una tarea COMPLETED.
+
+Mide solo la construcción de la respuesta a partir de la fila de TaskResult (sin red
+ni base de datos), con facturas de distinto número de líneas:
+
+- antes:   JSON de Gemini tal cual, json.loads en cada consulta, jsonable_encoder y JSONResponse
+- después: JSON normalizado al completar, pasado sin decodificar a FastJSONResponse (orjson)
+
+Uso:
+    python -m benchmarks.benchmark_status [--line-items 10,100,1000] [--iterations 2000]
+"""
+
+import argparse
+import json
+import statistics
+import time
+import uuid
+import zlib
+from datetime import datetime
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from json_response import FastJSONResponse, HAS_FRAGMENT
+from task_results import COMPRESSION_LEVEL, normalize_json, parse_result, result_content
+
+
+def sample_invoice(line_items: int) -> str:
+    """Respuesta de Gemini de ejemplo (con sangría, como la devuelve el modelo)."""
+    return json.dumps({
+        "invoice_id": "INV-2024-001",
+        "issuer_name": "ACME Corp",
+        "issuer_tax_id": "B12345678",
+        "recipient_name": "Cliente Ejemplo S.L.",
+        "recipient_tax_id": "B87654321",
+        "issue_date": "2024-03-15",
+        "due_date": "2024-04-15",
+        "total_amount": 1210.0,
+        "tax_amount": 210.0,
+        "currency": "EUR",
+        "line_items": [
+            {"description": f"Producto {index}", "quantity": index % 7 + 1,
+             "unit_price": 10.5, "total_price": 10.5 * (index % 7 + 1)}
+            for index in range(line_items)
+        ],
+    }, indent=2, ensure_ascii=False)
+
+
+def status_metadata() -> dict:
+    return {
+        "task_id": uuid.uuid4(),
+        "status": "COMPLETED",
+        "filename": "factura.pdf",
+        "user_identifier": "usuario123",
+        "batch_id": uuid.uuid4(),
+        "cache_hit": False,
+        "processing_path": "image",
+        "created_at": datetime.utcnow().isoformat(),
+        "completed_at": datetime.utcnow().isoformat(),
+        "tokens_used": 1800,
+    }
+
+
+def before(stored: bytes) -> bytes:
+    response = status_metadata()
+    response["data"] = parse_result(stored)
+    return JSONResponse(jsonable_encoder(response)).body
+
+
+def after(stored: bytes) -> bytes:
+    response = status_metadata()
+    response["data"] = result_content(stored, normalized=True)
+    return FastJSONResponse(response).body
+
+
+def measure(build, stored: bytes, iterations: int) -> list:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        build(stored)
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--line-items", default="10,100,1000", help="Líneas por factura, separadas por comas")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"orjson.Fragment disponible: {'sí' if HAS_FRAGMENT else 'no (se decodifica el resultado)'}")
+    print(f"{'líneas':>7} {'modo':<8} {'p50 µs':>9} {'p99 µs':>9} {'bytes':>9}")
+    print("-" * 46)
+    for line_items in [int(value) for value in args.line_items.split(",")]:
+        raw_text = sample_invoice(line_items)
+        stored_before = zlib.compress(raw_text.encode("utf-8"), COMPRESSION_LEVEL)
+        stored_after = zlib.compress(normalize_json(raw_text), COMPRESSION_LEVEL)
+        for mode, build, stored in (("antes", before, stored_before), ("después", after, stored_after)):
+            build(stored)  # Calentamiento
+            timings = sorted(measure(build, stored, args.iterations))
+            p50 = statistics.median(timings)
+            p99 = timings[int(len(timings) * 0.99) - 1]
+            print(f"{line_items:>7} {mode:<8} {p50:>9.1f} {p99:>9.1f} {len(build(stored)):>9,}")
+
+
+if __name__ == "__main__":
+    main()
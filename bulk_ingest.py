@@ -0,0 +1,219 @@
+# bulk_ingest.py
+"""
+Ingesta masiva: un archivo ZIP o TAR con miles de facturas en una sola petición.
+
+Los miembros se leen por bloques directamente desde el archivo subido (que
+Starlette ya guarda en disco) hasta UPLOAD_DIR, validando tipo real y tamaño
+sobre la marcha; el archivo completo nunca se carga en memoria. Las filas de
+ApiTrackingLog del lote se insertan con un único commit.
+"""
+
+import hashlib
+import os
+import tarfile
+import uuid
+import zipfile
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+from sqlmodel import Session
+from config import settings
+from file_storage import upload_path, delete_upload
+from gedata import load_prompt
+from models import ApiTrackingLog, InvoiceBatch
+from validators import FileValidator
+import result_cache
+import stats
+
+
+class ArchiveError(Exception):
+    """El archivo no es un ZIP/TAR legible o supera los límites de la ingesta masiva."""
+
+
+@dataclass
+class StagedFile:
+    """Miembro válido del archivo, ya copiado a UPLOAD_DIR."""
+    task_id: uuid.UUID
+    filename: str
+    path: str
+    size: int
+    sha256: str
+    mime_type: str
+
+
+@dataclass
+class StagedArchive:
+    files: List[StagedFile] = field(default_factory=list)
+    rejected: List[dict] = field(default_factory=list)
+
+    def discard(self) -> None:
+        """Elimina de disco los archivos copiados (petición rechazada)."""
+        for staged in self.files:
+            delete_upload(staged.path)
+
+
+def _iter_members(fileobj: BinaryIO) -> Iterator[Tuple[str, int, BinaryIO]]:
+    """
+    Recorre los archivos regulares de un ZIP o TAR (también .tar.gz, .tar.bz2, .tar.xz).
+    Devuelve (nombre, tamaño declarado, flujo de lectura) de cada miembro.
+    """
+    fileobj.seek(0)
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as stream:
+                    yield info.filename, info.file_size, stream
+        return
+
+    fileobj.seek(0)
+    try:
+        # Modo flujo ("r|*"): los miembros se leen en orden, sin índice ni saltos atrás
+        with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                stream = archive.extractfile(member)
+                if stream is not None:
+                    yield member.name, member.size, stream
+    except tarfile.ReadError as e:
+        raise ArchiveError(f"El archivo no es un ZIP o TAR válido: {e}")
+
+
+def _is_ignored(member_name: str) -> bool:
+    """Metadatos que añaden los compresores (macOS) y archivos ocultos."""
+    base_name = os.path.basename(member_name)
+    return member_name.startswith("__MACOSX/") or not base_name or base_name.startswith(".")
+
+
+def _stage_member(filename: str, declared_size: int, stream: BinaryIO) -> StagedFile:
+    """
+    Copia un miembro a UPLOAD_DIR por bloques, con las mismas comprobaciones que una
+    subida individual. Lanza ValueError con el motivo si el miembro no es válido.
+    """
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if extension not in settings.allowed_extensions:
+        raise ValueError(f"Extensión no permitida: .{extension}")
+
+    max_size = settings.max_file_size_mb * 1024 * 1024
+    if declared_size > max_size:
+        raise ValueError(f"Excede el tamaño máximo de {settings.max_file_size_mb}MB")
+
+    chunk_size = settings.upload_chunk_size_kb * 1024
+    task_id = uuid.uuid4()
+    path = upload_path(task_id, filename)
+    digest = hashlib.sha256()
+    size = 0
+    mime_type = None
+    try:
+        with open(path, "wb") as target:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                if mime_type is None:
+                    mime_type = FileValidator.sniff_mime_type(chunk)
+                    if mime_type is None:
+                        raise ValueError("El contenido no es un PDF, JPEG o PNG válido")
+                    if extension not in FileValidator.ALLOWED_MIME_TYPES[mime_type]:
+                        raise ValueError(f"El contenido ({mime_type}) no coincide con su extensión .{extension}")
+                # El tamaño declarado en la cabecera no es fiable (bombas de compresión)
+                size += len(chunk)
+                if size > max_size:
+                    raise ValueError(f"Excede el tamaño máximo de {settings.max_file_size_mb}MB")
+                digest.update(chunk)
+                target.write(chunk)
+        if size == 0:
+            raise ValueError("El archivo está vacío")
+    except BaseException:
+        delete_upload(path)
+        raise
+
+    return StagedFile(task_id=task_id, filename=filename, path=path, size=size,
+                      sha256=digest.hexdigest(), mime_type=mime_type)
+
+
+def stage_archive(fileobj: BinaryIO) -> StagedArchive:
+    """
+    Valida los miembros del archivo y copia los válidos a UPLOAD_DIR. Los inválidos
+    se devuelven en `rejected` sin abortar el resto. Es síncrono: el llamador lo
+    ejecuta en un hilo para no bloquear el event loop.
+    """
+    staged = StagedArchive()
+    members = 0
+    try:
+        for member_name, declared_size, stream in _iter_members(fileobj):
+            if _is_ignored(member_name):
+                continue
+            members += 1
+            if members > settings.bulk_max_files:
+                raise ArchiveError(f"Máximo {settings.bulk_max_files} archivos por ingesta masiva")
+            try:
+                staged.files.append(_stage_member(member_name, declared_size, stream))
+            except (ValueError, RuntimeError, zipfile.BadZipFile) as e:
+                # RuntimeError: miembro cifrado; BadZipFile: CRC incorrecto
+                staged.rejected.append({"filename": member_name, "error": str(e)})
+    except (ArchiveError, zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+        staged.discard()
+        if isinstance(e, ArchiveError):
+            raise
+        raise ArchiveError(f"No se pudo leer el archivo: {e}")
+    return staged
+
+
+def create_tasks(session: Session, batch: InvoiceBatch, staged: StagedArchive,
+                 user_identifier: str, render_profile: Optional[str] = None) -> Tuple[List[dict], int]:
+    """
+    Crea las filas de ApiTrackingLog de todos los archivos del lote con un solo
+    commit. Los archivos con resultado en caché se completan al momento.
+    Devuelve ({task_id, status, filename} de cada tarea, número de resultados de caché).
+    """
+    prompt = load_prompt()
+    cache_keys = [
+        result_cache.build_cache_key(staged_file.sha256, prompt, settings.gemini_model)
+        for staged_file in staged.files
+    ]
+    cached_entries = result_cache.lookup_many(session, cache_keys)
+
+    now = datetime.utcnow()
+    log_entries = []
+    pending = 0
+    cached_paths = []
+    for staged_file, cache_key in zip(staged.files, cache_keys):
+        log_entry = ApiTrackingLog(
+            task_id=staged_file.task_id,
+            batch_id=batch.batch_id,
+            user_identifier=user_identifier,
+            status="PENDING",
+            filename=staged_file.filename,
+            render_profile=render_profile,
+            request_utc_timestamp=now,
+            status_updated_utc_timestamp=now,
+            stored_path=staged_file.path
+        )
+        cached = cached_entries.get(cache_key)
+        if cached:
+            log_entry.status = "COMPLETED"
+            log_entry.stored_path = None
+            result_cache.apply_cached_result(session, log_entry, cached)
+            stats.record_new_task(session, log_entry)
+            cached_paths.append(staged_file.path)
+        else:
+            pending += 1
+        log_entries.append(log_entry)
+
+    session.add_all(log_entries)
+    stats.record_new_pending_tasks(session, user_identifier, now.date(), pending)
+    # Tras el commit las filas quedan expiradas: se copian antes para no recargarlas una a una
+    created = [
+        {"task_id": log_entry.task_id, "status": log_entry.status, "filename": log_entry.filename}
+        for log_entry in log_entries
+    ]
+    session.commit()
+
+    for path in cached_paths:
+        delete_upload(path)
+    return created, len(cached_paths)
+
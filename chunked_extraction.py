@@ -0,0 +1,101 @@
+# chunked_extraction.py
+"""
+Extracción por grupos de páginas para facturas largas.
+
+Un PDF con muchas páginas se divide en grupos de CHUNK_PAGES páginas que se
+extraen en paralelo (cada grupo es una llamada a Gemini más pequeña y rápida).
+Después se combinan los resultados: los campos de cabecera se toman del primer
+grupo que los contiene (los totales, del último) y los line_items se concatenan
+en el orden de las páginas.
+"""
+
+import asyncio
+import json
+from typing import Any, Dict, List, Union
+from config import settings
+from gedata import get_invoice_data_from_gemini
+
+# Campos que suelen aparecer en el resumen final: se toma el último valor no nulo
+LAST_VALUE_FIELDS = {"total_amount", "tax_amount"}
+
+
+def should_chunk(page_count: int) -> bool:
+    """True si la factura tiene páginas suficientes para extraerse por grupos."""
+    return (
+        settings.chunked_extraction_min_pages > 0
+        and page_count >= settings.chunked_extraction_min_pages
+        and page_count > settings.chunk_pages
+    )
+
+
+def split_pages(pages: list, chunk_size: int) -> List[list]:
+    """Divide las páginas en grupos consecutivos de como mucho `chunk_size` páginas."""
+    chunk_size = max(1, chunk_size)
+    return [pages[start:start + chunk_size] for start in range(0, len(pages), chunk_size)]
+
+
+def chunk_instructions(first_page: int, last_page: int, total_pages: int) -> str:
+    return (
+        f"Se te proporcionan solo las páginas {first_page} a {last_page} de una factura de "
+        f"{total_pages} páginas. Extrae los campos de cabecera que aparezcan en estas páginas "
+        "(null si no aparecen) y únicamente los line_items que aparecen en ellas. No devuelvas "
+        "el objeto de error solo porque falten campos que podrían estar en otras páginas."
+    )
+
+
+async def extract_in_chunks(prompt: str, pages: List[Union[bytes, str, dict]]) -> dict:
+    """
+    Extrae cada grupo de páginas en paralelo (como mucho CHUNK_MAX_CONCURRENCY a la vez)
+    y combina los resultados. Devuelve el mismo formato que get_invoice_data_from_gemini.
+    """
+    groups = split_pages(pages, settings.chunk_pages)
+    slots = asyncio.Semaphore(max(1, settings.chunk_max_concurrency))
+
+    async def extract_group(index: int, group: list) -> dict:
+        first_page = index * settings.chunk_pages + 1
+        instructions = chunk_instructions(first_page, first_page + len(group) - 1, len(pages))
+        async with slots:
+            return await get_invoice_data_from_gemini(prompt, group, instructions=instructions)
+
+    results = await asyncio.gather(*(extract_group(index, group) for index, group in enumerate(groups)))
+
+    # Si un grupo falla tras los reintentos, la factura no está completa: se informa del error
+    for index, result in enumerate(results):
+        if "error" in result:
+            return {"error": f"Grupo de páginas {index + 1} de {len(groups)}: {result['error']}"}
+
+    usage = {
+        key: sum(result["usage"][key] or 0 for result in results)
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens")
+    }
+    try:
+        documents = [json.loads(result["json_text"]) for result in results]
+    except json.JSONDecodeError as e:
+        return {"error": f"Respuesta no válida en la extracción por grupos: {e}"}
+
+    return {"json_text": json.dumps(merge_documents(documents), ensure_ascii=False), "usage": usage}
+
+
+def merge_documents(documents: List[Any]) -> Any:
+    """
+    Combina las extracciones de cada grupo (en orden de páginas).
+
+    Los grupos que devuelven el objeto de error (p. ej. páginas de condiciones
+    generales) se ignoran; si todos lo devuelven, se devuelve el primero.
+    """
+    invoices = [doc for doc in documents if isinstance(doc, dict) and "error" not in doc]
+    if not invoices:
+        return documents[0]
+
+    merged: Dict[str, Any] = {}
+    for document in invoices:
+        for field, value in document.items():
+            if isinstance(value, list):
+                merged.setdefault(field, [])
+                if isinstance(merged[field], list):
+                    merged[field].extend(value)
+            elif value is not None and (merged.get(field) is None or field in LAST_VALUE_FIELDS):
+                merged[field] = value
+            else:
+                merged.setdefault(field, None)
+    return merged
@@ -18,19 +18,102 @@ class Settings(BaseSettings):
     
     # Gemini API
     gemini_api_key: str = Field(default="", alias="GEMINI_API_KEY")
+    gemini_model: str = Field(default="gemini-1.5-flash", alias="GEMINI_MODEL")
+    gemini_context_cache: bool = Field(default=False, alias="GEMINI_CONTEXT_CACHE") # Caché del prompt en el proveedor
+    gemini_context_cache_ttl_minutes: int = Field(default=60, alias="GEMINI_CONTEXT_CACHE_TTL_MINUTES")
+    # Cuotas del proyecto en Gemini (0 = sin límite) y reintentos de errores transitorios
+    gemini_rpm_limit: int = Field(default=60, alias="GEMINI_RPM_LIMIT")
+    gemini_tpm_limit: int = Field(default=1000000, alias="GEMINI_TPM_LIMIT")
+    gemini_estimated_output_tokens: int = Field(default=800, alias="GEMINI_ESTIMATED_OUTPUT_TOKENS")
+    gemini_max_retries: int = Field(default=5, alias="GEMINI_MAX_RETRIES")
+    gemini_backoff_base_seconds: float = Field(default=2.0, alias="GEMINI_BACKOFF_BASE_SECONDS")
+    gemini_backoff_max_seconds: float = Field(default=60.0, alias="GEMINI_BACKOFF_MAX_SECONDS")
     
     # Database
     database_url: str = Field(default="sqlite:///./invoices.db", alias="DATABASE_URL")
+    db_pool_size: int = Field(default=10, alias="DB_POOL_SIZE") # Solo motores con servidor (PostgreSQL)
+    db_max_overflow: int = Field(default=20, alias="DB_MAX_OVERFLOW")
+    db_pool_pre_ping: bool = Field(default=True, alias="DB_POOL_PRE_PING")
+    db_pool_recycle_seconds: int = Field(default=1800, alias="DB_POOL_RECYCLE_SECONDS")
+    sqlite_journal_mode: str = Field(default="WAL", alias="SQLITE_JOURNAL_MODE") # WAL o DELETE (modo por defecto de SQLite)
+    sqlite_busy_timeout_ms: int = Field(default=5000, alias="SQLITE_BUSY_TIMEOUT_MS")
     
     # Server
     host: str = Field(default="127.0.0.1", alias="HOST")
     port: int = Field(default=8000, alias="PORT")
+    server_mode: str = Field(default="development", alias="SERVER_MODE") # development (recarga automática) o production
+    web_workers: int = Field(default=0, alias="WEB_WORKERS") # Procesos HTTP en producción (0 = uno por núcleo)
+    queue_workers: int = Field(default=1, alias="QUEUE_WORKERS") # Procesos de procesamiento en producción
+    embedded_dispatcher: bool = Field(default=True, alias="EMBEDDED_DISPATCHER") # El proceso HTTP también procesa tareas
+    db_migrate_on_startup: bool = Field(default=True, alias="DB_MIGRATE_ON_STARTUP") # En producción lo desactiva run_server.py en los procesos hijos
     
     # File Processing
     max_file_size_mb: int = Field(default=10, alias="MAX_FILE_SIZE_MB")
+    upload_chunk_size_kb: int = Field(default=64, alias="UPLOAD_CHUNK_SIZE_KB")
+    bulk_max_files: int = Field(default=5000, alias="BULK_MAX_FILES") # Archivos por ZIP/TAR en la ingesta masiva
+    bulk_max_archive_mb: int = Field(default=2048, alias="BULK_MAX_ARCHIVE_MB")
+    render_workers: int = Field(default=0, alias="RENDER_WORKERS") # 0 = un proceso por núcleo
+    render_profile: str = Field(default="standard", alias="RENDER_PROFILE") # standard, compact, grayscale, economy o custom
+    # Parámetros del perfil 'custom'
+    render_dpi: int = Field(default=144, alias="RENDER_DPI")
+    render_grayscale: bool = Field(default=False, alias="RENDER_GRAYSCALE")
+    render_format: str = Field(default="jpeg", alias="RENDER_FORMAT") # png, jpeg o webp
+    render_quality: int = Field(default=80, alias="RENDER_QUALITY")
+    render_max_dimension: int = Field(default=0, alias="RENDER_MAX_DIMENSION") # 0 = sin límite
+    pdf_text_mode: str = Field(default="auto", alias="PDF_TEXT_MODE") # auto: usar la capa de texto si existe; off: renderizar siempre
+    text_layer_min_chars: int = Field(default=100, alias="TEXT_LAYER_MIN_CHARS")
+    # Filtro previo de páginas en blanco y duplicadas
+    page_filter_blank: bool = Field(default=True, alias="PAGE_FILTER_BLANK")
+    blank_page_max_stddev: float = Field(default=8.0, alias="BLANK_PAGE_MAX_STDDEV") # Desviación típica de píxeles por zona (0-255)
+    page_filter_duplicates: bool = Field(default=True, alias="PAGE_FILTER_DUPLICATES")
+    duplicate_page_max_distance: int = Field(default=12, alias="DUPLICATE_PAGE_MAX_DISTANCE") # Bits distintos de 1024 (dHash)
+    # Facturas casi duplicadas entre subidas (hash perceptual de la primera página)
+    near_duplicate_mode: str = Field(default="flag", alias="NEAR_DUPLICATE_MODE") # off, flag (marcar) o reuse (reutilizar el resultado si el texto coincide)
+    near_duplicate_max_distance: int = Field(default=10, alias="NEAR_DUPLICATE_MAX_DISTANCE") # Bits distintos de 64 (máximo 15)
+    # Plantillas de proveedor: PDFs nativos de proveedores conocidos extraídos sin Gemini
+    supplier_template_mode: str = Field(default="extract", alias="SUPPLIER_TEMPLATE_MODE") # off, learn (solo aprender y medir) o extract
+    supplier_template_min_verified: int = Field(default=2, alias="SUPPLIER_TEMPLATE_MIN_VERIFIED") # Facturas en que cada regla reprodujo a Gemini
+    supplier_template_min_confidence: float = Field(default=1.0, alias="SUPPLIER_TEMPLATE_MIN_CONFIDENCE") # Fracción de campos verificados (0-1)
+    supplier_template_audit_rate: float = Field(default=0.05, alias="SUPPLIER_TEMPLATE_AUDIT_RATE") # Fracción de aciertos que se contrastan con Gemini
+    supplier_template_max_pages: int = Field(default=3, alias="SUPPLIER_TEMPLATE_MAX_PAGES")
+    # Extracción por grupos de páginas para facturas largas (0 = desactivada)
+    chunked_extraction_min_pages: int = Field(default=12, alias="CHUNKED_EXTRACTION_MIN_PAGES")
+    chunk_pages: int = Field(default=6, alias="CHUNK_PAGES")
+    chunk_max_concurrency: int = Field(default=4, alias="CHUNK_MAX_CONCURRENCY")
     
     # Processing
     max_concurrent_tasks: int = Field(default=5, alias="MAX_CONCURRENT_TASKS")
+    queue_poll_interval_seconds: float = Field(default=2.0, alias="QUEUE_POLL_INTERVAL_SECONDS")
+    upload_dir: str = Field(default="./data/uploads", alias="UPLOAD_DIR")
+    # Recuperación de tareas PROCESSING huérfanas (worker caído o reiniciado)
+    task_lease_seconds: int = Field(default=120, alias="TASK_LEASE_SECONDS") # Sin heartbeat en este tiempo, la tarea se recupera
+    task_heartbeat_seconds: float = Field(default=30.0, alias="TASK_HEARTBEAT_SECONDS")
+    task_max_attempts: int = Field(default=3, alias="TASK_MAX_ATTEMPTS") # Al agotarlos, la tarea pasa a FAILED
+    reaper_interval_seconds: float = Field(default=30.0, alias="REAPER_INTERVAL_SECONDS")
+    # Control de admisión (0 = sin límite): por encima, las subidas reciben 503 con Retry-After
+    admission_max_tasks: int = Field(default=1000, alias="ADMISSION_MAX_TASKS") # Tareas PENDING + PROCESSING
+    admission_max_mb: int = Field(default=512, alias="ADMISSION_MAX_MB") # Por proceso: subidas en curso + archivos cargados por los workers
+    admission_retry_after_seconds: int = Field(default=30, alias="ADMISSION_RETRY_AFTER_SECONDS")
+    
+    # Exportación de extracciones para el ERP
+    export_fetch_size: int = Field(default=500, alias="EXPORT_FETCH_SIZE") # Filas por lote del cursor de servidor
+    export_watermark_lag_seconds: int = Field(default=5, alias="EXPORT_WATERMARK_LAG_SECONDS")
+    
+    # Eventos en tiempo real (Server-Sent Events)
+    event_queue_size: int = Field(default=100, alias="EVENT_QUEUE_SIZE") # Eventos pendientes por conexión
+    event_heartbeat_seconds: float = Field(default=15.0, alias="EVENT_HEARTBEAT_SECONDS")
+    event_max_connections: int = Field(default=5000, alias="EVENT_MAX_CONNECTIONS")
+    event_poll_interval_seconds: float = Field(default=1.0, alias="EVENT_POLL_INTERVAL_SECONDS") # Sin despachador propio: sondeo de cambios de estado
+    
+    # Result Cache (resultados reutilizados para archivos idénticos)
+    result_cache_enabled: bool = Field(default=True, alias="RESULT_CACHE_ENABLED")
+    result_cache_max_entries: int = Field(default=10000, alias="RESULT_CACHE_MAX_ENTRIES")
+    result_cache_max_mb: int = Field(default=256, alias="RESULT_CACHE_MAX_MB")
+    result_cache_ttl_hours: int = Field(default=720, alias="RESULT_CACHE_TTL_HOURS")
+    
+    # Caché en memoria de respuestas de /status de tareas terminadas (por proceso; 0 la desactiva)
+    status_cache_max_entries: int = Field(default=20000, alias="STATUS_CACHE_MAX_ENTRIES")
+    status_cache_max_mb: int = Field(default=64, alias="STATUS_CACHE_MAX_MB")
     
     model_config = SettingsConfigDict(
         env_file=".env",
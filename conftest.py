@@ -0,0 +1,14 @@
+"""
+Entorno de las pruebas que no necesitan el servidor: base de datos SQLite y
+subidas en un directorio temporal, sin despachador embebido. Tiene que
+importarse antes que config.py; pytest lo carga solo y las pruebas lo importan
+para poder ejecutarse también como `python test_x.py`.
+"""
+
+import os
+import tempfile
+
+_test_dir = tempfile.mkdtemp(prefix="invoice-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_test_dir, 'invoices.db')}")
+os.environ.setdefault("UPLOAD_DIR", os.path.join(_test_dir, "uploads"))
+os.environ.setdefault("EMBEDDED_DISPATCHER", "false")
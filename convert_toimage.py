@@ -1,30 +1,201 @@
+import asyncio
+import math
+import multiprocessing
+import os
 import fitz  # PyMuPDF
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Tuple, Union
+from config import settings
+from render_profiles import RenderProfile, get_render_profile, encode_pixmap, reencode_image
+import page_filter
 
-def convert_pdf_to_images(pdf_bytes: bytes) -> List[bytes]:
+# Pool de procesos para renderizar páginas fuera del event loop (se crea bajo demanda)
+_render_pool: Optional[ProcessPoolExecutor] = None
+
+def get_render_workers() -> int:
+    """
+    Número de procesos de renderizado (RENDER_WORKERS=0 usa todos los núcleos).
+    """
+    return settings.render_workers or os.cpu_count() or 1
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """
+    Devuelve el pool de procesos de renderizado, creándolo la primera vez.
     """
-    Convierte cada página de un archivo PDF (proporcionado como bytes) en una lista de imágenes PNG (también como bytes).
+    global _render_pool
+    if _render_pool is None:
+        # 'spawn' evita heredar el estado del event loop y los hilos del servidor
+        _render_pool = ProcessPoolExecutor(
+            max_workers=get_render_workers(),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _render_pool
+
+def shutdown_render_pool() -> None:
+    """
+    Cierra el pool de procesos de renderizado.
+    """
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=True, cancel_futures=True)
+        _render_pool = None
+
+def _extract_text_layer(page: fitz.Page) -> Optional[str]:
     """
-    images = []
+    Extrae la capa de texto de una página con pistas de maquetación: cada bloque
+    se precede de su posición [x,y] en puntos. Devuelve None si la página no tiene
+    texto utilizable (página escaneada o texto ilegible).
+    """
+    lines = []
+    char_count = 0
+    for x0, y0, _x1, _y1, text, _block_no, block_type in page.get_text("blocks", sort=True):
+        if block_type != 0:  # 1 = bloque de imagen
+            continue
+        text = " | ".join(line.strip() for line in text.splitlines() if line.strip())
+        if not text:
+            continue
+        char_count += len(text)
+        lines.append(f"[{round(x0)},{round(y0)}] {text}")
+    
+    if char_count < settings.text_layer_min_chars:
+        return None
+    
+    body = "\n".join(lines)
+    # Fuentes sin tabla de Unicode producen caracteres de reemplazo: mejor renderizar
+    if body.count("\ufffd") > char_count * 0.05:
+        return None
+    
+    width, height = round(page.rect.width), round(page.rect.height)
+    header = f"--- Página {page.number + 1} (texto extraído del PDF, {width}x{height} pt, coordenadas [x,y] desde arriba a la izquierda) ---"
+    return f"{header}\n{body}"
+
+def _page_matrix(page: fitz.Page, profile: RenderProfile) -> fitz.Matrix:
+    """
+    Matriz de zoom para renderizar la página a los DPI del perfil sin superar su lado máximo.
+    """
+    zoom = profile.dpi / 72.0
+    if profile.max_dimension:
+        longest_side = max(page.rect.width, page.rect.height)
+        zoom = min(zoom, profile.max_dimension / longest_side)
+    return fitz.Matrix(zoom, zoom)
+
+def _process_pages(pdf_bytes: bytes, page_numbers: List[int], use_text_layer: bool,
+                   profile: RenderProfile) -> List[Union[str, dict]]:
+    """
+    Prepara un grupo de páginas para Gemini. Las páginas con capa de texto utilizable
+    se envían como texto; el resto se renderiza con el perfil indicado. Se ejecuta
+    dentro del pool de procesos.
+    """
+    return [part for part, _fingerprint in _prepare_pages(pdf_bytes, page_numbers, use_text_layer, profile, False)]
+
+def _prepare_pages(pdf_bytes: bytes, page_numbers: List[int], use_text_layer: bool,
+                   profile: RenderProfile, filter_pages: bool) -> List[Tuple[Optional[Union[str, dict]], Any]]:
+    """
+    Como _process_pages, pero con filter_pages devuelve también la huella de cada página
+    para detectar duplicados. Las páginas en blanco se devuelven como (None, None) sin
+    llegar a renderizarse a resolución completa.
+    """
+    parts = []
+    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+    for page_number in page_numbers:
+        page = pdf_document.load_page(page_number)
+        if use_text_layer:
+            text = _extract_text_layer(page)
+            if text:
+                parts.append((text, page_filter.text_fingerprint(text) if filter_pages else None))
+                continue
+        
+        fingerprint = None
+        if filter_pages:
+            # Miniatura barata: si la página está en blanco no se renderiza
+            measures = page_filter.fingerprint_page(page)
+            if page_filter.is_blank(measures):
+                parts.append((None, None))
+                continue
+            fingerprint = measures
+        
+        # Renderizar la página a un pixmap (una representación de imagen en memoria)
+        # La matriz de zoom fija la resolución (DPI) según el perfil para mejorar la calidad del OCR
+        colorspace = fitz.csGRAY if profile.grayscale else fitz.csRGB
+        pix = page.get_pixmap(matrix=_page_matrix(page, profile), colorspace=colorspace, alpha=False)
+        
+        # Codificar el pixmap en el formato del perfil (PNG, JPEG o WebP)
+        parts.append(({"mime_type": profile.mime_type, "data": encode_pixmap(pix, profile)}, fingerprint))
+    return parts
+
+async def prepare_pdf_pages_async(pdf_bytes: bytes, use_text_layer: bool,
+                                  profile: Optional[RenderProfile] = None,
+                                  filter_pages: bool = True) -> page_filter.FilteredPages:
+    """
+    Prepara las páginas de un PDF para Gemini sin bloquear el event loop: las páginas
+    se reparten en grupos contiguos entre los procesos del pool.
+    
+    Cada parte es un texto (página con capa de texto, si use_text_layer) o un dict
+    {"mime_type", "data"} con la página renderizada según el perfil. Con filter_pages
+    se descartan además las páginas en blanco y las casi idénticas a una anterior;
+    siempre se envía al menos una página.
+    """
+    profile = profile or get_render_profile()
+    loop = asyncio.get_running_loop()
+    pool = get_render_pool()
     try:
-        # Abrir el PDF desde el stream de bytes en memoria
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        # Abrir el documento solo para contar páginas es barato (no renderiza nada)
+        page_count = len(fitz.open(stream=pdf_bytes, filetype="pdf"))
+        if page_count == 0:
+            return page_filter.FilteredPages(parts=[], page_count=0)
         
-        # Iterar sobre cada página del documento
-        for page_number in range(len(pdf_document)):
-            page = pdf_document.load_page(page_number)
-            
-            # Renderizar la página a un pixmap (una representación de imagen en memoria)
-            # Se usa una matriz de zoom para aumentar la resolución (DPI) y mejorar la calidad del OCR
-            zoom_matrix = fitz.Matrix(2.0, 2.0) # Zoom 2x en cada dimensión = 300 DPI aprox.
-            pix = page.get_pixmap(matrix=zoom_matrix)
-            
-            # Guardar el pixmap como bytes en formato PNG
-            img_bytes = pix.tobytes("png")
-            images.append(img_bytes)
-            
+        group_size = math.ceil(page_count / min(get_render_workers(), page_count))
+        page_groups = [
+            list(range(start, min(start + group_size, page_count)))
+            for start in range(0, page_count, group_size)
+        ]
+        processed_groups = await asyncio.gather(*[
+            loop.run_in_executor(pool, _prepare_pages, pdf_bytes, group, use_text_layer, profile, filter_pages)
+            for group in page_groups
+        ])
+        pages = [page for group in processed_groups for page in group]
+        
+        parts = [part for part, _fingerprint in pages if part is not None]
+        fingerprints = [fingerprint for part, fingerprint in pages if part is not None]
+        blank_removed = page_count - len(parts)
+        if not parts:
+            # Todas las páginas parecen en blanco: enviar la primera para que Gemini decida
+            parts = await loop.run_in_executor(pool, _process_pages, pdf_bytes, [0], use_text_layer, profile)
+            fingerprints = [None]
+            blank_removed = page_count - 1
     except Exception as e:
         print(f"Error al procesar el PDF: {e}")
-        return []  # Devolver lista vacía en caso de error
-        
-    return images
\ No newline at end of file
+        return page_filter.FilteredPages(parts=[], page_count=0)  # Lista vacía en caso de error
+    
+    parts, duplicate_removed = page_filter.remove_duplicates(parts, fingerprints) if filter_pages else (parts, 0)
+    return page_filter.FilteredPages(
+        parts=parts,
+        page_count=page_count,
+        blank_removed=blank_removed,
+        duplicate_removed=duplicate_removed
+    )
+
+async def prepare_image_async(image_bytes: bytes, mime_type: str,
+                              profile: Optional[RenderProfile] = None) -> dict:
+    """
+    Prepara una imagen subida (JPG/PNG) para Gemini. Con el perfil 'standard' se envía
+    tal cual con su tipo MIME real; con otros perfiles se recodifica en el pool de procesos.
+    """
+    profile = profile or get_render_profile()
+    if profile.is_passthrough:
+        return {"mime_type": mime_type, "data": image_bytes}
+    
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(get_render_pool(), reencode_image, image_bytes, profile)
+    return {"mime_type": profile.mime_type, "data": data}
+
+def describe_processing_path(parts: List[Union[str, dict]]) -> str:
+    """
+    Resume cómo se enviaron las páginas: 'text', 'image' o 'mixed'.
+    """
+    text_pages = sum(1 for part in parts if isinstance(part, str))
+    if text_pages == len(parts):
+        return "text"
+    if text_pages == 0:
+        return "image"
+    return "mixed"
@@ -1,15 +1,170 @@
 # database.py
+from typing import Optional
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from config import settings
+from task_results import migrate_inline_payloads
+from near_duplicates import purge_legacy_fingerprints
+
+# Driver asíncrono para cada motor síncrono
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def is_sqlite(database_url: str) -> bool:
+    return make_url(database_url).get_backend_name() == "sqlite"
+
+def to_async_url(database_url: str) -> str:
+    """
+    Traduce la URL síncrona (sqlite:///..., postgresql://...) a su driver asíncrono
+    (aiosqlite, asyncpg). Si la URL ya indica un driver asíncrono se deja igual.
+    """
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if url.get_driver_name() in ("aiosqlite", "asyncpg"):
+        return database_url
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No hay driver asíncrono configurado para {backend}")
+    return url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+def _engine_options(database_url: str) -> dict:
+    """
+    Opciones del pool según el motor. SQLite usa un pool por hilo y no necesita
+    pre-ping; PostgreSQL usa un pool acotado con pre-ping y reciclado de conexiones.
+    """
+    if is_sqlite(database_url):
+        return {"connect_args": {"check_same_thread": False, "timeout": settings.sqlite_busy_timeout_ms / 1000}}
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "pool_recycle": settings.db_pool_recycle_seconds,
+    }
+
+def _configure_sqlite(engine: Engine) -> None:
+    """
+    Aplica los PRAGMA de SQLite en cada conexión nueva: WAL permite que los lectores
+    no esperen a los escritores y busy_timeout hace que un escritor espere al otro
+    en lugar de fallar con 'database is locked'.
+    """
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+        cursor.execute(f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}")
+        if settings.sqlite_journal_mode.upper() == "WAL":
+            # Con WAL, NORMAL es seguro frente a caídas de la aplicación y evita un fsync por commit
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+def build_engine(database_url: str) -> Engine:
+    """Crea el motor síncrono para la URL indicada."""
+    new_engine = create_engine(database_url, echo=False, **_engine_options(database_url))
+    if is_sqlite(database_url):
+        _configure_sqlite(new_engine)
+    return new_engine
+
+def build_async_engine(database_url: str) -> AsyncEngine:
+    """Crea el motor asíncrono (aiosqlite/asyncpg) para la URL síncrona indicada."""
+    async_url = to_async_url(database_url)
+    options = _engine_options(database_url)
+    if is_sqlite(database_url):
+        # aiosqlite ejecuta cada conexión en su propio hilo
+        options["connect_args"].pop("check_same_thread")
+    new_engine = create_async_engine(async_url, echo=False, **options)
+    if is_sqlite(database_url):
+        _configure_sqlite(new_engine.sync_engine)
+    return new_engine
 
 # Crear el motor de base de datos usando la configuración
-engine = create_engine(settings.database_url, echo=False)
+engine = build_engine(settings.database_url)
+
+# El motor asíncrono se crea al primer uso para no exigir el driver si no se usa
+_async_engine: Optional[AsyncEngine] = None
+
+def get_async_engine() -> AsyncEngine:
+    global _async_engine
+    if _async_engine is None:
+        _async_engine = build_async_engine(settings.database_url)
+    return _async_engine
+
+async def dispose_async_engine() -> None:
+    """Cierra las conexiones del motor asíncrono (al apagar la aplicación)."""
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
 
 def create_db_and_tables():
     """Crear las tablas en la base de datos."""
     SQLModel.metadata.create_all(engine)
+    migrate_inline_payloads(engine)
+    add_missing_columns()
+    purge_legacy_fingerprints(engine)
+    create_missing_indexes()
+
+# Columnas nuevas que se rellenan a partir de otra al añadirlas (tabla, columna): origen.
+# status_updated_utc_timestamp ordena el relay de eventos (events.py): sin valor, las
+# filas anteriores no aparecerían en las consultas por fecha de cambio de estado.
+COLUMN_BACKFILLS = {
+    ("apitrackinglog", "status_updated_utc_timestamp"): "request_utc_timestamp",
+}
+
+def add_missing_columns():
+    """
+    Añade a las tablas existentes las columnas nuevas de los modelos.
+
+    `create_all` no modifica tablas ya creadas, así que las bases de datos
+    anteriores necesitan este paso para recibir columnas añadidas después.
+    Las de COLUMN_BACKFILLS se rellenan en la misma transacción.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                if column.default is not None and not callable(column.default.arg):
+                    default = column.default.arg
+                    if isinstance(default, bool):
+                        default = "TRUE" if default else "FALSE"
+                    elif isinstance(default, str):
+                        default = f"'{default}'"
+                    ddl += f" DEFAULT {default}"
+                connection.execute(text(ddl))
+                source = COLUMN_BACKFILLS.get((table.name, column.name))
+                if source is not None:
+                    connection.execute(text(
+                        f"UPDATE {table.name} SET {column.name} = {source} WHERE {column.name} IS NULL"
+                    ))
+                print(f"Columna añadida: {table.name}.{column.name}")
+
+def create_missing_indexes():
+    """
+    Crea los índices declarados en los modelos que aún no existen en tablas anteriores.
+    """
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 def get_session():
     """Obtener una sesión de base de datos."""
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    """
+    Obtener una sesión asíncrona. Los endpoints de consulta la usan para no bloquear
+    el event loop mientras esperan a la base de datos.
+    """
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+        yield session
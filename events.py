@@ -0,0 +1,194 @@
+# events.py
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set
+from config import settings
+
+
+class Subscription:
+    """
+    Suscripción de un cliente a los cambios de estado. Los eventos se acumulan en
+    una cola acotada; si el cliente no la vacía, se descartan los más antiguos.
+    """
+
+    def __init__(self, topics: Set[str]):
+        self.topics = topics
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.event_queue_size)
+        self.dropped = 0
+
+    def push(self, event: dict) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+
+class EventHub:
+    """
+    Distribuidor en proceso de eventos de estado de tareas.
+
+    Las suscripciones se indexan por tema (task:<id>, batch:<id>, user:<id> o all),
+    de modo que publicar un evento solo toca a los suscriptores interesados y una
+    conexión inactiva no cuesta más que su cola vacía.
+    """
+
+    def __init__(self):
+        self._topics: Dict[str, Set[Subscription]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.subscriber_count = 0
+        self.published_count = 0
+        # Retransmisión desde la base de datos (procesos HTTP sin despachador propio)
+        self._relay: Optional[asyncio.Task] = None
+        self._relayed: Dict[tuple, datetime] = {}
+
+    def subscribe(self, task_id: Optional[uuid.UUID] = None, batch_id: Optional[uuid.UUID] = None,
+                  user_identifier: Optional[str] = None) -> Subscription:
+        """
+        Crea una suscripción que recibe los eventos que coinciden con cualquiera de
+        los filtros indicados (sin filtros: todos los eventos).
+        """
+        self._loop = asyncio.get_running_loop()
+        topics = set()
+        if task_id:
+            topics.add(f"task:{task_id}")
+        if batch_id:
+            topics.add(f"batch:{batch_id}")
+        if user_identifier:
+            topics.add(f"user:{user_identifier}")
+        if not topics:
+            topics.add("all")
+
+        subscription = Subscription(topics)
+        for topic in topics:
+            self._topics.setdefault(topic, set()).add(subscription)
+        self.subscriber_count += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.subscriber_count -= 1
+        for topic in subscription.topics:
+            subscribers = self._topics.get(topic)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._topics[topic]
+
+    def publish_status(self, task_id: uuid.UUID, status: str, batch_id: Optional[uuid.UUID] = None,
+                       user_identifier: Optional[str] = None, filename: Optional[str] = None) -> None:
+        """Publica una transición de estado de una tarea."""
+        event = {
+            "task_id": str(task_id),
+            "batch_id": str(batch_id) if batch_id else None,
+            "user_identifier": user_identifier,
+            "filename": filename,
+            "status": status,
+            "timestamp": datetime.utcnow().isoformat(),
+        }
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Llamada desde otro hilo: entregar el evento en el event loop de las suscripciones
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._dispatch, event)
+            return
+        self._dispatch(event)
+
+    def publish_log_entry(self, log_entry) -> None:
+        """Publica el estado actual de una fila de ApiTrackingLog."""
+        self.publish_status(
+            log_entry.task_id,
+            log_entry.status,
+            batch_id=log_entry.batch_id,
+            user_identifier=log_entry.user_identifier,
+            filename=log_entry.filename,
+        )
+
+    def start_relay(self) -> None:
+        """
+        Cuando las tareas se procesan en otros procesos, sus transiciones no pasan por
+        este hub. El relay sondea los cambios de estado recientes en ApiTrackingLog
+        (columna indexada status_updated_utc_timestamp) y los publica aquí.
+        """
+        if self._relay is None:
+            self._relay = asyncio.create_task(self._relay_loop())
+
+    async def stop_relay(self) -> None:
+        if self._relay is not None:
+            self._relay.cancel()
+            try:
+                await self._relay
+            except asyncio.CancelledError:
+                pass
+            self._relay = None
+
+    async def _relay_loop(self) -> None:
+        from sqlmodel import select
+        from sqlmodel.ext.asyncio.session import AsyncSession
+        from database import get_async_engine
+        from models import ApiTrackingLog
+
+        interval = settings.event_poll_interval_seconds
+        # Ventana solapada: un commit puede llegar después de la hora que registra
+        overlap = timedelta(seconds=max(5.0, interval * 5))
+        since = datetime.utcnow()
+        while True:
+            await asyncio.sleep(interval)
+            if not self.subscriber_count:
+                since = datetime.utcnow()
+                self._relayed.clear()
+                continue
+            try:
+                async with AsyncSession(get_async_engine()) as session:
+                    rows = (await session.exec(
+                        select(
+                            ApiTrackingLog.task_id,
+                            ApiTrackingLog.batch_id,
+                            ApiTrackingLog.user_identifier,
+                            ApiTrackingLog.filename,
+                            ApiTrackingLog.status,
+                            ApiTrackingLog.status_updated_utc_timestamp
+                        )
+                        .where(ApiTrackingLog.status_updated_utc_timestamp > since - overlap)
+                        .order_by(ApiTrackingLog.status_updated_utc_timestamp)
+                    )).all()
+            except Exception as e:
+                print(f"ERROR al retransmitir eventos desde la base de datos: {e}")
+                continue
+
+            for row in rows:
+                if (str(row.task_id), row.status) not in self._relayed:
+                    self.publish_status(row.task_id, row.status, batch_id=row.batch_id,
+                                        user_identifier=row.user_identifier, filename=row.filename)
+                since = max(since, row.status_updated_utc_timestamp)
+            horizon = since - overlap
+            self._relayed = {key: seen for key, seen in self._relayed.items() if seen >= horizon}
+
+    def _dispatch(self, event: dict) -> None:
+        if self._relay is not None:
+            # Evita volver a publicar lo que este proceso ya publicó o retransmitió
+            self._relayed[(event["task_id"], event["status"])] = datetime.utcnow()
+        topics = ["all", f"task:{event['task_id']}"]
+        if event["batch_id"]:
+            topics.append(f"batch:{event['batch_id']}")
+        if event["user_identifier"]:
+            topics.append(f"user:{event['user_identifier']}")
+
+        delivered = set()
+        for topic in topics:
+            for subscription in self._topics.get(topic, ()):
+                if subscription not in delivered:
+                    subscription.push(event)
+                    delivered.add(subscription)
+        self.published_count += 1
+
+
+def format_sse(event: dict, event_name: str = "status") -> str:
+    """Serializa un evento en formato Server-Sent Events."""
+    return f"event: {event_name}\ndata: {json.dumps(event)}\n\n"
+
+
+# Instancia global del distribuidor de eventos
+hub = EventHub()
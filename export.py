@@ -0,0 +1,182 @@
+# export.py
+"""
+Exportación de extracciones COMPLETED para la sincronización con el ERP.
+
+Las filas se leen con un cursor de servidor (yield_per) ordenadas por fecha de
+finalización e id, y se escriben a la respuesta por bloques: la memoria no
+depende del tamaño de la exportación. Cada exportación cubre la ventana
+(since, until]; el `until` devuelto en X-Export-Watermark es el `since` de la
+siguiente sincronización incremental.
+"""
+
+import csv
+import io
+import json
+import uuid
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+from sqlmodel import Session, select
+from config import settings
+from database import engine
+from models import ApiTrackingLog, TaskResult
+from task_results import decompress_json
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+# Campos de cabecera de la factura (ver promp.txt) y de cada línea en el CSV
+INVOICE_FIELDS = [
+    "invoice_id", "issuer_name", "issuer_tax_id", "recipient_name", "recipient_tax_id",
+    "issue_date", "due_date", "total_amount", "tax_amount", "currency",
+]
+LINE_ITEM_FIELDS = ["description", "quantity", "unit_price", "total_price"]
+CSV_COLUMNS = (
+    ["task_id", "batch_id", "user_identifier", "filename", "completed_at"]
+    + INVOICE_FIELDS
+    + ["line_number"] + [f"line_{name}" for name in LINE_ITEM_FIELDS]
+    + ["extraction_error"]
+)
+
+# Bytes acumulados antes de entregar un bloque a la respuesta
+FLUSH_BYTES = 64 * 1024
+
+
+def default_watermark() -> datetime:
+    """
+    Límite superior por defecto de la ventana. Se deja un margen para que una tarea
+    que se está confirmando con una fecha anterior no quede fuera de dos exportaciones.
+    """
+    return datetime.utcnow() - timedelta(seconds=settings.export_watermark_lag_seconds)
+
+
+def build_statement(until: datetime, since: Optional[datetime] = None,
+                    user_identifier: Optional[str] = None, batch_id: Optional[uuid.UUID] = None):
+    """Consulta de la ventana (since, until], sobre el índice (status, fecha de finalización, id)."""
+    statement = (
+        select(
+            ApiTrackingLog.task_id,
+            ApiTrackingLog.batch_id,
+            ApiTrackingLog.user_identifier,
+            ApiTrackingLog.filename,
+            ApiTrackingLog.completion_utc_timestamp,
+            TaskResult.result_data
+        )
+        .join(TaskResult, TaskResult.task_id == ApiTrackingLog.task_id)
+        .where(
+            ApiTrackingLog.status == "COMPLETED",
+            ApiTrackingLog.completion_utc_timestamp <= until
+        )
+    )
+    if since:
+        statement = statement.where(ApiTrackingLog.completion_utc_timestamp > since)
+    if user_identifier:
+        statement = statement.where(ApiTrackingLog.user_identifier == user_identifier)
+    if batch_id:
+        statement = statement.where(ApiTrackingLog.batch_id == batch_id)
+    return statement.order_by(
+        ApiTrackingLog.completion_utc_timestamp, ApiTrackingLog.id
+    ).execution_options(yield_per=settings.export_fetch_size)
+
+
+def _iter_rows(statement) -> Iterator:
+    with Session(engine) as session:
+        for row in session.exec(statement):
+            yield row
+
+
+def _ndjson_line(row) -> str:
+    """
+    Una línea por tarea. El JSON almacenado se incrusta tal cual, sin json.loads ni
+    json.dumps: los saltos de línea de un JSON válido solo pueden ser espacios entre
+    tokens (dentro de las cadenas van escapados), así que basta con sustituirlos.
+    """
+    metadata = json.dumps({
+        "task_id": str(row.task_id),
+        "batch_id": str(row.batch_id) if row.batch_id else None,
+        "user_identifier": row.user_identifier,
+        "filename": row.filename,
+        "completed_at": row.completion_utc_timestamp.isoformat(),
+    }, ensure_ascii=False)
+    json_text = (decompress_json(row.result_data) or "").strip()
+    if json_text.startswith(("{", "[")):
+        data = json_text.replace("\r", " ").replace("\n", " ")
+    else:
+        data = json.dumps(json_text or None, ensure_ascii=False)
+    return f'{metadata[:-1]}, "data": {data}}}\n'
+
+
+def _csv_rows(row) -> Iterator[list]:
+    """Filas CSV de una tarea: una por línea de factura (una sola si no tiene líneas)."""
+    base = [
+        str(row.task_id),
+        str(row.batch_id) if row.batch_id else "",
+        row.user_identifier,
+        row.filename or "",
+        row.completion_utc_timestamp.isoformat(),
+    ]
+    try:
+        document = json.loads(decompress_json(row.result_data) or "null")
+    except json.JSONDecodeError:
+        document = None
+    if not isinstance(document, dict):
+        yield base + [""] * (len(INVOICE_FIELDS) + 1 + len(LINE_ITEM_FIELDS)) + ["Resultado no es un objeto JSON"]
+        return
+
+    header = [_csv_value(document.get(name)) for name in INVOICE_FIELDS]
+    error = _csv_value(document.get("error"))
+    line_items = document.get("line_items") or []
+    if not isinstance(line_items, list) or not line_items:
+        yield base + header + [""] * (1 + len(LINE_ITEM_FIELDS)) + [error]
+        return
+    for number, item in enumerate(line_items, start=1):
+        item = item if isinstance(item, dict) else {}
+        yield base + header + [number] + [_csv_value(item.get(name)) for name in LINE_ITEM_FIELDS] + [error]
+
+
+def _csv_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def stream_ndjson(statement) -> Iterator[str]:
+    buffer = []
+    buffered = 0
+    for row in _iter_rows(statement):
+        line = _ndjson_line(row)
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= FLUSH_BYTES:
+            yield "".join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def stream_csv(statement) -> Iterator[str]:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(CSV_COLUMNS)
+    for row in _iter_rows(statement):
+        for csv_row in _csv_rows(row):
+            writer.writerow(csv_row)
+        if output.tell() >= FLUSH_BYTES:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+    if output.tell():
+        yield output.getvalue()
+
+
+def stream_export(export_format: str, statement) -> Iterator[str]:
+    """
+    Generador síncrono: StreamingResponse lo recorre en el pool de hilos, de modo
+    que el cursor de la base de datos no bloquea el event loop.
+    """
+    if export_format == "csv":
+        return stream_csv(statement)
+    return stream_ndjson(statement)
@@ -0,0 +1,47 @@
+# file_storage.py
+import os
+import shutil
+import uuid
+from typing import BinaryIO, Optional
+from config import settings
+
+
+def upload_path(task_id: uuid.UUID, filename: str) -> str:
+    """
+    Ruta en UPLOAD_DIR del archivo original de una tarea (crea el directorio si falta).
+    """
+    os.makedirs(settings.upload_dir, exist_ok=True)
+    extension = os.path.splitext(filename or "")[1].lower()
+    return os.path.join(settings.upload_dir, f"{task_id.hex}{extension}")
+
+
+def save_upload(task_id: uuid.UUID, filename: str, source: BinaryIO) -> str:
+    """
+    Copia por bloques el archivo original de una tarea a disco y devuelve su ruta.
+    El archivo se conserva hasta que la tarea llega a un estado final.
+    """
+    path = upload_path(task_id, filename)
+    source.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(source, f)
+    return path
+
+
+def read_upload(path: str) -> bytes:
+    """
+    Lee el archivo original de una tarea.
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def delete_upload(path: Optional[str]) -> None:
+    """
+    Elimina el archivo original de una tarea (si existe).
+    """
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,53 +1,230 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Union
 import google.generativeai as genai
+from google.generativeai import caching
 from google.generativeai.types import GenerationConfig
-from typing import List
-import os
 from config import settings
+from gemini_scheduler import scheduler
 
 # Configurar la API key desde configuración
 genai.configure(api_key=settings.gemini_api_key)
 
-async def get_invoice_data_from_gemini(prompt: str, images: List[bytes]) -> dict:
+PROMPT_PATH = "promp.txt"
+
+# Aviso que acompaña a las páginas enviadas como texto en lugar de imagen
+TEXT_LAYER_NOTE = (
+    "Algunas páginas se proporcionan como texto extraído directamente del PDF en lugar de imagen. "
+    "Cada bloque va precedido de su posición [x,y] en la página; úsala para reconstruir tablas y "
+    "asociar etiquetas con sus valores."
+)
+
+# Margen antes de la expiración con el que se renueva la caché de contexto
+CONTEXT_CACHE_RENEW_MARGIN = timedelta(minutes=5)
+
+def load_prompt() -> str:
     """
-    Envía el prompt y las imágenes de la factura a Gemini y devuelve el JSON extraído.
+    Devuelve el prompt de extracción (en memoria; se recarga si cambia el archivo).
     """
-    try:
-        # Seleccionar el modelo. 'gemini-1.5-flash' es rápido y rentable para esta tarea.
-        model = genai.GenerativeModel('gemini-1.5-flash')
-
-        # Configurar la generación para que devuelva JSON
-        generation_config = GenerationConfig(response_mime_type="application/json")
-        
-        # Construir el contenido multimodal: primero el texto del prompt, luego las imágenes
-        content_parts = [prompt]
-        for img_bytes in images:
-            content_parts.append({
-                "mime_type": "image/png",
-                "data": img_bytes
-            })
-
-        # Realizar la llamada a la API
-        response = await model.generate_content_async(
-            content_parts,
-            generation_config=generation_config
-        )
-        
-        # El response.text contendrá la cadena JSON. La deserialización se hará fuera.
-        # También se puede acceder al conteo de tokens para el logging
-        prompt_tokens = response.usage_metadata.prompt_token_count
-        completion_tokens = response.usage_metadata.candidates_token_count
-        total_tokens = response.usage_metadata.total_token_count
-        
-        # Devolver el texto JSON y la información de uso
-        return {
-            "json_text": response.text,
-            "usage": {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens
+    return extraction_client.get_prompt()
+
+def _read_prompt_file(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+class ExtractionClient:
+    """
+    Cliente de extracción con Gemini creado una sola vez al arrancar.
+
+    Mantiene el modelo y la configuración de generación, guarda el prompt en memoria
+    (recargándolo cuando cambia la fecha de modificación de promp.txt) y, si
+    GEMINI_CONTEXT_CACHE está activo, sube el prompt una vez como caché de contexto
+    del proveedor para no volver a enviar (ni pagar a precio completo) sus tokens en
+    cada llamada.
+    """
+
+    def __init__(self, model_name: str, prompt_path: str = PROMPT_PATH):
+        self.model_name = model_name
+        self.prompt_path = prompt_path
+        self.generation_config = GenerationConfig(response_mime_type="application/json")
+        self.model = genai.GenerativeModel(model_name)
+
+        self._prompt: Optional[str] = None
+        self._prompt_mtime: Optional[float] = None
+        self.prompt_sha256: Optional[str] = None
+        self.prompt_loaded_at: Optional[datetime] = None
+
+        self._context_cache: Optional[caching.CachedContent] = None
+        self._context_model: Optional[genai.GenerativeModel] = None
+        self._context_prompt_sha256: Optional[str] = None
+        self._context_lock: Optional[asyncio.Lock] = None
+        self._context_cache_failed_for: Optional[str] = None
+
+        self.calls = 0
+        self.cached_prompt_tokens = 0
+
+    def get_prompt(self) -> str:
+        """
+        Devuelve el prompt en memoria. Solo se vuelve a leer el archivo si su fecha de
+        modificación ha cambiado (un os.stat por llamada).
+        """
+        mtime = os.stat(self.prompt_path).st_mtime
+        if self._prompt is None or mtime != self._prompt_mtime:
+            self._prompt = _read_prompt_file(self.prompt_path)
+            self._prompt_mtime = mtime
+            self.prompt_sha256 = hashlib.sha256(self._prompt.encode("utf-8")).hexdigest()
+            self.prompt_loaded_at = datetime.utcnow()
+            print(f"Prompt cargado desde {self.prompt_path} ({len(self._prompt)} caracteres)")
+        return self._prompt
+
+    async def start(self) -> None:
+        """Carga el prompt y, si está activa, crea la caché de contexto."""
+        self.get_prompt()
+        if settings.gemini_context_cache and settings.gemini_api_key:
+            await self._get_context_model(self._prompt)
+
+    async def close(self) -> None:
+        """Elimina la caché de contexto del proveedor (deja de facturarse su almacenamiento)."""
+        if self._context_cache is not None:
+            cache = self._context_cache
+            self._context_cache = None
+            self._context_model = None
+            try:
+                await asyncio.to_thread(cache.delete)
+            except Exception as e:
+                print(f"No se pudo eliminar la caché de contexto: {e}")
+
+    async def generate(self, prompt: str, images: List[Union[bytes, str, dict]],
+                       instructions: Optional[str] = None) -> dict:
+        """
+        Envía el prompt y las páginas de la factura a Gemini y devuelve el JSON extraído.
+
+        Cada página puede ser una imagen PNG en bytes, el texto extraído de un PDF
+        o un dict {"mime_type", "data"} con la imagen ya preparada. `instructions` se
+        añade tras el prompt (p. ej. qué páginas de la factura se envían) sin alterar
+        el prompt cacheado.
+        """
+        try:
+            # Con caché de contexto, el prompt ya está en el proveedor y no se reenvía
+            model = None
+            if settings.gemini_context_cache:
+                model = await self._get_context_model(prompt)
+            content_parts = [] if model else [prompt]
+            model = model or self.model
+
+            if instructions:
+                content_parts.append(instructions)
+            if any(isinstance(page, str) for page in images):
+                content_parts.append(TEXT_LAYER_NOTE)
+            for page in images:
+                if isinstance(page, bytes):
+                    content_parts.append({
+                        "mime_type": "image/png",
+                        "data": page
+                    })
+                else:
+                    content_parts.append(page)
+
+            # El planificador espera a tener cuota y reintenta los errores transitorios (429, 503...)
+            estimated_tokens = scheduler.estimate_tokens(prompt + (instructions or ""), images)
+            response = await scheduler.run(
+                lambda: model.generate_content_async(content_parts, generation_config=self.generation_config),
+                estimated_tokens
+            )
+
+            usage = response.usage_metadata
+            scheduler.record_usage(estimated_tokens, usage.total_token_count)
+            self.calls += 1
+            self.cached_prompt_tokens += getattr(usage, "cached_content_token_count", 0) or 0
+
+            # El response.text contendrá la cadena JSON. La deserialización se hará fuera.
+            return {
+                "json_text": response.text,
+                "usage": {
+                    "prompt_tokens": usage.prompt_token_count,
+                    "completion_tokens": usage.candidates_token_count,
+                    "total_tokens": usage.total_token_count
+                }
             }
+
+        except Exception as e:
+            print(f"Error al llamar a la API de Gemini: {e}")
+            return {"error": str(e)}
+
+    def get_stats(self) -> dict:
+        return {
+            "model": self.model_name,
+            "prompt_sha256": self.prompt_sha256,
+            "prompt_loaded_at": self.prompt_loaded_at.isoformat() if self.prompt_loaded_at else None,
+            "context_cache_enabled": settings.gemini_context_cache,
+            "context_cache": self._context_cache.name if self._context_cache else None,
+            "context_cache_expires_at": self._context_cache.expire_time.isoformat() if self._context_cache else None,
+            "calls_since_start": self.calls,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
         }
 
-    except Exception as e:
-        print(f"Error al llamar a la API de Gemini: {e}")
-        return {"error": str(e)}
\ No newline at end of file
+    async def _get_context_model(self, prompt: str) -> Optional[genai.GenerativeModel]:
+        """
+        Devuelve un modelo ligado a la caché de contexto del prompt indicado, creándola o
+        renovándola si hace falta. Devuelve None si no se puede usar (el proveedor exige
+        un mínimo de tokens y versiones concretas del modelo): se envía el prompt completo.
+        """
+        prompt_sha256 = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        if self._context_cache_failed_for == prompt_sha256:
+            return None
+
+        if self._context_lock is None:
+            self._context_lock = asyncio.Lock()
+        async with self._context_lock:
+            if self._context_cache is not None and self._context_prompt_sha256 == prompt_sha256:
+                expires_at = self._context_cache.expire_time
+                if expires_at - datetime.now(timezone.utc) > CONTEXT_CACHE_RENEW_MARGIN:
+                    return self._context_model
+                try:
+                    await asyncio.to_thread(self._context_cache.update, ttl=self._context_ttl())
+                    return self._context_model
+                except Exception as e:
+                    print(f"No se pudo renovar la caché de contexto, se creará otra: {e}")
+
+            # Prompt nuevo (o recargado): sustituir la caché anterior
+            await self.close()
+            try:
+                cache = await asyncio.to_thread(
+                    caching.CachedContent.create,
+                    model=self.model_name,
+                    display_name=f"invoice-prompt-{prompt_sha256[:12]}",
+                    contents=[prompt],
+                    ttl=self._context_ttl(),
+                )
+            except Exception as e:
+                print(f"Caché de contexto no disponible, se enviará el prompt completo: {e}")
+                self._context_cache_failed_for = prompt_sha256
+                return None
+
+            self._context_cache = cache
+            self._context_model = genai.GenerativeModel.from_cached_content(
+                cached_content=cache,
+                generation_config=self.generation_config
+            )
+            self._context_prompt_sha256 = prompt_sha256
+            self._context_cache_failed_for = None
+            print(f"Caché de contexto creada: {cache.name}")
+            return self._context_model
+
+    @staticmethod
+    def _context_ttl() -> timedelta:
+        return timedelta(minutes=settings.gemini_context_cache_ttl_minutes)
+
+
+# Instancia global del cliente de extracción
+extraction_client = ExtractionClient(settings.gemini_model)
+
+async def get_invoice_data_from_gemini(prompt: str, images: List[Union[bytes, str, dict]],
+                                       instructions: Optional[str] = None) -> dict:
+    """
+    Envía el prompt y las páginas de la factura a Gemini con el cliente compartido.
+    """
+    return await extraction_client.generate(prompt, images, instructions)
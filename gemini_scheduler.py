@@ -0,0 +1,197 @@
+# gemini_scheduler.py
+"""
+Planificador de llamadas a Gemini.
+
+Antes de cada llamada reserva una petición en el cubo de RPM y una estimación de
+tokens en el cubo de TPM, de modo que el servicio trabaje al límite de la cuota en
+lugar de provocar errores 429. Los errores transitorios (429, cuota agotada, 500,
+503, timeouts) se reintentan con backoff exponencial con jitter, respetando el
+Retry-After que indique el proveedor.
+"""
+
+import asyncio
+import random
+import re
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Union
+from google.api_core import exceptions as google_exceptions
+from config import settings
+
+# Gemini 1.5 factura cada imagen como un número fijo de tokens
+ESTIMATED_TOKENS_PER_IMAGE = 258
+
+# Errores del proveedor que merece la pena reintentar
+TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,  # 429, incluye ResourceExhausted (cuota)
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+_RETRY_DELAY_PATTERN = re.compile(r"retry(?:_delay| in)[^0-9]*([0-9]+(?:\.[0-9]+)?)\s*s", re.IGNORECASE)
+
+
+class TokenBucket:
+    """
+    Cubo de tokens que se rellena de forma continua a `rate_per_minute` por minuto.
+    Las reservas se atienden en orden de llegada.
+    """
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.rate_per_second = self.capacity / 60
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    async def acquire(self, amount: float) -> float:
+        """Reserva `amount` tokens esperando si hace falta. Devuelve los segundos esperados."""
+        # Una petición mayor que el cubo entero se limita a su capacidad para no bloquearse
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate_per_second
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def adjust(self, delta: float) -> None:
+        """
+        Corrige una reserva con el consumo real: delta > 0 descuenta más tokens (el cubo
+        puede quedar en negativo y las siguientes reservas esperan), delta < 0 los devuelve.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class GeminiScheduler:
+    """
+    Reparte las llamadas a Gemini dentro de los límites de RPM y TPM del proyecto.
+    Un límite a 0 desactiva el cubo correspondiente.
+    """
+
+    def __init__(self, rpm_limit: int, tpm_limit: int):
+        self.requests_bucket = TokenBucket(rpm_limit) if rpm_limit > 0 else None
+        self.tokens_bucket = TokenBucket(tpm_limit) if tpm_limit > 0 else None
+        self._paused_until = 0.0
+
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled_seconds = 0.0
+
+    @staticmethod
+    def estimate_tokens(prompt: str, pages: List[Union[bytes, str, dict]]) -> int:
+        """
+        Estima los tokens de una llamada antes de enviarla: ~4 caracteres por token de
+        texto, un coste fijo por imagen y la respuesta esperada.
+        """
+        tokens = len(prompt) // 4 + settings.gemini_estimated_output_tokens
+        for page in pages:
+            if isinstance(page, str):
+                tokens += len(page) // 4
+            else:
+                tokens += ESTIMATED_TOKENS_PER_IMAGE
+        return tokens
+
+    async def run(self, call: Callable[[], Awaitable[Any]], estimated_tokens: int) -> Any:
+        """
+        Ejecuta `call` cuando haya presupuesto, reintentando los errores transitorios.
+        Relanza el error si no es transitorio o si se agotan los reintentos.
+        """
+        attempt = 0
+        while True:
+            await self._wait_for_budget(estimated_tokens)
+            try:
+                self.calls += 1
+                return await call()
+            except TRANSIENT_ERRORS as e:
+                if attempt >= settings.gemini_max_retries:
+                    raise
+                retry_after = get_retry_after(e)
+                if isinstance(e, google_exceptions.TooManyRequests):
+                    self.rate_limited += 1
+                    if retry_after:
+                        # La cuota es del proyecto: todas las llamadas esperan, no solo esta
+                        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                delay = retry_after or backoff_delay(attempt)
+                attempt += 1
+                self.retries += 1
+                print(f"Gemini: error transitorio ({type(e).__name__}), reintento {attempt} "
+                      f"de {settings.gemini_max_retries} en {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """Ajusta el cubo de TPM con los tokens realmente consumidos."""
+        if self.tokens_bucket and actual_tokens is not None:
+            self.tokens_bucket.adjust(actual_tokens - estimated_tokens)
+
+    def get_stats(self) -> dict:
+        return {
+            "rpm_limit": int(self.requests_bucket.capacity) if self.requests_bucket else None,
+            "tpm_limit": int(self.tokens_bucket.capacity) if self.tokens_bucket else None,
+            "tokens_available": int(self.tokens_bucket.tokens) if self.tokens_bucket else None,
+            "calls": self.calls,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+        }
+
+    async def _wait_for_budget(self, estimated_tokens: int) -> None:
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+            self.throttled_seconds += pause
+        if self.requests_bucket:
+            self.throttled_seconds += await self.requests_bucket.acquire(1)
+        if self.tokens_bucket:
+            self.throttled_seconds += await self.tokens_bucket.acquire(estimated_tokens)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Backoff exponencial con jitter completo: aleatorio entre 0 y base * 2^intento (con tope)."""
+    ceiling = min(settings.gemini_backoff_max_seconds, settings.gemini_backoff_base_seconds * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Segundos de espera indicados por el proveedor: cabecera Retry-After de la respuesta
+    HTTP, RetryInfo de los detalles del error o 'retry in Ns' en el mensaje.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if value:
+        try:
+            return min(float(value), settings.gemini_backoff_max_seconds)
+        except ValueError:
+            pass
+
+    for detail in getattr(error, "details", None) or ():
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            seconds = getattr(retry_delay, "seconds", 0) + getattr(retry_delay, "nanos", 0) / 1e9
+            if seconds > 0:
+                return min(seconds, settings.gemini_backoff_max_seconds)
+
+    match = _RETRY_DELAY_PATTERN.search(str(error))
+    if match:
+        return min(float(match.group(1)), settings.gemini_backoff_max_seconds)
+    return None
+
+
+# Instancia global del planificador (los límites son por proceso)
+scheduler = GeminiScheduler(settings.gemini_rpm_limit, settings.gemini_tpm_limit)
@@ -0,0 +1,63 @@
+# json_response.py
+"""
+Respuestas JSON con orjson y paso directo de JSON ya codificado.
+
+Los resultados de las extracciones se guardan normalizados (JSON compacto, ver
+task_results.normalize_json). Para servirlos no hace falta json.loads ni volver a
+codificarlos: raw_json los envuelve en un orjson.Fragment, que orjson copia tal
+cual en la respuesta.
+
+orjson es opcional: sin él se usa el módulo json y los fragmentos se decodifican.
+orjson no admite enteros de más de 64 bits; para esos documentos dumps recurre
+también al módulo json.
+"""
+
+import json
+import uuid
+from datetime import date, datetime
+from typing import Any
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende del entorno
+    orjson = None
+
+# orjson.Fragment existe desde orjson 3.9
+HAS_FRAGMENT = orjson is not None and hasattr(orjson, "Fragment")
+
+
+def raw_json(data: bytes) -> Any:
+    """Envuelve JSON ya codificado para incluirlo sin modificar en una FastJSONResponse."""
+    if HAS_FRAGMENT:
+        return orjson.Fragment(data)
+    return json.loads(data)
+
+
+def dumps(content: Any) -> bytes:
+    """Codifica a JSON compacto (UTF-8). Admite UUID y datetime como el codificador de FastAPI."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # Enteros de más de 64 bits (p. ej. un número de cuenta leído como número)
+            pass
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Respuesta JSON codificada con orjson. El endpoint debe devolverla directamente
+    (no un dict) para que FastAPI no pase el contenido por jsonable_encoder.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -1,19 +1,36 @@
 # main.py
-import json
+import base64
 import uuid
 from datetime import datetime
-from typing import List
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, BackgroundTasks, status, Form
-from fastapi.responses import HTMLResponse
+from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, status, Form
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.requests import Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlmodel import Session, select
-from database import create_db_and_tables, get_session
-from models import ApiTrackingLog
-from background_processor import process_invoice_task
-from validators import FileValidator
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import create_db_and_tables, get_session, get_async_session, get_async_engine, dispose_async_engine, engine
+from models import ApiTrackingLog, InvoiceBatch, StatsCounter, TaskResult
+from task_queue import dispatcher
+from admission import admission, AdmissionRejected
+from file_storage import save_upload
+from convert_toimage import shutdown_render_pool
+from render_profiles import get_render_profile, RENDER_PROFILES
+from gedata import load_prompt, extraction_client
+from gemini_scheduler import scheduler as gemini_scheduler
+import bulk_ingest
+import export
+import result_cache
+import stats
+import supplier_templates
+import task_results
+import asyncio
+from events import hub, format_sse
+from validators import FileValidator, MAX_FILES_PER_BATCH, max_request_bytes
+from json_response import FastJSONResponse
+from status_cache import status_cache
 from config import settings
 from datetime import datetime
 
@@ -41,16 +58,96 @@ try:
 except:
     pass  # Directorio static no existe aún
 
+def _overloaded_response(rejection: AdmissionRejected) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": rejection.reason},
+        headers={"Retry-After": str(rejection.retry_after)}
+    )
+
+# Control de admisión de subidas: se decide antes de leer el cuerpo de la petición
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    if request.method != "POST" or request.url.path not in ("/api/v1/invoices/extract", "/api/v1/invoices/extract-archive"):
+        return await call_next(request)
+    
+    # Cuerpos que declaran más de lo admisible se rechazan antes de que Starlette los reciba
+    if request.url.path == "/api/v1/invoices/extract-archive":
+        max_body = max_request_bytes(1, settings.bulk_max_archive_mb)
+    else:
+        max_body = max_request_bytes(MAX_FILES_PER_BATCH, settings.max_file_size_mb)
+    try:
+        declared_size = int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        declared_size = None
+    if declared_size is not None and declared_size > max_body:
+        return JSONResponse(
+            status_code=413, # Content Too Large
+            content={"detail": f"La petición supera el tamaño máximo admitido ({max_body // (1024 * 1024)}MB)"}
+        )
+    
+    # Las tareas en vuelo se leen una sola vez por petición; el endpoint repite la
+    # comprobación con el número real de archivos usando request.state.tasks_in_flight
+    async with AsyncSession(get_async_engine()) as session:
+        request.state.tasks_in_flight = await admission.in_flight_tasks(session)
+    
+    if request.url.path == "/api/v1/invoices/extract-archive":
+        # El archivo se recibe en disco y se lee por bloques: solo cuenta el presupuesto de tareas
+        try:
+            admission.check_tasks(request.state.tasks_in_flight)
+        except AdmissionRejected as rejection:
+            return _overloaded_response(rejection)
+        return await call_next(request)
+    
+    # Sin Content-Length (envío por bloques) se reserva el tamaño máximo de un archivo
+    upload_size = declared_size if declared_size is not None else settings.max_file_size_mb * 1024 * 1024
+    
+    try:
+        admission.check_tasks(request.state.tasks_in_flight)
+        admission.reserve_upload(upload_size)
+    except AdmissionRejected as rejection:
+        return _overloaded_response(rejection)
+    
+    try:
+        return await call_next(request)
+    finally:
+        admission.release_upload(upload_size)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, rejection: AdmissionRejected):
+    return _overloaded_response(rejection)
+
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def on_startup():
+    # En producción las migraciones ya las aplicó run_server.py antes de lanzar los workers
+    if settings.db_migrate_on_startup:
+        create_db_and_tables()
+    with Session(engine) as session:
+        stats.ensure_initialized(session)
+    if settings.embedded_dispatcher:
+        await extraction_client.start()
+        # Las consultas de /status llegan a este mismo proceso: se precarga su caché
+        await dispatcher.start(warm_status_cache=True)
+    else:
+        # Las tareas las procesan los workers de cola (worker.py); sus transiciones
+        # se leen de la base de datos para los clientes de /api/v1/events
+        hub.start_relay()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await dispatcher.stop()
+    await hub.stop_relay()
+    await extraction_client.close()
+    shutdown_render_pool()
+    await dispose_async_engine()
 
 # Endpoint para iniciar la extracción (múltiples archivos)
 @app.post("/api/v1/invoices/extract", status_code=status.HTTP_202_ACCEPTED)
 async def extract_invoice_data(
-    background_tasks: BackgroundTasks,
+    request: Request,
     files: List[UploadFile] = File(...),
     user_identifier: str = Form(default="default_user"),
+    render_profile: Optional[str] = Form(default=None),
     session: Session = Depends(get_session)
 ):
     """
@@ -58,48 +155,212 @@ async def extract_invoice_data(
     
     - **files**: Lista de archivos (PDF, JPG, PNG) a procesar
     - **user_identifier**: Identificador del usuario que hace la solicitud
+    - **render_profile**: Perfil de renderizado opcional (standard, compact, grayscale, economy, custom)
     
     Returns:
+        - **batch_id**: Identificador del lote (consultable en /api/v1/batches/{batch_id})
         - **task_ids**: Lista de identificadores de tareas para seguimiento
         - **message**: Mensaje de confirmación
     """
-    # Validar archivos
+    if render_profile:
+        try:
+            get_render_profile(render_profile)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    # Validar archivos (el contenido queda en archivos temporales, no en memoria)
     validated_files = await FileValidator.validate_files(files)
     
+    # El lote completo debe caber en el presupuesto de tareas en vuelo
+    try:
+        admission.check_tasks(request.state.tasks_in_flight, len(validated_files))
+    except AdmissionRejected:
+        for validated in validated_files:
+            validated.close()
+        raise
+    
     task_ids = []
+    cached_count = 0
+    prompt = load_prompt()
     
-    for filename, content in validated_files:
-        # Crear la entrada de registro inicial en la BD
-        log_entry = ApiTrackingLog(
-            user_identifier=user_identifier,
-            status="PENDING",
-            filename=filename
-        )
-        session.add(log_entry)
-        session.commit()
-        session.refresh(log_entry)
-        
-        # Añadir la tarea de procesamiento al fondo
-        background_tasks.add_task(
-            process_invoice_task,
-            log_entry.task_id,
-            content,
-            user_identifier,
-            filename
-        )
-        
-        task_ids.append(log_entry.task_id)
+    batch = InvoiceBatch(user_identifier=user_identifier, total_files=len(validated_files))
+    session.add(batch)
+    
+    try:
+        for validated in validated_files:
+            filename = validated.filename
+            cache_key = result_cache.build_cache_key(validated.sha256, prompt, settings.gemini_model)
+            cached = result_cache.lookup(session, cache_key)
+            
+            if cached:
+                # Resultado ya conocido: la tarea se completa sin llamar a Gemini
+                log_entry = ApiTrackingLog(
+                    batch_id=batch.batch_id,
+                    user_identifier=user_identifier,
+                    status="COMPLETED",
+                    filename=filename
+                )
+                result_cache.apply_cached_result(session, log_entry, cached)
+                session.add(log_entry)
+                stats.record_new_task(session, log_entry)
+                session.commit()
+                session.refresh(log_entry)
+                hub.publish_log_entry(log_entry)
+                task_ids.append(log_entry.task_id)
+                cached_count += 1
+                continue
+            
+            # Crear la entrada de registro inicial en la BD. El archivo se guarda en disco
+            # para que la tarea sobreviva a un reinicio hasta que el despachador la reclame.
+            log_entry = ApiTrackingLog(
+                batch_id=batch.batch_id,
+                user_identifier=user_identifier,
+                status="PENDING",
+                filename=filename,
+                render_profile=render_profile
+            )
+            log_entry.stored_path = save_upload(log_entry.task_id, filename, validated.file)
+            session.add(log_entry)
+            stats.record_new_task(session, log_entry)
+            session.commit()
+            session.refresh(log_entry)
+            hub.publish_log_entry(log_entry)
+            
+            task_ids.append(log_entry.task_id)
+    finally:
+        for validated in validated_files:
+            validated.close()
+    
+    # Despertar al despachador para que reclame las tareas nuevas
+    dispatcher.notify()
     
     # Devolver los task_ids para que el cliente pueda consultar el estado
     return {
+        "batch_id": batch.batch_id,
         "task_ids": task_ids,
         "message": f"Lote de {len(validated_files)} facturas enviado a procesar.",
-        "total_files": len(validated_files)
+        "total_files": len(validated_files),
+        "cached_files": cached_count
     }
 
+# Endpoint de ingesta masiva (un ZIP o TAR con muchas facturas)
+@app.post("/api/v1/invoices/extract-archive", status_code=status.HTTP_202_ACCEPTED)
+async def extract_invoice_archive(
+    request: Request,
+    archive: UploadFile = File(...),
+    user_identifier: str = Form(default="default_user"),
+    render_profile: Optional[str] = Form(default=None),
+    session: Session = Depends(get_session)
+):
+    """
+    Procesa un archivo ZIP o TAR (también .tar.gz) con hasta BULK_MAX_FILES facturas.
+    
+    - **archive**: Archivo ZIP/TAR con PDF, JPG o PNG
+    - **user_identifier**: Identificador del usuario que hace la solicitud
+    - **render_profile**: Perfil de renderizado opcional
+    
+    Los miembros se validan uno a uno sin cargar el archivo en memoria; los inválidos
+    se devuelven en **rejected** sin impedir que se procese el resto. Todas las tareas
+    del lote se crean con un único commit.
+    
+    Returns:
+        - **batch_id**: Identificador del lote (consultable en /api/v1/batches/{batch_id})
+        - **task_ids**: Lista de identificadores de tareas
+        - **rejected**: Archivos del ZIP/TAR descartados y el motivo
+    """
+    if render_profile:
+        try:
+            get_render_profile(render_profile)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    if archive.size is not None and archive.size > settings.bulk_max_archive_mb * 1024 * 1024:
+        raise HTTPException(
+            status_code=413, # Content Too Large
+            detail=f"El archivo excede el tamaño máximo de {settings.bulk_max_archive_mb}MB"
+        )
+    
+    try:
+        staged = await asyncio.to_thread(bulk_ingest.stage_archive, archive.file)
+    except bulk_ingest.ArchiveError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    finally:
+        await archive.close()
+    
+    if not staged.files:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"message": "El archivo no contiene facturas válidas", "rejected": staged.rejected}
+        )
+    
+    try:
+        admission.check_tasks(request.state.tasks_in_flight, len(staged.files))
+        batch = InvoiceBatch(user_identifier=user_identifier, total_files=len(staged.files))
+        batch_id = batch.batch_id
+        session.add(batch)
+        created, cached_count = bulk_ingest.create_tasks(
+            session, batch, staged, user_identifier, render_profile
+        )
+    except BaseException:
+        session.rollback()
+        staged.discard()
+        raise
+    
+    for task in created:
+        hub.publish_status(task["task_id"], task["status"], batch_id=batch_id,
+                           user_identifier=user_identifier, filename=task["filename"])
+    dispatcher.notify()
+    
+    return {
+        "batch_id": batch_id,
+        "task_ids": [task["task_id"] for task in created],
+        "message": f"Lote de {len(created)} facturas enviado a procesar.",
+        "total_files": len(created),
+        "cached_files": cached_count,
+        "rejected": staged.rejected
+    }
+
+# Endpoint de exportación de extracciones (sincronización con el ERP)
+@app.get("/api/v1/invoices/export")
+async def export_extractions(
+    format: str = "ndjson",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    user_identifier: Optional[str] = None,
+    batch_id: Optional[uuid.UUID] = None
+):
+    """
+    Exporta en streaming las extracciones COMPLETED terminadas en la ventana (since, until].
+    
+    - **format**: ndjson (una tarea por línea) o csv (una fila por línea de factura)
+    - **since**: Marca de la sincronización anterior (UTC, ISO 8601); sin ella, desde el principio
+    - **until**: Límite superior (por defecto, ahora menos EXPORT_WATERMARK_LAG_SECONDS)
+    - **user_identifier**, **batch_id**: Filtros opcionales
+    
+    La cabecera X-Export-Watermark contiene el `until` usado: pasado como `since` en la
+    siguiente llamada, se obtienen solo las extracciones nuevas.
+    """
+    if format not in export.EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Formato no válido: {format}. Formatos disponibles: {list(export.EXPORT_FORMATS)}"
+        )
+    
+    watermark = until or export.default_watermark()
+    statement = export.build_statement(watermark, since, user_identifier, batch_id)
+    headers = {"X-Export-Watermark": watermark.isoformat()}
+    if format == "csv":
+        headers["Content-Disposition"] = f'attachment; filename="extracciones-{watermark:%Y%m%dT%H%M%S}.csv"'
+    
+    return StreamingResponse(
+        export.stream_export(format, statement),
+        media_type=export.EXPORT_FORMATS[format],
+        headers=headers
+    )
+
 # Endpoint para consultar el estado de la tarea
 @app.get("/api/v1/invoices/status/{task_id}")
-async def get_task_status(task_id: uuid.UUID, session: Session = Depends(get_session)):
+async def get_task_status(task_id: uuid.UUID, request: Request, session: AsyncSession = Depends(get_async_session)):
     """
     Consulta el estado de una tarea específica.
     
@@ -110,43 +371,50 @@ async def get_task_status(task_id: uuid.UUID, session: Session = Depends(get_ses
         - **status**: Estado actual de la tarea
         - **data**: Datos extraídos (solo si está completada)
         - **error**: Mensaje de error (solo si falló)
-    """
-    # Buscar por task_id en lugar de id
-    statement = select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)
-    log_entry = session.exec(statement).first()
     
-    if not log_entry:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
-        
-    response = {
-        "task_id": log_entry.task_id,
-        "status": log_entry.status,
-        "filename": log_entry.filename,
-        "user_identifier": log_entry.user_identifier,
-        "created_at": log_entry.request_utc_timestamp.isoformat(),
-        "completed_at": log_entry.completion_utc_timestamp.isoformat() if log_entry.completion_utc_timestamp else None
-    }
-    
-    if log_entry.status == "COMPLETED" and log_entry.final_json_response:
-        try:
-            response["data"] = json.loads(log_entry.final_json_response)
-        except json.JSONDecodeError:
-            response["data"] = log_entry.final_json_response
+    Las tareas terminadas (COMPLETED o FAILED) se sirven desde una caché en memoria
+    con cabecera ETag; con If-None-Match se responde 304 si no ha cambiado.
+    """
+    cached = status_cache.get(task_id)
+    if cached is None:
+        # Buscar por task_id en lugar de id
+        statement = select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)
+        log_entry = (await session.exec(statement)).first()
         
-        # Agregar información de tokens si está disponible
-        if log_entry.total_tokens:
-            response["tokens_used"] = log_entry.total_tokens
-            
-    elif log_entry.status == "FAILED":
-        response["error"] = log_entry.error_message
+        if not log_entry:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
         
-    return response
+        # El resultado vive en TaskResult y solo se lee cuando la tarea ha terminado
+        result = None
+        if log_entry.status in ("COMPLETED", "FAILED"):
+            result = await session.get(TaskResult, task_id)
+        body, etag = status_cache.render(log_entry, result)
+        if etag is None:
+            return Response(content=body, media_type="application/json")
+    else:
+        body, etag = cached
+    
+    headers = {"ETag": etag}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        status_cache.not_modified += 1
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (RFC 9110): admite listas, W/ y *."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
 
 # Endpoint para consultar el estado de múltiples tareas
 @app.get("/api/v1/invoices/batch-status")
 async def get_batch_status(
     task_ids: str,  # Lista de task_ids separados por comas
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """
     Consulta el estado de múltiples tareas usando una lista de task_ids separados por comas.
@@ -159,11 +427,24 @@ async def get_batch_status(
             detail="Formato de task_id inválido"
         )
     
+    # Una sola consulta para todo el lote (el resultado, con LEFT JOIN a TaskResult)
+    statement = (
+        select(
+            ApiTrackingLog.task_id,
+            ApiTrackingLog.status,
+            ApiTrackingLog.filename,
+            TaskResult.result_data,
+            TaskResult.normalized,
+            TaskResult.error_message
+        )
+        .outerjoin(TaskResult, TaskResult.task_id == ApiTrackingLog.task_id)
+        .where(ApiTrackingLog.task_id.in_(task_id_list))
+    )
+    log_entries = {row.task_id: row for row in await session.exec(statement)}
+    
     results = []
     for task_id in task_id_list:
-        # Usar select con where en lugar de session.get()
-        statement = select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)
-        log_entry = session.exec(statement).first()
+        log_entry = log_entries.get(task_id)
         
         if not log_entry:
             results.append({
@@ -178,52 +459,249 @@ async def get_batch_status(
                 "filename": log_entry.filename
             }
             
-            if log_entry.status == "COMPLETED" and log_entry.final_json_response:
-                try:
-                    result["data"] = json.loads(log_entry.final_json_response)
-                except json.JSONDecodeError:
-                    result["data"] = log_entry.final_json_response
+            if log_entry.status == "COMPLETED" and log_entry.result_data:
+                result["data"] = task_results.result_content(log_entry.result_data, log_entry.normalized)
             elif log_entry.status == "FAILED":
                 result["error"] = log_entry.error_message
                 
             results.append(result)
     
-    return {"results": results}
+    return FastJSONResponse({"results": results})
+
+# Endpoint para consultar un lote completo
+@app.get("/api/v1/batches/{batch_id}")
+async def get_batch(
+    batch_id: uuid.UUID,
+    include_data: bool = True,
+    session: AsyncSession = Depends(get_async_session)
+):
+    """
+    Consulta el progreso de un lote con una sola consulta indexada por batch_id.
+    
+    - **batch_id**: UUID del lote devuelto por /api/v1/invoices/extract
+    - **include_data**: Si es false, no se leen ni devuelven los datos extraídos ni los errores
+    
+    Returns:
+        - **progress**: Conteo de tareas por estado
+        - **tasks**: Estado de cada tarea del lote
+    """
+    columns = [
+        ApiTrackingLog.task_id,
+        ApiTrackingLog.status,
+        ApiTrackingLog.filename,
+        ApiTrackingLog.user_identifier,
+        ApiTrackingLog.request_utc_timestamp,
+        ApiTrackingLog.completion_utc_timestamp,
+    ]
+    statement = select(*columns)
+    if include_data:
+        statement = select(*columns, TaskResult.result_data, TaskResult.normalized, TaskResult.error_message).outerjoin(
+            TaskResult, TaskResult.task_id == ApiTrackingLog.task_id
+        )
+    
+    statement = statement.where(ApiTrackingLog.batch_id == batch_id).order_by(ApiTrackingLog.id)
+    rows = (await session.exec(statement)).all()
+    
+    # Todo lote tiene al menos una tarea: sin filas, el lote no existe
+    if not rows:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Batch not found")
+    
+    progress = {"total": len(rows), "pending": 0, "processing": 0, "completed": 0, "failed": 0}
+    tasks = []
+    for row in rows:
+        progress[row.status.lower()] = progress.get(row.status.lower(), 0) + 1
+        task = {
+            "task_id": row.task_id,
+            "status": row.status,
+            "filename": row.filename,
+            "created_at": row.request_utc_timestamp.isoformat(),
+            "completed_at": row.completion_utc_timestamp.isoformat() if row.completion_utc_timestamp else None
+        }
+        if include_data:
+            if row.status == "COMPLETED" and row.result_data:
+                task["data"] = task_results.result_content(row.result_data, row.normalized)
+            elif row.status == "FAILED":
+                task["error"] = row.error_message
+        tasks.append(task)
+    
+    progress["done"] = progress["completed"] + progress["failed"]
+    
+    return FastJSONResponse({
+        "batch_id": batch_id,
+        "user_identifier": rows[0].user_identifier,
+        "is_finished": progress["done"] == progress["total"],
+        "progress": progress,
+        "tasks": tasks
+    })
+
+async def _read_rows(statement) -> list:
+    """Ejecuta una consulta en una sesión asíncrona de vida corta."""
+    async with AsyncSession(get_async_engine()) as session:
+        return (await session.exec(statement)).all()
+
+# Endpoint de suscripción a cambios de estado (Server-Sent Events)
+@app.get("/api/v1/events")
+async def stream_events(
+    request: Request,
+    task_id: Optional[uuid.UUID] = None,
+    batch_id: Optional[uuid.UUID] = None,
+    user_identifier: Optional[str] = None
+):
+    """
+    Envía en tiempo real las transiciones de estado de las tareas (text/event-stream).
+    
+    - **task_id**, **batch_id**, **user_identifier**: Filtros opcionales; se reciben los
+      eventos que coinciden con cualquiera de ellos (sin filtros: todos los eventos)
+    
+    Al conectar se envía el estado actual de la tarea o del lote indicado, para que el
+    cliente no pierda transiciones ocurridas antes de suscribirse.
+    """
+    if hub.subscriber_count >= settings.event_max_connections:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Demasiadas conexiones de eventos abiertas",
+            headers={"Retry-After": "30"}
+        )
+    
+    # Consulta del estado actual (columnas estrechas). Se ejecuta en el generador y
+    # la sesión se cierra enseguida para no retener una conexión durante todo el stream.
+    statement = None
+    if task_id or batch_id:
+        condition = ApiTrackingLog.task_id == task_id if task_id else ApiTrackingLog.batch_id == batch_id
+        if task_id and batch_id:
+            condition = (ApiTrackingLog.task_id == task_id) | (ApiTrackingLog.batch_id == batch_id)
+        statement = select(
+            ApiTrackingLog.task_id,
+            ApiTrackingLog.batch_id,
+            ApiTrackingLog.user_identifier,
+            ApiTrackingLog.filename,
+            ApiTrackingLog.status
+        ).where(condition)
+    
+    async def event_stream():
+        # La suscripción vive solo dentro del generador: si el cliente se desconecta
+        # antes de que empiece o falla la consulta inicial, no queda registrada.
+        # Se suscribe antes de leer el estado actual para no perder transiciones.
+        subscription = hub.subscribe(task_id=task_id, batch_id=batch_id, user_identifier=user_identifier)
+        try:
+            if statement is not None:
+                for row in await _read_rows(statement):
+                    yield format_sse({
+                        "task_id": str(row.task_id),
+                        "batch_id": str(row.batch_id) if row.batch_id else None,
+                        "user_identifier": row.user_identifier,
+                        "filename": row.filename,
+                        "status": row.status,
+                        "timestamp": datetime.utcnow().isoformat()
+                    })
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.queue.get(), timeout=settings.event_heartbeat_seconds
+                    )
+                    yield format_sse(event)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # Comentario SSE para mantener viva la conexión a través de proxies
+                    yield ": ping\n\n"
+        finally:
+            hub.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Interfaz web de administración
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_dashboard(request: Request, session: Session = Depends(get_session)):
+async def admin_dashboard(request: Request):
     """
     Interfaz web para monitorear el estado de todas las facturas.
+    Los datos se cargan por páginas desde /api/v1/admin/logs.
     """
-    # Obtener todas las entradas de seguimiento
-    statement = select(ApiTrackingLog).order_by(ApiTrackingLog.request_utc_timestamp.desc())
-    logs = session.exec(statement).all()
-    
     return templates.TemplateResponse("admin_dashboard.html", {
         "request": request,
-        "logs": logs,
         "title": "Dashboard de Administración - Extracción de Facturas"
     })
 
+def _encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """Codifica la posición (fecha de solicitud, id) de la última fila devuelta."""
+    raw = f"{timestamp.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cursor inválido")
+
 # API para la interfaz web (obtener datos en JSON)
 @app.get("/api/v1/admin/logs")
 async def get_admin_logs(
-    status_filter: str = None,
+    status_filter: Optional[str] = None,
+    user_identifier: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    cursor: Optional[str] = None,
     limit: int = 100,
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_async_session)
 ):
     """
-    API para obtener los logs de procesamiento con filtros opcionales.
+    API para obtener los logs de procesamiento con filtros opcionales y paginación por cursor.
+    
+    - **status_filter**: Filtrar por estado
+    - **user_identifier**: Filtrar por usuario
+    - **date_from** / **date_to**: Rango de fecha de solicitud (UTC, ISO 8601)
+    - **cursor**: Valor de next_cursor de la página anterior
+    - **limit**: Filas por página (máximo 500)
+    
+    Las filas se ordenan de la más reciente a la más antigua. Cada página se obtiene
+    con una búsqueda por índice a partir del cursor, sin OFFSET, y nunca se leen los
+    datos extraídos (de TaskResult solo se lee el mensaje de error).
     """
-    statement = select(ApiTrackingLog)
+    limit = max(1, min(limit, 500))
+    
+    # Proyección: solo las columnas del listado
+    statement = select(
+        ApiTrackingLog.id,
+        ApiTrackingLog.task_id,
+        ApiTrackingLog.filename,
+        ApiTrackingLog.user_identifier,
+        ApiTrackingLog.status,
+        ApiTrackingLog.request_utc_timestamp,
+        ApiTrackingLog.completion_utc_timestamp,
+        ApiTrackingLog.total_tokens,
+        ApiTrackingLog.cache_hit,
+        ApiTrackingLog.processing_path,
+        TaskResult.error_message
+    ).outerjoin(TaskResult, TaskResult.task_id == ApiTrackingLog.task_id)
     
     if status_filter:
         statement = statement.where(ApiTrackingLog.status == status_filter)
+    if user_identifier:
+        statement = statement.where(ApiTrackingLog.user_identifier == user_identifier)
+    if date_from:
+        statement = statement.where(ApiTrackingLog.request_utc_timestamp >= date_from)
+    if date_to:
+        statement = statement.where(ApiTrackingLog.request_utc_timestamp < date_to)
+    if cursor:
+        cursor_timestamp, cursor_id = _decode_cursor(cursor)
+        statement = statement.where(
+            (ApiTrackingLog.request_utc_timestamp < cursor_timestamp)
+            | ((ApiTrackingLog.request_utc_timestamp == cursor_timestamp) & (ApiTrackingLog.id < cursor_id))
+        )
     
-    statement = statement.order_by(ApiTrackingLog.request_utc_timestamp.desc()).limit(limit)
+    statement = statement.order_by(
+        ApiTrackingLog.request_utc_timestamp.desc(),
+        ApiTrackingLog.id.desc()
+    ).limit(limit + 1)
     
-    logs = session.exec(statement).all()
+    logs = (await session.exec(statement)).all()
+    has_more = len(logs) > limit
+    logs = logs[:limit]
     
     return {
         "logs": [
@@ -235,10 +713,13 @@ async def get_admin_logs(
                 "request_timestamp": log.request_utc_timestamp.isoformat(),
                 "completion_timestamp": log.completion_utc_timestamp.isoformat() if log.completion_utc_timestamp else None,
                 "total_tokens": log.total_tokens,
+                "cache_hit": log.cache_hit,
+                "processing_path": log.processing_path,
                 "error_message": log.error_message
             }
             for log in logs
-        ]
+        ],
+        "next_cursor": _encode_cursor(logs[-1].request_utc_timestamp, logs[-1].id) if has_more else None
     }
 
 # Endpoint para obtener estadísticas
@@ -247,25 +728,51 @@ async def get_admin_stats(session: Session = Depends(get_session)):
     """
     Obtiene estadísticas de uso del sistema.
     """
-    from sqlmodel import func
-    
-    # Contar por estado
-    pending_count = session.exec(select(func.count(ApiTrackingLog.id)).where(ApiTrackingLog.status == "PENDING")).first()
-    processing_count = session.exec(select(func.count(ApiTrackingLog.id)).where(ApiTrackingLog.status == "PROCESSING")).first()
-    completed_count = session.exec(select(func.count(ApiTrackingLog.id)).where(ApiTrackingLog.status == "COMPLETED")).first()
-    failed_count = session.exec(select(func.count(ApiTrackingLog.id)).where(ApiTrackingLog.status == "FAILED")).first()
-    
-    # Total de tokens utilizados
-    total_tokens = session.exec(select(func.sum(ApiTrackingLog.total_tokens))).first() or 0
+    # Contadores mantenidos en cada transición de estado (sin recorrer ApiTrackingLog)
+    counters = stats.get_counters(session)
     
     return {
-        "pending": pending_count or 0,
-        "processing": processing_count or 0,
-        "completed": completed_count or 0,
-        "failed": failed_count or 0,
-        "total_tokens_used": total_tokens
+        "pending": counters.get("status:PENDING", 0),
+        "processing": counters.get("status:PROCESSING", 0),
+        "completed": counters.get("status:COMPLETED", 0),
+        "failed": counters.get("status:FAILED", 0),
+        "total_tokens_used": counters.get("tokens:total", 0),
+        "result_cache": result_cache.get_cache_stats(session, counters),
+        "queue": dispatcher.get_stats(counters),
+        "gemini": gemini_scheduler.get_stats(),
+        "page_filter": {
+            "blank_pages_removed": counters.get("pages:blank_removed", 0),
+            "duplicate_pages_removed": counters.get("pages:duplicate_removed", 0)
+        },
+        "near_duplicates": {
+            "mode": settings.near_duplicate_mode,
+            "flagged": counters.get("near_duplicates:flagged", 0),
+            "reused": counters.get("near_duplicates:reused", 0)
+        },
+        "supplier_templates": supplier_templates.get_stats(session, counters),
+        "events": {
+            "subscribers": hub.subscriber_count,
+            "published_since_start": hub.published_count
+        },
+        "status_cache": status_cache.get_stats()
     }
 
+# Endpoint para obtener el resumen diario de uso
+@app.get("/api/v1/admin/stats/daily")
+async def get_daily_stats(
+    days: int = 30,
+    user_identifier: Optional[str] = None,
+    session: Session = Depends(get_session)
+):
+    """
+    Obtiene el resumen diario (tareas, tokens, fallos, latencia media) por usuario.
+    
+    - **days**: Número de días hacia atrás (por defecto 30)
+    - **user_identifier**: Filtrar por usuario
+    """
+    days = max(1, min(days, 366))
+    return {"days": stats.get_daily_rollups(session, days, user_identifier)}
+
 # Endpoint para obtener información del sistema
 @app.get("/api/v1/system/info")
 async def get_system_info():
@@ -277,28 +784,37 @@ async def get_system_info():
         "version": settings.app_version,
         "max_file_size_mb": settings.max_file_size_mb,
         "allowed_extensions": settings.allowed_extensions,
+        "render_profile": settings.render_profile,
+        "render_profiles": list(RENDER_PROFILES.keys()) + ["custom"],
         "gemini_configured": bool(settings.gemini_api_key),
+        "extraction_client": extraction_client.get_stats(),
         "database_url": settings.database_url.replace("sqlite:///", "").replace("./", ""),
         "status": "operational"
     }
 
 # Endpoint para validar configuración
 @app.get("/api/v1/system/health")
-async def health_check(session: Session = Depends(get_session)):
+async def health_check(session: AsyncSession = Depends(get_async_session)):
     """
     Endpoint de health check para verificar el estado del sistema.
     """
     try:
         # Verificar base de datos
-        session.exec(select(ApiTrackingLog).limit(1))
+        await session.exec(select(ApiTrackingLog.id).limit(1))
         db_status = "healthy"
+        counters = {
+            counter.name: counter.value
+            for counter in await session.exec(select(StatsCounter))
+        }
     except Exception as e:
         db_status = f"error: {str(e)}"
+        counters = {}
     
     return {
         "status": "healthy" if db_status == "healthy" else "unhealthy",
         "database": db_status,
         "gemini_api": "configured" if settings.gemini_api_key else "not configured",
+        "admission": admission.get_stats(counters),
         "timestamp": datetime.utcnow().isoformat()
     }
 
@@ -1,19 +1,120 @@
 # models.py
 import uuid
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional
+from sqlalchemy import Index
 from sqlmodel import Field, SQLModel
 
 class ApiTrackingLog(SQLModel, table=True):
+    # Índices compuestos para el listado paginado (orden por fecha de solicitud e id),
+    # para reclamar la tarea PENDING más antigua y para exportar por fecha de finalización
+    __table_args__ = (
+        Index("ix_apitrackinglog_request_ts_id", "request_utc_timestamp", "id"),
+        Index("ix_apitrackinglog_status_request_ts_id", "status", "request_utc_timestamp", "id"),
+        Index("ix_apitrackinglog_user_request_ts_id", "user_identifier", "request_utc_timestamp", "id"),
+        Index("ix_apitrackinglog_status_completion_ts_id", "status", "completion_utc_timestamp", "id"),
+    )
+    
     id: Optional[int] = Field(default=None, primary_key=True)
     task_id: uuid.UUID = Field(default_factory=uuid.uuid4, index=True, unique=True)
+    batch_id: Optional[uuid.UUID] = Field(default=None, index=True) # Lote al que pertenece la tarea
     user_identifier: str
     filename: Optional[str] = None
     request_utc_timestamp: datetime = Field(default_factory=datetime.utcnow)
     completion_utc_timestamp: Optional[datetime] = None
     status: str = Field(default="PENDING") # PENDING, PROCESSING, COMPLETED, FAILED
+    status_updated_utc_timestamp: datetime = Field(default_factory=datetime.utcnow, index=True) # Último cambio de estado
     prompt_tokens: Optional[int] = None
     completion_tokens: Optional[int] = None
     total_tokens: Optional[int] = None
+    cache_hit: bool = Field(default=False) # True si el resultado se obtuvo de la caché
+    render_profile: Optional[str] = None # Perfil de renderizado solicitado (None = el de RENDER_PROFILE)
+    processing_path: Optional[str] = None # text, image o mixed: cómo se enviaron las páginas a Gemini
+    page_count: Optional[int] = None # Páginas del documento
+    blank_pages_removed: int = Field(default=0) # Páginas en blanco no enviadas a Gemini
+    duplicate_pages_removed: int = Field(default=0) # Páginas casi idénticas no enviadas a Gemini
+    stored_path: Optional[str] = None # Archivo original en disco mientras la tarea no termina
+    lease_owner: Optional[str] = None # Worker que tiene reclamada la tarea (host:pid:id)
+    lease_expires_utc_timestamp: Optional[datetime] = Field(default=None, index=True) # Renovado por el heartbeat del worker
+    attempts: int = Field(default=0) # Veces que se ha reclamado la tarea
+    near_duplicate_of: Optional[uuid.UUID] = None # Tarea COMPLETED con una primera página casi idéntica
+    near_duplicate_distance: Optional[int] = None # Bits distintos entre los hashes perceptuales
+
+class TaskResult(SQLModel, table=True):
+    """
+    Resultado de una tarea terminada, separado de ApiTrackingLog para que las consultas
+    de estado lean filas estrechas. El JSON se guarda comprimido (ver task_results.py).
+    """
+    task_id: uuid.UUID = Field(primary_key=True)
+    result_data: Optional[bytes] = None # JSON extraído comprimido con zlib
+    result_size_bytes: int = Field(default=0) # Tamaño del JSON sin comprimir
+    normalized: bool = Field(default=False) # JSON compacto validado al completar (se sirve sin decodificar)
     error_message: Optional[str] = None
-    final_json_response: Optional[str] = None # Almacenar el JSON como texto
\ No newline at end of file
+
+class DocumentFingerprint(SQLModel, table=True):
+    """
+    Huella de una extracción COMPLETED para detectar facturas casi duplicadas (ver
+    near_duplicates.py): hash perceptual de 64 bits de la primera página y, si el PDF
+    tiene capa de texto, el SHA-256 de su texto normalizado. Las cuatro bandas de 16
+    bits indexadas permiten buscar hashes cercanos sin recorrer la tabla.
+    """
+    task_id: uuid.UUID = Field(primary_key=True)
+    hash_value: str = Field(max_length=16) # Hexadecimal
+    text_digest: Optional[str] = Field(default=None, index=True, max_length=64)
+    band0: Optional[int] = Field(default=None, index=True)
+    band1: Optional[int] = Field(default=None, index=True)
+    band2: Optional[int] = Field(default=None, index=True)
+    band3: Optional[int] = Field(default=None, index=True)
+    created_utc_timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class SupplierTemplate(SQLModel, table=True):
+    """
+    Plantilla de extracción local aprendida para un proveedor (ver supplier_templates.py).
+    Las reglas por campo, con sus verificaciones, se guardan como JSON.
+    """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    issuer_tax_id: str = Field(index=True, unique=True, max_length=32) # Normalizado: solo letras y dígitos
+    issuer_name: Optional[str] = None
+    rules: str # JSON
+    samples: int = Field(default=0) # Extracciones de Gemini de las que se ha aprendido
+    hits: int = Field(default=0) # Facturas extraídas con la plantilla
+    created_utc_timestamp: datetime = Field(default_factory=datetime.utcnow)
+    updated_utc_timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class InvoiceBatch(SQLModel, table=True):
+    """Lote de facturas enviado en una misma petición de extracción."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    batch_id: uuid.UUID = Field(default_factory=uuid.uuid4, index=True, unique=True)
+    user_identifier: str
+    total_files: int = Field(default=0)
+    created_utc_timestamp: datetime = Field(default_factory=datetime.utcnow)
+
+class ExtractionCache(SQLModel, table=True):
+    """Resultado de extracción reutilizable, indexado por hash de contenido + prompt + modelo."""
+    cache_key: str = Field(primary_key=True, max_length=64)
+    model_name: str
+    final_json_response: str
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    total_tokens: Optional[int] = None
+    size_bytes: int = Field(default=0)
+    hit_count: int = Field(default=0)
+    created_utc_timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
+    last_access_utc_timestamp: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+class StatsCounter(SQLModel, table=True):
+    """Contador global mantenido en la misma transacción que cada cambio de estado."""
+    name: str = Field(primary_key=True) # p. ej. status:PENDING, tokens:total
+    value: int = Field(default=0)
+
+class DailyUsageRollup(SQLModel, table=True):
+    """Resumen diario de uso por usuario."""
+    day: date = Field(primary_key=True)
+    user_identifier: str = Field(primary_key=True)
+    tasks: int = Field(default=0)
+    completed: int = Field(default=0)
+    failed: int = Field(default=0)
+    cache_hits: int = Field(default=0)
+    total_tokens: int = Field(default=0)
+    latency_ms_sum: int = Field(default=0) # Suma de latencias de tareas finalizadas
+    latency_count: int = Field(default=0)
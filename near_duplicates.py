@@ -0,0 +1,311 @@
+# near_duplicates.py
+"""
+Detección de facturas casi duplicadas entre subidas.
+
+La misma factura puede llegar como PDF escaneado y como foto, con bytes distintos
+(la caché de resultados no la reconoce). Para detectarla se guarda una huella de
+cada extracción COMPLETED:
+
+- un hash perceptual grueso (64 bits) de la primera página, y
+- si el PDF tiene capa de texto, el SHA-256 de su texto normalizado.
+
+El hash se calcula sobre el mapa de tinta de la página: cuánto más oscuro es cada
+píxel que el papel que lo rodea. Así no influyen la iluminación de una foto, el
+fondo alrededor del papel ni el gris de un escáner. El mapa se recorta a la zona con
+contenido y se reduce a 8 x 8 celdas; cada bit indica si la celda tiene más tinta
+que la media (aHash). Un escaneo y una foto de la misma factura quedan a pocos bits;
+la maquetación de otro proveedor, lejos. Un hash fino (dHash de 1024 bits) separa
+en cambio el escaneo de la foto de la misma factura a cientos de bits.
+
+A cambio, dos facturas distintas de un mismo proveedor (misma maquetación, otro
+número e importes) también quedan a pocos bits. Por eso, cuando las dos subidas
+tienen capa de texto, decide el texto (igual: duplicada; distinto: no lo es), y
+solo se reutiliza el resultado de otra tarea si el texto coincide. Entre escaneos y
+fotos solo hay hash: la factura se marca, nunca se reutiliza su resultado.
+
+El índice usa multi-index hashing: el hash se divide en 4 bandas de 16 bits,
+cada una en una columna indexada. Si dos hashes están a distancia de Hamming <= r,
+por el principio del palomar al menos una banda está a distancia <= r // 4, así
+que basta buscar por igualdad en cada banda los valores a esa distancia
+(consultas indexadas, sin recorrer la tabla) y verificar la distancia completa
+solo en los candidatos. Los bits se reparten entre las bandas alternados (el bit i
+va a la banda i % 4) para que cada banda cubra toda la página y las zonas en blanco
+no dejen bandas a cero que coincidirían con casi todas las facturas.
+"""
+
+import asyncio
+import hashlib
+import io
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import combinations
+from typing import List, Optional
+from sqlalchemy import delete, inspect, or_, text
+from sqlmodel import Session, select
+from config import settings
+from models import ApiTrackingLog, DocumentFingerprint, TaskResult
+import stats
+
+HASH_SIZE = 8  # aHash de 8 x 8 = 64 bits
+BANDS = 4
+BAND_BITS = HASH_SIZE * HASH_SIZE // BANDS
+# Distancia máxima admitida: con radio 3 por banda ya son 697 valores por consulta
+MAX_DISTANCE = BANDS * 4 - 1
+# Tablas de huellas de versiones anteriores
+LEGACY_TABLES = ("perceptualhash", "fingerprintband")
+# Lado mayor (en píxeles) de la imagen sobre la que se calcula la huella
+FINGERPRINT_SIZE = 512
+# Diferencia mínima (niveles de gris) con el papel para que un píxel cuente como tinta
+INK_CONTRAST = 24
+# El papel es lo que supera esta fracción del nivel del 5 % de píxeles más claros
+PAPER_LEVEL = 0.7
+# Marco de la imagen que se ignora (bordes de la foto, sombras del escáner)
+BORDER_FRACTION = 0.04
+# Fracción de la tinta que se descarta en cada borde al recortar (motas sueltas)
+TRIM_FRACTION = 0.005
+
+
+@dataclass
+class Fingerprint:
+    """Huella de una subida: hash perceptual de la primera página y resumen de su capa de texto."""
+    hash_value: int
+    text_digest: Optional[str] = None
+
+
+def _text_digest(document) -> Optional[str]:
+    """SHA-256 del texto normalizado del PDF, o None si alguna página no tiene capa de texto."""
+    texts = []
+    for page in document:
+        text = " ".join(page.get_text("text").split()).casefold()
+        if len(text) < settings.text_layer_min_chars or text.count("\ufffd") > len(text) * 0.05:
+            return None
+        texts.append(text)
+    return hashlib.sha256("\f".join(texts).encode("utf-8")).hexdigest()
+
+
+def ink_map(image):
+    """
+    Mapa de tinta de una página en escala de grises (0 = papel). El nivel del papel se
+    estima en cada zona (máximo local desenfocado), así que una iluminación irregular
+    no cuenta como tinta. El fondo alrededor del papel y el marco de la imagen se anulan.
+    """
+    from PIL import Image, ImageChops, ImageFilter
+    paper_level = image.filter(ImageFilter.MaxFilter(9)).filter(ImageFilter.GaussianBlur(8))
+    histogram = paper_level.histogram()
+    brightest, count = 255, 0
+    while brightest > 0 and count + histogram[brightest] < sum(histogram) * 0.05:
+        count += histogram[brightest]
+        brightest -= 1
+    threshold = brightest * PAPER_LEVEL
+    paper = (image.filter(ImageFilter.MaxFilter(9))
+             .point(lambda value: 255 if value > threshold else 0)
+             .filter(ImageFilter.MinFilter(15)))
+
+    ink = ImageChops.subtract(paper_level, image).point(lambda value: 0 if value < INK_CONTRAST else min(255, value * 2))
+    width, height = image.size
+    margin_x, margin_y = int(width * BORDER_FRACTION), int(height * BORDER_FRACTION)
+    frame = Image.new("L", image.size, 0)
+    frame.paste(255, (margin_x, margin_y, width - margin_x, height - margin_y))
+    return ImageChops.multiply(ImageChops.multiply(ink, paper), frame)
+
+
+def _trimmed_range(profile: List[int]) -> Optional[tuple]:
+    """Intervalo [inicio, fin) del perfil sin el TRIM_FRACTION de tinta de cada extremo."""
+    total = sum(profile)
+    if not total:
+        return None
+    limit = total * TRIM_FRACTION
+    start, accumulated = 0, 0
+    while accumulated + profile[start] <= limit:
+        accumulated += profile[start]
+        start += 1
+    end, accumulated = len(profile), 0
+    while accumulated + profile[end - 1] <= limit:
+        accumulated += profile[end - 1]
+        end -= 1
+    return start, end
+
+
+def content_box(ink) -> Optional[tuple]:
+    """Zona con contenido del mapa de tinta, sin las motas sueltas de los bordes."""
+    from PIL import Image
+    width, height = ink.size
+    columns = _trimmed_range(list(ink.resize((width, 1), Image.BOX).getdata()))
+    rows = _trimmed_range(list(ink.resize((1, height), Image.BOX).getdata()))
+    if columns is None or rows is None:
+        return None
+    return columns[0], rows[0], columns[1], rows[1]
+
+
+def average_hash(image, hash_size: int = HASH_SIZE) -> int:
+    """aHash: un bit por celda de la imagen reducida a hash_size x hash_size, 1 si supera la media."""
+    from PIL import Image
+    pixels = list(image.resize((hash_size, hash_size), Image.BOX).getdata())
+    mean = sum(pixels) / len(pixels)
+    value = 0
+    for pixel in pixels:
+        value = (value << 1) | (pixel > mean)
+    return value
+
+
+def compute_fingerprint(file_bytes: bytes, mime_type: str) -> Optional[Fingerprint]:
+    """
+    Huella de la primera página (PDF) o de la imagen: aHash del mapa de tinta recortado
+    a la zona con contenido y resumen del texto de los PDF nativos.
+    Se ejecuta en el pool de procesos de renderizado.
+    """
+    import fitz  # PyMuPDF
+    from PIL import Image, ImageOps
+    import page_filter
+
+    text_digest = None
+    try:
+        if mime_type == "application/pdf":
+            document = fitz.open(stream=file_bytes, filetype="pdf")
+            if len(document) == 0:
+                return None
+            image = page_filter.page_thumbnail(document.load_page(0), FINGERPRINT_SIZE)
+            text_digest = _text_digest(document)
+        else:
+            image = Image.open(io.BytesIO(file_bytes))
+            image = ImageOps.exif_transpose(image).convert("L")
+            image.thumbnail((FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+    except Exception as e:
+        print(f"No se pudo calcular la huella de la factura: {e}")
+        return None
+
+    ink = ink_map(image)
+    box = content_box(ink)
+    if box:
+        ink = ink.crop(box)
+    return Fingerprint(average_hash(ink), text_digest)
+
+
+async def compute_fingerprint_async(file_bytes: bytes, mime_type: str) -> Optional[Fingerprint]:
+    """compute_fingerprint en el pool de procesos, sin bloquear el event loop."""
+    from convert_toimage import get_render_pool
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_render_pool(), compute_fingerprint, file_bytes, mime_type)
+
+
+def split_bands(hash_value: int) -> List[int]:
+    """
+    Divide el hash en BANDS bandas de BAND_BITS bits, alternando los bits: el bit i
+    (contando desde el alto) va a la banda i % BANDS.
+    """
+    bands = [0] * BANDS
+    total_bits = BANDS * BAND_BITS
+    for bit in range(total_bits):
+        bands[bit % BANDS] = (bands[bit % BANDS] << 1) | ((hash_value >> (total_bits - 1 - bit)) & 1)
+    return bands
+
+
+def band_variants(band: int, radius: int) -> List[int]:
+    """Todos los valores de banda a distancia de Hamming <= radius de `band`."""
+    variants = [band]
+    for distance in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), distance):
+            flipped = band
+            for bit in bits:
+                flipped ^= 1 << bit
+            variants.append(flipped)
+    return variants
+
+
+def find_match(session: Session, fingerprint: Fingerprint, max_distance: Optional[int] = None) -> Optional[dict]:
+    """
+    Busca la extracción COMPLETED que es la misma factura. Devuelve {"task_id",
+    "distance", "text_match"} o None. text_match indica que la capa de texto coincide,
+    condición para reutilizar el resultado.
+    """
+    if fingerprint.text_digest:
+        same_text = session.exec(
+            select(DocumentFingerprint.task_id, DocumentFingerprint.hash_value)
+            .where(DocumentFingerprint.text_digest == fingerprint.text_digest)
+        ).first()
+        if same_text:
+            distance = bin(int(same_text.hash_value, 16) ^ fingerprint.hash_value).count("1")
+            return {"task_id": same_text.task_id, "distance": distance, "text_match": True}
+
+    max_distance = settings.near_duplicate_max_distance if max_distance is None else max_distance
+    max_distance = min(max_distance, MAX_DISTANCE)
+    radius = max_distance // BANDS
+    columns = [DocumentFingerprint.band0, DocumentFingerprint.band1, DocumentFingerprint.band2, DocumentFingerprint.band3]
+    conditions = [
+        column.in_(band_variants(band, radius))
+        for column, band in zip(columns, split_bands(fingerprint.hash_value))
+    ]
+    candidates = session.exec(
+        select(DocumentFingerprint.task_id, DocumentFingerprint.hash_value, DocumentFingerprint.text_digest)
+        .where(or_(*conditions))
+    ).all()
+
+    best = None
+    for candidate in candidates:
+        # Si las dos tienen capa de texto y no coincide (se habría encontrado arriba), son facturas distintas
+        if fingerprint.text_digest and candidate.text_digest:
+            continue
+        distance = bin(int(candidate.hash_value, 16) ^ fingerprint.hash_value).count("1")
+        if distance <= max_distance and (best is None or distance < best["distance"]):
+            best = {"task_id": candidate.task_id, "distance": distance, "text_match": False}
+    return best
+
+
+def index_task(session: Session, task_id: uuid.UUID, fingerprint: Fingerprint) -> None:
+    """Añade al índice la huella de una extracción COMPLETED."""
+    bands = split_bands(fingerprint.hash_value)
+    session.merge(DocumentFingerprint(
+        task_id=task_id,
+        hash_value=f"{fingerprint.hash_value:016x}",
+        text_digest=fingerprint.text_digest,
+        band0=bands[0],
+        band1=bands[1],
+        band2=bands[2],
+        band3=bands[3],
+    ))
+
+
+def purge_legacy_fingerprints(engine) -> None:
+    """
+    Migración de bases de datos anteriores. Las huellas de versiones previas no son
+    comparables con las actuales (otro hash sobre otra imagen) y no se pueden
+    recalcular porque el archivo original ya se borró: se eliminan la tabla de 64 bits
+    (perceptualhash), la de bandas de 1024 bits (fingerprintband) y las filas de
+    documentfingerprint sin bandas.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table_name in LEGACY_TABLES:
+            if inspector.has_table(table_name):
+                connection.execute(text(f"DROP TABLE {table_name}"))
+                print(f"Tabla obsoleta eliminada: {table_name}")
+        if inspector.has_table(DocumentFingerprint.__tablename__):
+            deleted = connection.execute(
+                delete(DocumentFingerprint).where(DocumentFingerprint.band0.is_(None))
+            ).rowcount
+            if deleted:
+                print(f"{deleted} huellas de facturas de una versión anterior eliminadas")
+
+
+def reuse_result(session: Session, log_entry: ApiTrackingLog, match_task_id: uuid.UUID) -> bool:
+    """
+    Copia a una tarea el resultado de la extracción duplicada. No se consumen tokens.
+    Solo debe llamarse si find_match devolvió text_match (misma capa de texto).
+    Devuelve False si ese resultado ya no existe. El llamador marca la tarea como COMPLETED.
+    """
+    source = session.get(TaskResult, match_task_id)
+    if source is None or source.result_data is None:
+        return False
+    session.merge(TaskResult(
+        task_id=log_entry.task_id,
+        result_data=source.result_data,
+        result_size_bytes=source.result_size_bytes,
+        normalized=source.normalized,
+    ))
+    log_entry.prompt_tokens = 0
+    log_entry.completion_tokens = 0
+    log_entry.total_tokens = 0
+    log_entry.processing_path = stats.NEAR_DUPLICATE_PATH
+    log_entry.completion_utc_timestamp = datetime.utcnow()
+    return True
@@ -0,0 +1,160 @@
+# page_filter.py
+"""
+Filtro previo de páginas: descarta páginas en blanco y páginas casi idénticas
+antes de enviarlas a Gemini.
+
+- Una página está en blanco si en ninguna zona de su miniatura en escala de
+  grises la desviación típica de los píxeles supera BLANK_PAGE_MAX_STDDEV. Se mide
+  por zonas porque una sola línea de texto apenas cambia la varianza de la página
+  entera; los márgenes se ignoran (sombras de escáner).
+- Dos páginas renderizadas son casi idénticas si su contenido ocupa la misma zona
+  de la página y la distancia de Hamming entre los hashes perceptuales de esa zona
+  (dHash de 1024 bits) no supera DUPLICATE_PAGE_MAX_DISTANCE. Se compara solo la
+  zona con contenido porque en páginas casi vacías el blanco domina el hash.
+  Las páginas con capa de texto se comparan por su texto.
+"""
+
+import hashlib
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+import fitz  # PyMuPDF
+from config import settings
+
+# Lado mayor (en píxeles) de la miniatura usada para medir la página
+THUMBNAIL_SIZE = 256
+# La miniatura se divide en TILE_GRID x TILE_GRID zonas para medir la varianza
+TILE_GRID = 16
+# Margen ignorado en cada borde, como fracción del lado
+MARGIN_FRACTION = 0.03
+# Lado del dHash usado para comparar páginas de un mismo documento (32² = 1024 bits).
+# Con menos bits, dos páginas con la misma maquetación y distinto texto parecen iguales.
+PAGE_HASH_SIZE = 32
+# Nivel de gris (sobre el fondo blanco) a partir del cual un píxel se considera contenido
+INK_THRESHOLD = 32
+# Diferencia máxima (en milésimas del lado) entre las zonas con contenido de dos duplicados
+MAX_CONTENT_BOX_SHIFT = 20
+
+
+@dataclass
+class PageFingerprint:
+    """Medidas baratas de una página, calculadas sobre una miniatura."""
+    max_tile_stddev: float
+    dhash: int  # dHash de la zona con contenido
+    content_box: Tuple[int, int, int, int]  # Zona con contenido, en milésimas del ancho y alto
+
+
+@dataclass
+class FilteredPages:
+    """Páginas que se envían a Gemini y cuántas se descartaron."""
+    parts: List[Union[str, dict]]
+    page_count: int
+    blank_removed: int = 0
+    duplicate_removed: int = 0
+
+
+def page_thumbnail(page: fitz.Page, size: int = THUMBNAIL_SIZE):
+    """Renderiza la página en escala de grises con su lado mayor de `size` píxeles (imagen de Pillow)."""
+    from PIL import Image
+    zoom = size / max(page.rect.width, page.rect.height)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+
+def dhash(image, hash_size: int = 16) -> int:
+    """
+    Hash de diferencias (dHash): compara cada píxel con su vecino derecho en una
+    versión reducida de (hash_size + 1) x hash_size. Devuelve hash_size² bits.
+    """
+    from PIL import Image
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def max_tile_stddev(image) -> float:
+    """Mayor desviación típica de los píxeles entre las zonas de la imagen (sin márgenes)."""
+    from PIL import ImageStat
+    width, height = image.size
+    margin_x, margin_y = int(width * MARGIN_FRACTION), int(height * MARGIN_FRACTION)
+    image = image.crop((margin_x, margin_y, width - margin_x, height - margin_y))
+    width, height = image.size
+    highest = 0.0
+    for tile_y in range(TILE_GRID):
+        for tile_x in range(TILE_GRID):
+            box = (
+                tile_x * width // TILE_GRID, tile_y * height // TILE_GRID,
+                (tile_x + 1) * width // TILE_GRID, (tile_y + 1) * height // TILE_GRID,
+            )
+            if box[2] > box[0] and box[3] > box[1]:
+                highest = max(highest, ImageStat.Stat(image.crop(box)).stddev[0])
+    return highest
+
+
+def fingerprint_page(page: fitz.Page) -> PageFingerprint:
+    """Varianza por zonas y dHash de la zona con contenido de la página."""
+    from PIL import ImageOps
+    thumbnail = page_thumbnail(page)
+    width, height = thumbnail.size
+    ink = ImageOps.invert(thumbnail).point(lambda value: 255 if value > INK_THRESHOLD else 0)
+    box = ink.getbbox() or (0, 0, width, height)
+    return PageFingerprint(
+        max_tile_stddev=max_tile_stddev(thumbnail),
+        dhash=dhash(thumbnail.crop(box), PAGE_HASH_SIZE),
+        content_box=(
+            box[0] * 1000 // width, box[1] * 1000 // height,
+            box[2] * 1000 // width, box[3] * 1000 // height,
+        ),
+    )
+
+
+def is_near_duplicate(a: PageFingerprint, b: PageFingerprint) -> bool:
+    """True si dos páginas renderizadas son casi idénticas."""
+    if any(abs(x - y) > MAX_CONTENT_BOX_SHIFT for x, y in zip(a.content_box, b.content_box)):
+        return False
+    return hamming_distance(a.dhash, b.dhash) <= settings.duplicate_page_max_distance
+
+
+def is_blank(fingerprint: PageFingerprint) -> bool:
+    return settings.page_filter_blank and fingerprint.max_tile_stddev <= settings.blank_page_max_stddev
+
+
+def text_fingerprint(text: str) -> int:
+    """Huella de una página de texto, sin la cabecera (que incluye el número de página)."""
+    body = text.split("\n", 1)[-1]
+    return int.from_bytes(hashlib.sha256(body.encode("utf-8")).digest()[:8], "big")
+
+
+def remove_duplicates(parts: List[Union[str, dict]],
+                      fingerprints: List[Optional[Union[int, PageFingerprint]]]) -> tuple:
+    """
+    Quita las páginas casi idénticas a una anterior (en orden de página).
+    `fingerprints[i]` es la huella de una página renderizada, la huella del texto de una
+    página de texto, o None si no se comparó. Devuelve (páginas, descartadas).
+    """
+    if not settings.page_filter_duplicates:
+        return parts, 0
+
+    kept_parts = []
+    seen_images: List[PageFingerprint] = []
+    seen_texts = set()
+    for part, fingerprint in zip(parts, fingerprints):
+        if fingerprint is not None:
+            if isinstance(part, str):
+                if fingerprint in seen_texts:
+                    continue
+                seen_texts.add(fingerprint)
+            else:
+                if any(is_near_duplicate(fingerprint, seen) for seen in seen_images):
+                    continue
+                seen_images.append(fingerprint)
+        kept_parts.append(part)
+    return kept_parts, len(parts) - len(kept_parts)
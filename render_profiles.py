@@ -0,0 +1,106 @@
+# render_profiles.py
+import io
+from dataclasses import dataclass
+from typing import Dict, Optional
+from config import settings
+
+MIME_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+@dataclass(frozen=True)
+class RenderProfile:
+    """
+    Parámetros de renderizado y codificación de las páginas enviadas a Gemini.
+    """
+    name: str
+    dpi: int = 144
+    grayscale: bool = False
+    image_format: str = "png"  # png, jpeg o webp
+    quality: int = 85  # Solo para jpeg/webp
+    max_dimension: Optional[int] = None  # Lado máximo en píxeles
+
+    @property
+    def mime_type(self) -> str:
+        return MIME_TYPES[self.image_format]
+
+    @property
+    def is_passthrough(self) -> bool:
+        """True si las imágenes subidas (JPG/PNG) se pueden enviar sin recodificar."""
+        return self.image_format == "png" and not self.grayscale and self.max_dimension is None
+
+
+# Perfiles predefinidos. 'standard' reproduce el comportamiento original (zoom 2x, PNG).
+RENDER_PROFILES: Dict[str, RenderProfile] = {
+    "standard": RenderProfile(name="standard", dpi=144, image_format="png"),
+    "compact": RenderProfile(name="compact", dpi=150, image_format="jpeg", quality=80, max_dimension=2000),
+    "grayscale": RenderProfile(name="grayscale", dpi=150, grayscale=True, image_format="jpeg", quality=75, max_dimension=2000),
+    "economy": RenderProfile(name="economy", dpi=110, grayscale=True, image_format="webp", quality=60, max_dimension=1600),
+}
+
+
+def get_render_profile(name: Optional[str] = None) -> RenderProfile:
+    """
+    Devuelve el perfil indicado, el de RENDER_PROFILE si no se indica ninguno, o el
+    perfil 'custom' construido con las variables RENDER_DPI, RENDER_FORMAT, etc.
+    Lanza ValueError si el perfil no existe.
+    """
+    name = name or settings.render_profile
+    if name == "custom":
+        if settings.render_format not in MIME_TYPES:
+            raise ValueError(f"Formato de renderizado no soportado: {settings.render_format}")
+        return RenderProfile(
+            name="custom",
+            dpi=settings.render_dpi,
+            grayscale=settings.render_grayscale,
+            image_format=settings.render_format,
+            quality=settings.render_quality,
+            max_dimension=settings.render_max_dimension or None,
+        )
+    if name not in RENDER_PROFILES:
+        raise ValueError(
+            f"Perfil de renderizado desconocido: {name}. "
+            f"Perfiles disponibles: {list(RENDER_PROFILES.keys()) + ['custom']}"
+        )
+    return RENDER_PROFILES[name]
+
+
+def encode_pixmap(pix, profile: RenderProfile) -> bytes:
+    """
+    Codifica un pixmap de PyMuPDF en el formato del perfil.
+    """
+    if profile.image_format == "png":
+        return pix.tobytes("png")
+    if profile.image_format == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=profile.quality)
+
+    # PyMuPDF no escribe WebP: se delega en Pillow
+    from PIL import Image
+    mode = "L" if pix.n == 1 else "RGB"
+    image = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+    return _save_pil_image(image, profile)
+
+
+def reencode_image(image_bytes: bytes, profile: RenderProfile) -> bytes:
+    """
+    Aplica el perfil (escala de grises, lado máximo, formato) a una imagen subida.
+    """
+    from PIL import Image
+    image = Image.open(io.BytesIO(image_bytes))
+    image = image.convert("L" if profile.grayscale else "RGB")
+    if profile.max_dimension and max(image.size) > profile.max_dimension:
+        image.thumbnail((profile.max_dimension, profile.max_dimension))
+    return _save_pil_image(image, profile)
+
+
+def _save_pil_image(image, profile: RenderProfile) -> bytes:
+    output = io.BytesIO()
+    if profile.image_format == "png":
+        image.save(output, format="PNG", optimize=True)
+    elif profile.image_format == "jpeg":
+        image.save(output, format="JPEG", quality=profile.quality, optimize=True)
+    else:
+        image.save(output, format="WEBP", quality=profile.quality, method=4)
+    return output.getvalue()
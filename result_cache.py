@@ -0,0 +1,221 @@
+# result_cache.py
+import hashlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import delete
+from sqlmodel import Session, select, func
+from models import ApiTrackingLog, ExtractionCache
+from config import settings
+import stats
+import task_results
+
+# Se incrementa si cambia el formato de los resultados almacenados
+CACHE_FORMAT_VERSION = "1"
+
+# Contadores de aciertos/fallos (en StatsCounter, compartidos entre procesos)
+HITS_COUNTER = "result_cache:hits"
+MISSES_COUNTER = "result_cache:misses"
+
+# Claves por consulta en lookup_many (por debajo del límite de parámetros de SQLite)
+LOOKUP_CHUNK_SIZE = 500
+
+# La expulsión se comprueba una vez cada EVICT_EVERY_STORES resultados guardados por
+# proceso (los límites pueden superarse como mucho en ese número de entradas) y lee
+# las entradas menos usadas por bloques de EVICT_BATCH_SIZE
+EVICT_EVERY_STORES = 50
+EVICT_BATCH_SIZE = 500
+
+_stores_since_evict = 0
+
+
+def hash_content(file_bytes: bytes) -> str:
+    """
+    Calcula el hash SHA-256 del contenido de un archivo.
+    """
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def build_cache_key(content_hash: str, prompt: str, model_name: str) -> str:
+    """
+    Construye la clave de caché a partir del hash del archivo, el prompt y el modelo.
+    Cualquier cambio en el prompt o en el modelo invalida las entradas anteriores.
+    """
+    key_material = "\n".join([
+        CACHE_FORMAT_VERSION,
+        content_hash,
+        hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        model_name,
+    ])
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+
+def lookup(session: Session, cache_key: str, record_miss: bool = True) -> Optional[ExtractionCache]:
+    """
+    Busca un resultado en caché. Devuelve None si no existe o si ha expirado.
+    Las re-comprobaciones de una misma subida pasan record_miss=False para no
+    contar el fallo dos veces.
+    """
+    if not settings.result_cache_enabled:
+        return None
+
+    entry = session.get(ExtractionCache, cache_key)
+    if entry is None or _is_expired(entry):
+        if record_miss:
+            stats.increment(session, MISSES_COUNTER)
+        return None
+
+    entry.hit_count += 1
+    entry.last_access_utc_timestamp = datetime.utcnow()
+    session.add(entry)
+    stats.increment(session, HITS_COUNTER)
+    return entry
+
+
+def lookup_many(session: Session, cache_keys: List[str]) -> Dict[str, ExtractionCache]:
+    """
+    Busca varios resultados en caché con una consulta por bloque de claves (ingesta masiva).
+    Devuelve {cache_key: entrada} solo con las entradas vigentes.
+    """
+    if not settings.result_cache_enabled or not cache_keys:
+        return {}
+
+    found = {}
+    unique_keys = list(dict.fromkeys(cache_keys))
+    for start in range(0, len(unique_keys), LOOKUP_CHUNK_SIZE):
+        chunk = unique_keys[start:start + LOOKUP_CHUNK_SIZE]
+        for entry in session.exec(select(ExtractionCache).where(ExtractionCache.cache_key.in_(chunk))):
+            if not _is_expired(entry):
+                found[entry.cache_key] = entry
+
+    now = datetime.utcnow()
+    hits = 0
+    for cache_key in cache_keys:
+        entry = found.get(cache_key)
+        if entry is not None:
+            entry.hit_count += 1
+            entry.last_access_utc_timestamp = now
+            session.add(entry)
+            hits += 1
+    if hits:
+        stats.increment(session, HITS_COUNTER, hits)
+    if len(cache_keys) - hits:
+        stats.increment(session, MISSES_COUNTER, len(cache_keys) - hits)
+    return found
+
+
+def apply_cached_result(session: Session, log_entry: ApiTrackingLog, entry: ExtractionCache) -> None:
+    """
+    Copia a una tarea un resultado de la caché. No se consumen tokens.
+    El llamador marca la tarea como COMPLETED (ver stats.set_status).
+    """
+    task_results.store_result(session, log_entry.task_id, entry.final_json_response)
+    log_entry.prompt_tokens = 0
+    log_entry.completion_tokens = 0
+    log_entry.total_tokens = 0
+    log_entry.cache_hit = True
+    log_entry.completion_utc_timestamp = datetime.utcnow()
+
+
+def store(session: Session, cache_key: str, gemini_result: dict) -> None:
+    """
+    Guarda un resultado de Gemini en caché y, cada EVICT_EVERY_STORES resultados,
+    aplica la política de expulsión.
+    """
+    if not settings.result_cache_enabled:
+        return
+
+    json_text = gemini_result["json_text"]
+    usage = gemini_result["usage"]
+    entry = session.get(ExtractionCache, cache_key) or ExtractionCache(
+        cache_key=cache_key,
+        model_name=settings.gemini_model,
+        final_json_response=json_text,
+    )
+    entry.final_json_response = json_text
+    entry.prompt_tokens = usage["prompt_tokens"]
+    entry.completion_tokens = usage["completion_tokens"]
+    entry.total_tokens = usage["total_tokens"]
+    entry.size_bytes = len(json_text.encode("utf-8"))
+    entry.created_utc_timestamp = datetime.utcnow()
+    entry.last_access_utc_timestamp = entry.created_utc_timestamp
+    session.add(entry)
+    session.flush()
+
+    global _stores_since_evict
+    _stores_since_evict += 1
+    if _stores_since_evict >= EVICT_EVERY_STORES:
+        _stores_since_evict = 0
+        evict(session)
+
+
+def evict(session: Session) -> int:
+    """
+    Elimina las entradas expiradas y, si se superan los límites de número de
+    entradas o de tamaño total, las menos usadas recientemente.
+    Devuelve el número de entradas eliminadas.
+    """
+    expiry_limit = datetime.utcnow() - timedelta(hours=settings.result_cache_ttl_hours)
+    result = session.execute(
+        delete(ExtractionCache).where(ExtractionCache.created_utc_timestamp < expiry_limit)
+    )
+    removed = result.rowcount or 0
+
+    entries, total_bytes = _usage(session)
+    max_bytes = settings.result_cache_max_mb * 1024 * 1024
+    if entries <= settings.result_cache_max_entries and total_bytes <= max_bytes:
+        return removed
+
+    # Solo se leen clave y tamaño de las entradas sobrantes (índice por último acceso),
+    # nunca el JSON almacenado ni toda la tabla
+    victims = []
+    while entries > settings.result_cache_max_entries or total_bytes > max_bytes:
+        batch = session.exec(
+            select(ExtractionCache.cache_key, ExtractionCache.size_bytes)
+            .order_by(ExtractionCache.last_access_utc_timestamp)
+            .offset(len(victims))
+            .limit(max(entries - settings.result_cache_max_entries, EVICT_BATCH_SIZE))
+        ).all()
+        if not batch:
+            break
+        for cache_key, size_bytes in batch:
+            if entries <= settings.result_cache_max_entries and total_bytes <= max_bytes:
+                break
+            entries -= 1
+            total_bytes -= size_bytes
+            victims.append(cache_key)
+
+    for start in range(0, len(victims), LOOKUP_CHUNK_SIZE):
+        chunk = victims[start:start + LOOKUP_CHUNK_SIZE]
+        session.execute(delete(ExtractionCache).where(ExtractionCache.cache_key.in_(chunk)))
+    return removed + len(victims)
+
+
+def get_cache_stats(session: Session, counters: Optional[dict] = None) -> dict:
+    """
+    Estadísticas de la caché para el endpoint de administración.
+    """
+    entries, total_bytes = _usage(session)
+    counters = counters if counters is not None else stats.get_counters(session)
+    hits = counters.get(HITS_COUNTER, 0)
+    misses = counters.get(MISSES_COUNTER, 0)
+    lookups = hits + misses
+    return {
+        "enabled": settings.result_cache_enabled,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        "entries": entries,
+        "size_bytes": total_bytes,
+    }
+
+
+def _usage(session: Session) -> tuple:
+    entries, total_bytes = session.exec(
+        select(func.count(ExtractionCache.cache_key), func.sum(ExtractionCache.size_bytes))
+    ).one()
+    return entries or 0, total_bytes or 0
+
+
+def _is_expired(entry: ExtractionCache) -> bool:
+    age = datetime.utcnow() - entry.created_utc_timestamp
+    return age > timedelta(hours=settings.result_cache_ttl_hours)
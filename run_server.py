@@ -1,12 +1,69 @@
 #!/usr/bin/env python3
 """
-Script para ejecutar el servidor de desarrollo de FastAPI
+Script para ejecutar el servidor de FastAPI
+
+- SERVER_MODE=development: un proceso con recarga automática (por defecto).
+- SERVER_MODE=production: WEB_WORKERS procesos HTTP sin recarga y QUEUE_WORKERS
+  procesos de cola (worker.py) que procesan las facturas por separado.
 """
 
+import multiprocessing
+import os
 import sys
 import uvicorn
 from config import settings
 
+def start_queue_workers() -> list:
+    """Lanza los procesos de cola. La base de datos ya está creada por este proceso."""
+    import worker
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(settings.queue_workers):
+        process = context.Process(target=worker.main, args=(False,), name=f"queue-worker-{index}")
+        process.start()
+        processes.append(process)
+    return processes
+
+def stop_queue_workers(processes: list) -> None:
+    """SIGTERM: cada worker termina las tareas en curso antes de salir."""
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+
+def run_production() -> None:
+    from sqlmodel import Session
+    from database import create_db_and_tables, engine
+    import stats
+
+    # Migraciones una sola vez, antes de arrancar los procesos
+    create_db_and_tables()
+    with Session(engine) as session:
+        stats.ensure_initialized(session)
+    # Los procesos hijos heredan el entorno: ninguno vuelve a ejecutar DDL ni migraciones
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "false"
+
+    web_workers = settings.web_workers or os.cpu_count() or 1
+    queue_processes = []
+    if settings.queue_workers > 0:
+        # Los procesos HTTP no procesan tareas (los procesos hijos heredan el entorno)
+        os.environ["EMBEDDED_DISPATCHER"] = "false"
+        queue_processes = start_queue_workers()
+    print(f"⚙️  Modo producción: {web_workers} procesos HTTP, {len(queue_processes)} procesos de cola")
+
+    try:
+        uvicorn.run(
+            "main:app",
+            host=settings.host,
+            port=settings.port,
+            workers=web_workers,
+            proxy_headers=True,
+            log_level="info"
+        )
+    finally:
+        stop_queue_workers(queue_processes)
+
 def main():
     """Función principal para ejecutar el servidor"""
     
@@ -23,14 +80,17 @@ def main():
         print()
     
     try:
-        uvicorn.run(
-            "main:app",
-            host=settings.host,
-            port=settings.port,
-            reload=True,
-            reload_dirs=["./"],
-            log_level="info"
-        )
+        if settings.server_mode == "production":
+            run_production()
+        else:
+            uvicorn.run(
+                "main:app",
+                host=settings.host,
+                port=settings.port,
+                reload=True,
+                reload_dirs=["./"],
+                log_level="info"
+            )
     except KeyboardInterrupt:
         print("\n👋 Servidor detenido")
     except Exception as e:
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# stats.py
+"""
+Estadísticas mantenidas de forma incremental.
+
+Cada transición de estado actualiza, en la misma transacción que la fila de
+ApiTrackingLog, los contadores globales (StatsCounter) y el resumen diario por
+usuario (DailyUsageRollup). Así las consultas de estadísticas leen unas pocas
+filas en lugar de recorrer toda la tabla de seguimiento.
+
+Para reconstruir las estadísticas a partir de ApiTrackingLog:
+    python stats.py rebuild
+"""
+
+import sys
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional
+from sqlalchemy import delete, update
+from sqlmodel import Session, select
+from models import ApiTrackingLog, StatsCounter, DailyUsageRollup
+
+STATUSES = ["PENDING", "PROCESSING", "COMPLETED", "FAILED"]
+TERMINAL_STATUSES = ("COMPLETED", "FAILED")
+
+# Marca de que los contadores ya se inicializaron sobre esta base de datos
+INITIALIZED_COUNTER = "stats:initialized"
+
+# processing_path de las tareas que reutilizan el resultado de una factura casi duplicada
+NEAR_DUPLICATE_PATH = "near_duplicate"
+
+# processing_path de las tareas extraídas con la plantilla del proveedor, sin Gemini
+SUPPLIER_TEMPLATE_PATH = "supplier_template"
+
+
+def increment(session: Session, name: str, delta: int = 1) -> None:
+    """
+    Incrementa un contador de forma atómica (UPDATE value = value + delta).
+    """
+    _upsert_add(session, StatsCounter, {"name": name}, {"value": delta})
+
+
+def record_new_task(session: Session, log_entry: ApiTrackingLog) -> None:
+    """
+    Registra una tarea recién creada (normalmente PENDING, o COMPLETED si vino de la caché).
+    """
+    increment(session, f"status:{log_entry.status}")
+    increment(session, "tasks:total")
+    _add_rollup(session, log_entry.request_utc_timestamp.date(), log_entry.user_identifier, tasks=1)
+    if log_entry.status in TERMINAL_STATUSES:
+        _record_terminal(session, log_entry)
+
+
+def record_new_pending_tasks(session: Session, user_identifier: str, day: date, count: int) -> None:
+    """
+    Registra `count` tareas PENDING creadas de una vez (ingesta masiva): tres
+    actualizaciones en lugar de tres por tarea.
+    """
+    if not count:
+        return
+    increment(session, "status:PENDING", count)
+    increment(session, "tasks:total", count)
+    _add_rollup(session, day, user_identifier, tasks=count)
+
+
+def set_status(session: Session, log_entry: ApiTrackingLog, new_status: str) -> None:
+    """
+    Cambia el estado de una tarea y actualiza las estadísticas en la misma transacción.
+    Si el nuevo estado es final, los tokens y la fecha de finalización deben estar ya asignados.
+    """
+    old_status = log_entry.status
+    log_entry.status = new_status
+    if old_status != new_status:
+        log_entry.status_updated_utc_timestamp = datetime.utcnow()
+    session.add(log_entry)
+    record_transition(session, log_entry, old_status)
+
+
+def record_transition(session: Session, log_entry: ApiTrackingLog, old_status: str) -> None:
+    """
+    Actualiza las estadísticas para una transición ya aplicada a log_entry.
+    """
+    if old_status == log_entry.status:
+        return
+    increment(session, f"status:{old_status}", -1)
+    increment(session, f"status:{log_entry.status}")
+    if log_entry.status in TERMINAL_STATUSES:
+        _record_terminal(session, log_entry)
+
+
+def record_claim(session: Session) -> None:
+    """
+    Registra una transición PENDING -> PROCESSING aplicada con un UPDATE condicional.
+    """
+    increment(session, "status:PENDING", -1)
+    increment(session, "status:PROCESSING")
+
+
+def record_requeue(session: Session, count: int) -> None:
+    """
+    Registra `count` transiciones PROCESSING -> PENDING de tareas con el lease vencido.
+    """
+    if not count:
+        return
+    increment(session, "status:PROCESSING", -count)
+    increment(session, "status:PENDING", count)
+    increment(session, "tasks:requeued", count)
+
+
+def record_pages_removed(session: Session, blank: int, duplicate: int) -> None:
+    """
+    Acumula las páginas descartadas por el filtro previo de páginas en blanco y duplicadas.
+    """
+    if blank:
+        increment(session, "pages:blank_removed", blank)
+    if duplicate:
+        increment(session, "pages:duplicate_removed", duplicate)
+
+
+def record_near_duplicate(session: Session, reused: bool) -> None:
+    """
+    Cuenta una factura casi duplicada de otra ya extraída (marcada o con el resultado reutilizado).
+    """
+    increment(session, "near_duplicates:reused" if reused else "near_duplicates:flagged")
+
+
+def record_supplier_template(session: Session, outcome: str) -> None:
+    """
+    Cuenta el resultado de un intento de extracción con plantilla de proveedor: hit,
+    shadow_hit (confianza suficiente pero se llama igualmente a Gemini), low_confidence,
+    no_template, audit_agreed o audit_mismatch.
+    """
+    increment(session, f"supplier_templates:{outcome}")
+
+
+def get_counters(session: Session) -> Dict[str, int]:
+    """
+    Devuelve todos los contadores (tabla pequeña, coste constante).
+    """
+    return {counter.name: counter.value for counter in session.exec(select(StatsCounter))}
+
+
+def get_daily_rollups(session: Session, days: int = 30, user_identifier: Optional[str] = None) -> list:
+    """
+    Resumen diario de los últimos `days` días, opcionalmente para un usuario.
+    """
+    since = date.today() - timedelta(days=days - 1)
+    statement = select(DailyUsageRollup).where(DailyUsageRollup.day >= since)
+    if user_identifier:
+        statement = statement.where(DailyUsageRollup.user_identifier == user_identifier)
+    statement = statement.order_by(DailyUsageRollup.day.desc(), DailyUsageRollup.user_identifier)
+
+    return [
+        {
+            "day": rollup.day.isoformat(),
+            "user_identifier": rollup.user_identifier,
+            "tasks": rollup.tasks,
+            "completed": rollup.completed,
+            "failed": rollup.failed,
+            "cache_hits": rollup.cache_hits,
+            "total_tokens": rollup.total_tokens,
+            "mean_latency_ms": round(rollup.latency_ms_sum / rollup.latency_count) if rollup.latency_count else None,
+        }
+        for rollup in session.exec(statement)
+    ]
+
+
+def ensure_initialized(session: Session) -> None:
+    """
+    Reconstruye las estadísticas la primera vez que se arranca sobre una base de datos
+    creada antes de que existieran los contadores.
+    """
+    if session.get(StatsCounter, INITIALIZED_COUNTER) is None:
+        rebuild(session)
+
+
+def rebuild(session: Session) -> None:
+    """
+    Recalcula contadores y resúmenes diarios recorriendo ApiTrackingLog una sola vez.
+    Pensado para ejecutarse una vez (migración) o tras una corrección manual de datos.
+    """
+    counters: Dict[str, int] = {f"status:{status}": 0 for status in STATUSES}
+    counters["tasks:total"] = 0
+    counters["tokens:total"] = 0
+    counters["pages:blank_removed"] = 0
+    counters["pages:duplicate_removed"] = 0
+    counters["near_duplicates:flagged"] = 0
+    counters["near_duplicates:reused"] = 0
+    rollups: Dict[tuple, dict] = {}
+
+    statement = select(
+        ApiTrackingLog.user_identifier,
+        ApiTrackingLog.status,
+        ApiTrackingLog.request_utc_timestamp,
+        ApiTrackingLog.completion_utc_timestamp,
+        ApiTrackingLog.total_tokens,
+        ApiTrackingLog.cache_hit,
+        ApiTrackingLog.blank_pages_removed,
+        ApiTrackingLog.duplicate_pages_removed,
+        ApiTrackingLog.near_duplicate_of,
+        ApiTrackingLog.processing_path,
+    ).execution_options(yield_per=1000)
+
+    for row in session.exec(statement):
+        counters[f"status:{row.status}"] = counters.get(f"status:{row.status}", 0) + 1
+        counters["tasks:total"] += 1
+        counters["pages:blank_removed"] += row.blank_pages_removed or 0
+        counters["pages:duplicate_removed"] += row.duplicate_pages_removed or 0
+        if row.near_duplicate_of is not None:
+            reused = row.processing_path == NEAR_DUPLICATE_PATH
+            counters["near_duplicates:reused" if reused else "near_duplicates:flagged"] += 1
+        _accumulate(rollups, row.request_utc_timestamp.date(), row.user_identifier, tasks=1)
+
+        if row.status in TERMINAL_STATUSES:
+            counters["tokens:total"] += row.total_tokens or 0
+            day = (row.completion_utc_timestamp or row.request_utc_timestamp).date()
+            _accumulate(rollups, day, row.user_identifier, **_terminal_values(
+                row.status, row.total_tokens, row.cache_hit,
+                row.request_utc_timestamp, row.completion_utc_timestamp
+            ))
+
+    session.execute(delete(DailyUsageRollup))
+    session.execute(delete(StatsCounter).where(StatsCounter.name.like("status:%")))
+    session.execute(delete(StatsCounter).where(StatsCounter.name.like("pages:%")))
+    session.execute(delete(StatsCounter).where(StatsCounter.name.like("near_duplicates:%")))
+    session.execute(delete(StatsCounter).where(StatsCounter.name.in_(["tasks:total", "tokens:total"])))
+    for name, value in counters.items():
+        session.add(StatsCounter(name=name, value=value))
+    for (day, user_identifier), values in rollups.items():
+        session.add(DailyUsageRollup(day=day, user_identifier=user_identifier, **values))
+
+    session.merge(StatsCounter(name=INITIALIZED_COUNTER, value=1))
+    session.commit()
+
+
+def _record_terminal(session: Session, log_entry: ApiTrackingLog) -> None:
+    completed_at = log_entry.completion_utc_timestamp or datetime.utcnow()
+    increment(session, "tokens:total", log_entry.total_tokens or 0)
+    _add_rollup(session, completed_at.date(), log_entry.user_identifier, **_terminal_values(
+        log_entry.status, log_entry.total_tokens, log_entry.cache_hit,
+        log_entry.request_utc_timestamp, completed_at
+    ))
+
+
+def _terminal_values(status: str, total_tokens: Optional[int], cache_hit: bool,
+                     requested_at: datetime, completed_at: Optional[datetime]) -> dict:
+    values = {
+        "completed": 1 if status == "COMPLETED" else 0,
+        "failed": 1 if status == "FAILED" else 0,
+        "cache_hits": 1 if cache_hit else 0,
+        "total_tokens": total_tokens or 0,
+        "latency_ms_sum": 0,
+        "latency_count": 0,
+    }
+    if completed_at and requested_at:
+        values["latency_ms_sum"] = int((completed_at - requested_at).total_seconds() * 1000)
+        values["latency_count"] = 1
+    return values
+
+
+def _accumulate(rollups: Dict[tuple, dict], day: date, user_identifier: str, **values) -> None:
+    totals = rollups.setdefault((day, user_identifier), {})
+    for field, value in values.items():
+        totals[field] = totals.get(field, 0) + value
+
+
+def _add_rollup(session: Session, day: date, user_identifier: str, **values) -> None:
+    _upsert_add(session, DailyUsageRollup, {"day": day, "user_identifier": user_identifier}, values)
+
+
+def _upsert_add(session: Session, model, keys: dict, increments: dict) -> None:
+    """
+    Suma `increments` a la fila identificada por `keys`, creándola si no existe.
+    Usa INSERT ... ON CONFLICT DO UPDATE en SQLite y PostgreSQL.
+    """
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table).values(**keys, **increments)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={field: table.c[field] + statement.excluded[field] for field in increments}
+        )
+        session.execute(statement)
+        return
+
+    # Otros motores: UPDATE y, si no existía la fila, INSERT
+    conditions = [table.c[field] == value for field, value in keys.items()]
+    result = session.execute(
+        update(table).where(*conditions).values(
+            **{field: table.c[field] + value for field, value in increments.items()}
+        )
+    )
+    if result.rowcount == 0:
+        session.execute(table.insert().values(**keys, **increments))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] != "rebuild":
+        print("Uso: python stats.py rebuild")
+        sys.exit(1)
+
+    from database import engine, create_db_and_tables
+    create_db_and_tables()
+    with Session(engine) as session:
+        rebuild(session)
+        print("Estadísticas reconstruidas:")
+        for name, value in sorted(get_counters(session).items()):
+            print(f"  {name}: {value}")
@@ -0,0 +1,150 @@
+# status_cache.py
+"""
+Caché LRU en memoria de las respuestas de /api/v1/invoices/status/{task_id} de
+tareas terminadas.
+
+Una tarea COMPLETED o FAILED ya no cambia, así que su respuesta se renderiza una
+vez y se sirve desde memoria en las consultas siguientes, sin tocar la base de
+datos. Cada respuesta lleva un ETag: si el cliente lo envía en If-None-Match, se
+responde 304 sin cuerpo. La caché está acotada por número de entradas y por bytes.
+"""
+
+import hashlib
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+from sqlmodel import Session, select
+from config import settings
+from database import engine
+from json_response import dumps
+from models import ApiTrackingLog, TaskResult
+import task_results
+
+TERMINAL_STATUSES = ("COMPLETED", "FAILED")
+
+
+def build_status(log_entry: ApiTrackingLog, result: Optional[TaskResult]) -> dict:
+    """Respuesta de /status para una fila de ApiTrackingLog y su TaskResult (si ya lo hay)."""
+    response = {
+        "task_id": log_entry.task_id,
+        "status": log_entry.status,
+        "filename": log_entry.filename,
+        "user_identifier": log_entry.user_identifier,
+        "batch_id": log_entry.batch_id,
+        "cache_hit": log_entry.cache_hit,
+        "processing_path": log_entry.processing_path,
+        "attempts": log_entry.attempts,
+        "pages": {
+            "total": log_entry.page_count,
+            "blank_removed": log_entry.blank_pages_removed,
+            "duplicate_removed": log_entry.duplicate_pages_removed
+        } if log_entry.page_count is not None else None,
+        "near_duplicate": {
+            "task_id": log_entry.near_duplicate_of,
+            "distance": log_entry.near_duplicate_distance
+        } if log_entry.near_duplicate_of is not None else None,
+        "created_at": log_entry.request_utc_timestamp.isoformat(),
+        "completed_at": log_entry.completion_utc_timestamp.isoformat() if log_entry.completion_utc_timestamp else None
+    }
+
+    # El resultado vive en TaskResult y solo se lee cuando la tarea ha terminado
+    if log_entry.status == "COMPLETED":
+        if result and result.result_data:
+            response["data"] = task_results.result_content(result.result_data, result.normalized)
+        # Agregar información de tokens si está disponible
+        if log_entry.total_tokens:
+            response["tokens_used"] = log_entry.total_tokens
+    elif log_entry.status == "FAILED":
+        response["error"] = result.error_message if result else None
+    return response
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+class StatusResponseCache:
+    """
+    LRU de cuerpos JSON ya codificados (y su ETag) por task_id. Solo admite tareas
+    terminadas; cada proceso tiene la suya.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[uuid.UUID, Tuple[bytes, str]]" = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, task_id: uuid.UUID) -> Optional[Tuple[bytes, str]]:
+        """Devuelve (cuerpo, ETag) y lo marca como usado recientemente."""
+        entry = self._entries.get(task_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(task_id)
+        self.hits += 1
+        return entry
+
+    def put(self, task_id: uuid.UUID, body: bytes) -> Tuple[bytes, str]:
+        """Guarda una respuesta terminal y expulsa las menos usadas si se superan los límites."""
+        entry = (body, make_etag(body))
+        if not self.enabled or len(body) > self.max_bytes:
+            return entry
+        previous = self._entries.pop(task_id, None)
+        if previous is not None:
+            self.size_bytes -= len(previous[0])
+        self._entries[task_id] = entry
+        self.size_bytes += len(body)
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            _, (evicted_body, _) = self._entries.popitem(last=False)
+            self.size_bytes -= len(evicted_body)
+        return entry
+
+    def render(self, log_entry: ApiTrackingLog, result: Optional[TaskResult]) -> Tuple[bytes, Optional[str]]:
+        """
+        Codifica la respuesta de /status. Si la tarea ha terminado, la guarda en la
+        caché y devuelve también su ETag.
+        """
+        body = dumps(build_status(log_entry, result))
+        if log_entry.status not in TERMINAL_STATUSES:
+            return body, None
+        return self.put(log_entry.task_id, body)
+
+    def warm(self, task_id: uuid.UUID) -> None:
+        """
+        Renderiza y guarda la respuesta de una tarea recién terminada, para que la
+        primera consulta del cliente ya no lea la base de datos.
+        """
+        if not self.enabled:
+            return
+        with Session(engine) as session:
+            log_entry = session.exec(select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)).first()
+            if log_entry is None or log_entry.status not in TERMINAL_STATUSES:
+                return
+            self.render(log_entry, session.get(TaskResult, task_id))
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "not_modified": self.not_modified,
+        }
+
+
+# Instancia global de la caché de respuestas de estado
+status_cache = StatusResponseCache(
+    settings.status_cache_max_entries,
+    settings.status_cache_max_mb * 1024 * 1024,
+)
@@ -0,0 +1,646 @@
+# supplier_templates.py
+"""
+Plantillas de proveedor: extracción local de facturas recurrentes sin llamar a Gemini.
+
+Muchos proveedores envían cada mes PDFs nativos (con capa de texto) con la misma
+maquetación. Por cada issuer_tax_id se aprende una plantilla a partir de las
+extracciones COMPLETED de Gemini y de las palabras de la capa de texto (PyMuPDF):
+
+- Cada campo se localiza por su etiqueta en la misma línea («Nº factura:»), por la
+  etiqueta de la línea de encima o, si no la hay, por su posición en la página. El
+  valor se lee según su tipo: importe con el separador decimal del proveedor, fecha
+  con su formato, código (número de factura, NIF) o texto.
+- Las líneas de factura se leen bajo la cabecera de la tabla, mientras cada línea
+  termine con las columnas numéricas en el orden aprendido.
+
+Cada nueva extracción de Gemini del mismo proveedor verifica la plantilla: una regla
+que reproduce el valor de Gemini suma una verificación; si no, se vuelve a aprender
+de esa factura y su cuenta empieza de cero. La confianza de una extracción local es
+la fracción de campos cuya regla tiene SUPPLIER_TEMPLATE_MIN_VERIFIED verificaciones
+y ha encontrado su valor; es 0 si falta un campo obligatorio o los importes no cuadran.
+"""
+
+import asyncio
+import json
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import func, update
+from sqlmodel import Session, select
+from config import settings
+from models import SupplierTemplate
+
+# Campos de la factura (ver promp.txt) y tipo de valor de cada uno
+FIELD_KINDS = {
+    "invoice_id": "code",
+    "issuer_name": "text",
+    "issuer_tax_id": "code",
+    "recipient_name": "text",
+    "recipient_tax_id": "code",
+    "issue_date": "date",
+    "due_date": "date",
+    "total_amount": "amount",
+    "tax_amount": "amount",
+    "currency": "text",
+}
+REQUIRED_FIELDS = ("invoice_id", "issue_date", "total_amount")
+LINE_ITEM_NUMBERS = ("quantity", "unit_price", "total_price")
+
+DATE_FORMATS = ["%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y-%m-%d", "%Y/%m/%d", "%d/%m/%y", "%d-%m-%y"]
+AMOUNT_PATTERN = re.compile(r"^-?(?:\d{1,3}(?:[.,']\d{3})+|\d+)(?:[.,]\d{1,4})?$")
+STRIP_CHARS = " :;()[]€$£%"
+
+LINE_TOLERANCE_PT = 3.0   # Palabras con el centro vertical a menos de esta distancia forman una línea
+SEGMENT_GAP = 0.04        # Hueco horizontal (fracción del ancho) que separa columnas de texto
+MAX_ANCHOR_SKIP = 2       # Palabras con dígitos que puede haber entre una etiqueta y su valor
+POSITION_MARGIN = 0.02    # Holgura de las reglas por posición (fracción de la página)
+AMOUNT_TOLERANCE = 0.005
+
+
+# --- Capa de texto --------------------------------------------------------------
+
+def read_layout(pdf_bytes: bytes) -> Optional[dict]:
+    """
+    Líneas de palabras de un PDF nativo: {"page_count", "lines": [{"page", "y", "words"}]},
+    con cada palabra como (x0, x1, texto) y coordenadas normalizadas a 0-1. Devuelve
+    None si alguna página no tiene capa de texto o si el PDF supera
+    SUPPLIER_TEMPLATE_MAX_PAGES. Se ejecuta en el pool de procesos de renderizado.
+    """
+    import fitz  # PyMuPDF
+
+    try:
+        document = fitz.open(stream=pdf_bytes, filetype="pdf")
+    except Exception as e:
+        print(f"No se pudo leer la capa de texto: {e}")
+        return None
+    if len(document) == 0 or len(document) > settings.supplier_template_max_pages:
+        return None
+
+    lines = []
+    for page in document:
+        width, height = page.rect.width or 1.0, page.rect.height or 1.0
+        words = [word for word in page.get_text("words") if word[4].strip()]
+        if sum(len(word[4]) for word in words) < settings.text_layer_min_chars:
+            return None
+        words.sort(key=lambda word: ((word[1] + word[3]) / 2, word[0]))
+        current, current_mid = [], 0.0
+        for x0, y0, x1, y1, text, *_ in words:
+            mid = (y0 + y1) / 2
+            if current and abs(mid - current_mid) > LINE_TOLERANCE_PT:
+                lines.append(_make_line(page.number, current, width, height))
+                current = []
+            if not current:
+                current_mid = mid
+            current.append((x0, mid, x1, text))
+        if current:
+            lines.append(_make_line(page.number, current, width, height))
+    return {"page_count": len(document), "lines": lines}
+
+
+def _make_line(page_number: int, words: list, width: float, height: float) -> dict:
+    words.sort(key=lambda word: word[0])
+    return {
+        "page": page_number,
+        "y": round(sum(word[1] for word in words) / len(words) / height, 4),
+        "words": [(round(x0 / width, 4), round(x1 / width, 4), text) for x0, _mid, x1, text in words],
+    }
+
+
+async def read_layout_async(pdf_bytes: bytes) -> Optional[dict]:
+    """read_layout en el pool de procesos, sin bloquear el event loop."""
+    from convert_toimage import get_render_pool
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_render_pool(), read_layout, pdf_bytes)
+
+
+# --- Lectura y comparación de valores -------------------------------------------
+
+def tax_key(value: Any) -> str:
+    """NIF/CIF/VAT normalizado (solo letras y dígitos, en mayúsculas): clave de la plantilla."""
+    return re.sub(r"[^0-9A-Z]", "", str(value or "").upper())
+
+
+def _clean(text: str) -> str:
+    return text.strip(STRIP_CHARS).rstrip(".,")
+
+
+def _is_label(text: str) -> bool:
+    """Palabra válida para una etiqueta: con letras y sin dígitos (los números cambian de una factura a otra)."""
+    return any(char.isalpha() for char in text) and not any(char.isdigit() for char in text)
+
+
+def _norm_text(value: Any) -> str:
+    return " ".join(str(value).split()).casefold()
+
+
+def parse_amount(text: str, decimal: Optional[str]) -> Optional[float]:
+    """Importe con el separador decimal del proveedor ("," o "."; None lo deduce)."""
+    text = _clean(text)
+    if not AMOUNT_PATTERN.match(text):
+        return None
+    if decimal is None:
+        # Sin separador aprendido: el último separador seguido de 1 o 2 cifras es el decimal
+        match = re.search(r"[.,](\d{1,2})$", text)
+        decimal = text[match.start()] if match else "."
+    thousands = "." if decimal == "," else ","
+    text = text.replace(thousands, "").replace("'", "").replace(decimal, ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _decimal_of(text: str) -> Optional[str]:
+    """Separador decimal de un importe escrito con decimales ("1.210,00" -> ",")."""
+    match = re.search(r"[.,](\d{1,2})$", _clean(text))
+    return _clean(text)[match.start()] if match else None
+
+
+def parse_date(text: str, date_format: str) -> Optional[str]:
+    try:
+        return datetime.strptime(_clean(text), date_format).date().isoformat()
+    except ValueError:
+        return None
+
+
+def _as_number(value: Any) -> Optional[float]:
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def same_value(kind: str, predicted: Any, expected: Any) -> bool:
+    """Compara el valor de la plantilla con el de Gemini según el tipo del campo."""
+    if predicted is None or expected is None:
+        return predicted is None and expected is None
+    if kind == "amount":
+        predicted, expected = _as_number(predicted), _as_number(expected)
+        return predicted is not None and expected is not None and abs(predicted - expected) <= AMOUNT_TOLERANCE
+    if kind == "code":
+        return tax_key(predicted) == tax_key(expected)
+    return _norm_text(predicted) == _norm_text(expected)
+
+
+# --- Aprendizaje ----------------------------------------------------------------
+
+def _learn_decimal(layout: dict, document: dict) -> Optional[str]:
+    """Separador decimal del proveedor, deducido del importe total u otro importe con decimales."""
+    targets = [_as_number(document.get(name)) for name in ("total_amount", "tax_amount")]
+    targets = [value for value in targets if value is not None and not value.is_integer()]
+    for line in layout["lines"]:
+        for _x0, _x1, text in line["words"]:
+            decimal = _decimal_of(text)
+            if decimal and any(abs((parse_amount(text, decimal) or 0) - target) <= AMOUNT_TOLERANCE
+                               for target in targets):
+                return decimal
+    return None
+
+
+def _locate(layout: dict, kind: str, value: Any, decimal: Optional[str]) -> Optional[dict]:
+    """
+    Busca el valor en la capa de texto. Devuelve {"line", "start", "end", "format"} de
+    la aparición preferida: la precedida por una etiqueta y, entre ellas, la última.
+    """
+    value_words = str(value).split()
+    found = []
+    for line_index, line in enumerate(layout["lines"]):
+        texts = [text for _x0, _x1, text in line["words"]]
+        for start, text in enumerate(texts):
+            match = None
+            if kind == "amount":
+                parsed = parse_amount(text, decimal)
+                if parsed is not None and abs(parsed - float(value)) <= AMOUNT_TOLERANCE:
+                    match = {"end": start + 1, "format": None}
+            elif kind == "date":
+                for date_format in DATE_FORMATS:
+                    if parse_date(text, date_format) == value:
+                        match = {"end": start + 1, "format": date_format}
+                        break
+            elif kind == "code":
+                if tax_key(text) and tax_key(text) == tax_key(value):
+                    match = {"end": start + 1, "format": "raw" if _clean(text) == str(value) else "key"}
+            else:
+                end = start + len(value_words)
+                if value_words and _norm_text(" ".join(texts[start:end])).rstrip(".,:;") == _norm_text(value).rstrip(".,:;"):
+                    match = {"end": end, "format": None}
+            if match:
+                labelled = start > 0 and _is_label(texts[start - 1])
+                found.append((labelled, line_index, {"line": line_index, "start": start, **match}))
+    if not found:
+        return None
+    labelled = [item for item in found if item[0]]
+    return (labelled or found)[-1][2]
+
+
+def _learn_field(layout: dict, name: str, value: Any, decimal: Optional[str]) -> dict:
+    """Regla de un campo aprendida de una factura: etiqueta, posición, constante o nulo."""
+    kind = FIELD_KINDS[name]
+    if value is None or value == "":
+        return {"type": "null", "verified": 0}
+    if kind == "amount" and _as_number(value) is None:
+        return {"type": "constant", "value": value, "verified": 0}
+    location = _locate(layout, kind, _as_number(value) if kind == "amount" else value, decimal)
+    if location is None:
+        # Campos que no aparecen como tales (p. ej. la moneda): valor fijo del proveedor
+        return {"type": "constant", "value": value, "verified": 0}
+
+    lines = layout["lines"]
+    line = lines[location["line"]]
+    words = line["words"]
+    start, end = location["start"], location["end"]
+    rule = {
+        "type": "located",
+        "kind": kind,
+        "format": location["format"],
+        "page": line["page"],
+        "box": [words[start][0], line["y"], words[end - 1][1]],
+        "verified": 0,
+    }
+
+    # Etiqueta en la misma línea: hasta 3 palabras con letras y sin dígitos antes del
+    # valor, sin saltar a otra columna («Nº factura:»). Las palabras con dígitos no
+    # forman parte de la etiqueta porque cambian de una factura a otra; las que hay
+    # entre la etiqueta y el valor («IVA 21%») solo se cuentan (skip)
+    anchor = []
+    skip = 0
+    index = start - 1
+    while index >= 0 and len(anchor) < 3:
+        if index + 1 < start and words[index + 1][0] - words[index][1] > SEGMENT_GAP:
+            break
+        if _is_label(words[index][2]):
+            anchor.insert(0, _norm_text(words[index][2]))
+        elif anchor or skip == MAX_ANCHOR_SKIP:
+            break
+        else:
+            skip += 1
+        index -= 1
+    if anchor:
+        rule.update(relation="left", anchor=anchor)
+        if skip:
+            rule["skip"] = skip
+        return rule
+
+    # Etiqueta encima del valor: palabras de la línea anterior que se solapan en horizontal
+    previous = lines[location["line"] - 1] if location["line"] > 0 else None
+    if previous is not None and previous["page"] == line["page"]:
+        x0, x1 = words[start][0], words[end - 1][1]
+        above = []
+        for wx0, wx1, text in previous["words"]:
+            if wx1 < x0 - POSITION_MARGIN or wx0 > x1 + POSITION_MARGIN:
+                continue
+            if not _is_label(text) or len(above) == 3:
+                break
+            above.append(text)
+        if above:
+            rule.update(relation="above", anchor=[_norm_text(text) for text in above])
+    return rule
+
+
+def _row_numbers(words: list, decimal: Optional[str]) -> Tuple[int, List[float]]:
+    """Columnas numéricas al final de una línea: (índice de la primera, valores)."""
+    values = []
+    index = len(words)
+    while index > 0:
+        text = words[index - 1][2]
+        if not _clean(text) and text.strip() in ("€", "$", "£", "%"):
+            index -= 1
+            continue
+        parsed = parse_amount(text, decimal)
+        if parsed is None:
+            break
+        values.insert(0, parsed)
+        index -= 1
+    return index, values
+
+
+def _learn_line_items(layout: dict, items: Any, decimal: Optional[str]) -> dict:
+    """
+    Regla de la tabla de conceptos: texto de la cabecera y orden de las columnas
+    numéricas. Solo se aprende si cada concepto de Gemini aparece en una línea propia,
+    consecutiva y con las mismas columnas.
+    """
+    if not items:
+        return {"type": "empty", "verified": 0}
+    if not isinstance(items, list):
+        return {"type": "unknown", "verified": 0}
+
+    lines = layout["lines"]
+    columns = None
+    first_line = previous_line = None
+    for item in items:
+        if not isinstance(item, dict):
+            return {"type": "unknown", "verified": 0}
+        total = _as_number(item.get("total_price"))
+        row = None
+        start_at = 0 if previous_line is None else previous_line + 1
+        for line_index in range(start_at, len(lines)):
+            first_number, values = _row_numbers(lines[line_index]["words"], decimal)
+            if total is not None and values and first_number > 0 and abs(values[-1] - total) <= AMOUNT_TOLERANCE:
+                row = (line_index, values)
+                break
+        if row is None or (previous_line is not None and row[0] != previous_line + 1):
+            return {"type": "unknown", "verified": 0}
+        line_index, values = row
+        row_columns = []
+        for number in values:
+            name = next((name for name in LINE_ITEM_NUMBERS
+                         if name not in row_columns and _as_number(item.get(name)) is not None
+                         and abs(_as_number(item.get(name)) - number) <= AMOUNT_TOLERANCE), None)
+            row_columns.append(name)
+        if columns is not None and row_columns != columns:
+            return {"type": "unknown", "verified": 0}
+        columns = row_columns
+        first_line = line_index if first_line is None else first_line
+        previous_line = line_index
+
+    header = lines[first_line - 1] if first_line > 0 else None
+    if header is None or header["page"] != lines[first_line]["page"]:
+        return {"type": "unknown", "verified": 0}
+    return {
+        "type": "table",
+        "header": _norm_text(" ".join(text for _x0, _x1, text in header["words"])),
+        "columns": columns,
+        "verified": 0,
+    }
+
+
+# --- Extracción -----------------------------------------------------------------
+
+def _find_anchor(words: list, anchor: List[str]) -> Optional[int]:
+    texts = [_norm_text(text) for _x0, _x1, text in words]
+    for index in range(len(texts) - len(anchor) + 1):
+        if texts[index:index + len(anchor)] == anchor:
+            return index
+    return None
+
+
+def _read_value(words: list, rule: dict, decimal: Optional[str]) -> Any:
+    """Lee el valor desde la primera palabra de `words` según el tipo de la regla."""
+    words = [word for word in words if _clean(word[2]) or word[2].strip() not in STRIP_CHARS]
+    if not words:
+        return None
+    kind, text = rule["kind"], words[0][2]
+    if kind == "amount":
+        return parse_amount(text, decimal)
+    if kind == "date":
+        return parse_date(text, rule["format"])
+    if kind == "code":
+        value = _clean(text)
+        if not any(char.isdigit() for char in value):
+            return None
+        return tax_key(value) if rule["format"] == "key" else value
+    # Texto: hasta el siguiente hueco de columna
+    segment = [words[0]]
+    for word in words[1:]:
+        if word[0] - segment[-1][1] > SEGMENT_GAP:
+            break
+        segment.append(word)
+    return " ".join(text for _x0, _x1, text in segment).strip(" :;")
+
+
+def _apply_field(layout: dict, rule: dict, decimal: Optional[str]) -> Tuple[Any, bool]:
+    """Aplica la regla de un campo: (valor, encontrado)."""
+    if rule["type"] == "null":
+        return None, True
+    if rule["type"] == "constant":
+        return rule["value"], True
+
+    lines = layout["lines"]
+    anchor = rule.get("anchor")
+    if anchor:
+        for line_index, line in enumerate(lines):
+            position = _find_anchor(line["words"], anchor)
+            if position is None:
+                continue
+            if rule["relation"] == "left":
+                candidates = line["words"][position + len(anchor) + rule.get("skip", 0):]
+            else:
+                below = lines[line_index + 1] if line_index + 1 < len(lines) else None
+                if below is None or below["page"] != line["page"]:
+                    continue
+                x0, x1 = line["words"][position][0], line["words"][position + len(anchor) - 1][1]
+                candidates = [word for word in below["words"]
+                              if word[1] >= x0 - POSITION_MARGIN and word[0] <= x1 + POSITION_MARGIN]
+            value = _read_value(candidates, rule, decimal)
+            if value is not None:
+                return value, True
+
+    # Sin etiqueta (o sin valor junto a ella): la misma posición en la página
+    x0, y, x1 = rule["box"]
+    for line in lines:
+        if line["page"] != rule["page"] or abs(line["y"] - y) > POSITION_MARGIN:
+            continue
+        candidates = [word for word in line["words"] if word[1] >= x0 - POSITION_MARGIN and word[0] <= x1 + POSITION_MARGIN]
+        value = _read_value(candidates, rule, decimal)
+        if value is not None:
+            return value, True
+    return None, False
+
+
+def _apply_line_items(layout: dict, rule: dict, decimal: Optional[str]) -> Tuple[Optional[list], bool]:
+    if rule["type"] == "empty":
+        return [], True
+    if rule["type"] != "table":
+        return None, False
+
+    lines = layout["lines"]
+    columns = rule["columns"]
+    for line_index, line in enumerate(lines):
+        if _norm_text(" ".join(text for _x0, _x1, text in line["words"])) != rule["header"]:
+            continue
+        items = []
+        for row in lines[line_index + 1:]:
+            if row["page"] != line["page"]:
+                break
+            first_number, values = _row_numbers(row["words"], decimal)
+            if first_number == 0 or len(values) != len(columns):
+                break
+            item = {"description": " ".join(text for _x0, _x1, text in row["words"][:first_number]),
+                    "quantity": None, "unit_price": None, "total_price": None}
+            for name, number in zip(columns, values):
+                if name:
+                    item[name] = int(number) if name == "quantity" and number.is_integer() else number
+            items.append(item)
+        if items:
+            return items, True
+    return None, False
+
+
+def _consistent(document: dict) -> bool:
+    """Comprobaciones de la extracción local: campos obligatorios e importes que cuadran."""
+    if any(document.get(name) in (None, "") for name in REQUIRED_FIELDS):
+        return False
+    total = _as_number(document.get("total_amount"))
+    tax = _as_number(document.get("tax_amount")) or 0.0
+    if total is None or tax > total + AMOUNT_TOLERANCE:
+        return False
+    prices = [_as_number(item.get("total_price")) for item in document.get("line_items") or []]
+    if prices and all(price is not None for price in prices):
+        tolerance = 0.01 * len(prices) + AMOUNT_TOLERANCE
+        if abs(sum(prices) - (total - tax)) > tolerance and abs(sum(prices) - total) > tolerance:
+            return False
+    return True
+
+
+def apply_rules(layout: dict, rules: dict) -> Tuple[dict, Dict[str, bool]]:
+    """Aplica todas las reglas: (documento en el esquema de promp.txt, encontrado por campo)."""
+    decimal = rules.get("decimal")
+    document, found = {}, {}
+    for name in FIELD_KINDS:
+        document[name], found[name] = _apply_field(layout, rules["fields"][name], decimal)
+    document["line_items"], found["line_items"] = _apply_line_items(layout, rules["line_items"], decimal)
+    return document, found
+
+
+def _all_rules(rules: dict) -> Dict[str, dict]:
+    return {**rules["fields"], "line_items": rules["line_items"]}
+
+
+def confidence(rules: dict, document: dict, found: Dict[str, bool]) -> float:
+    """Fracción de reglas verificadas que han encontrado su valor; 0 si la factura no cuadra."""
+    if not _consistent(document):
+        return 0.0
+    all_rules = _all_rules(rules)
+    trusted = sum(1 for name, rule in all_rules.items()
+                  if found[name] and rule["verified"] >= settings.supplier_template_min_verified)
+    return trusted / len(all_rules)
+
+
+def _candidate_keys(layout: dict) -> List[str]:
+    """Palabras (o pares de palabras) con forma de NIF/CIF/VAT."""
+    keys = set()
+    for line in layout["lines"]:
+        texts = [text for _x0, _x1, text in line["words"]]
+        for index, text in enumerate(texts):
+            for candidate in (text, "".join(texts[index:index + 2])):
+                key = tax_key(candidate)
+                if 6 <= len(key) <= 16 and sum(char.isdigit() for char in key) >= 5:
+                    keys.add(key)
+    return list(keys)[:1000]
+
+
+def predict(session: Session, layout: dict) -> Optional[dict]:
+    """
+    Busca la plantilla del emisor (cualquier NIF de la factura con plantilla; si hay
+    varias, la más entrenada) y la aplica. Devuelve {"template_id", "issuer_tax_id",
+    "document", "confidence"} o None si ningún proveedor conocido aparece en la factura.
+    """
+    keys = _candidate_keys(layout)
+    if not keys:
+        return None
+    template = session.exec(
+        select(SupplierTemplate)
+        .where(SupplierTemplate.issuer_tax_id.in_(keys))
+        .order_by(SupplierTemplate.samples.desc())
+    ).first()
+    if template is None:
+        return None
+    rules = json.loads(template.rules)
+    document, found = apply_rules(layout, rules)
+    score = confidence(rules, document, found)
+    if tax_key(document.get("issuer_tax_id")) != template.issuer_tax_id:
+        score = 0.0
+    return {
+        "template_id": template.id,
+        "issuer_tax_id": template.issuer_tax_id,
+        "document": document,
+        "confidence": round(score, 4),
+    }
+
+
+def record_hit(session: Session, template_id: int) -> None:
+    """Cuenta una factura extraída con la plantilla (UPDATE atómico)."""
+    session.execute(
+        update(SupplierTemplate)
+        .where(SupplierTemplate.id == template_id)
+        .values(hits=SupplierTemplate.hits + 1)
+    )
+
+
+def learn(session: Session, layout: dict, json_text: str) -> Optional[bool]:
+    """
+    Aprende o verifica la plantilla del emisor con una extracción COMPLETED de Gemini.
+    Las reglas que reproducen el valor de Gemini suman una verificación; las demás se
+    vuelven a aprender de esta factura. Devuelve True si todas coincidían, False si
+    alguna no, y None si no había plantilla o la extracción no sirve para aprender.
+    """
+    try:
+        document = json.loads(json_text)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(document, dict) or "error" in document:
+        return None
+    key = tax_key(document.get("issuer_tax_id"))
+    if len(key) < 6:
+        return None
+
+    template = session.exec(select(SupplierTemplate).where(SupplierTemplate.issuer_tax_id == key)).first()
+    if template is None:
+        template = SupplierTemplate(issuer_tax_id=key, rules="{}")
+        rules = {"decimal": None, "fields": {}, "line_items": {"type": "unknown", "verified": 0}}
+        predicted = found = None
+    else:
+        rules = json.loads(template.rules)
+        predicted, found = apply_rules(layout, rules)
+
+    rules["decimal"] = _learn_decimal(layout, document) or rules.get("decimal")
+    agreed = predicted is not None
+    for name, kind in FIELD_KINDS.items():
+        rule = rules["fields"].get(name)
+        if rule is not None and found[name] and same_value(kind, predicted[name], document.get(name)):
+            rule["verified"] += 1
+        else:
+            rules["fields"][name] = _learn_field(layout, name, document.get(name), rules["decimal"])
+            agreed = False
+
+    if predicted is not None and found["line_items"] and _same_line_items(predicted["line_items"], document.get("line_items")):
+        rules["line_items"]["verified"] += 1
+    else:
+        rules["line_items"] = _learn_line_items(layout, document.get("line_items"), rules["decimal"])
+        agreed = False
+
+    template.issuer_name = document.get("issuer_name") or template.issuer_name
+    template.rules = json.dumps(rules, ensure_ascii=False)
+    template.samples += 1
+    template.updated_utc_timestamp = datetime.utcnow()
+    session.add(template)
+    session.commit()
+    return agreed if predicted is not None else None
+
+
+def _same_line_items(predicted: Optional[list], expected: Any) -> bool:
+    expected = expected or []
+    if predicted is None or not isinstance(expected, list) or len(predicted) != len(expected):
+        return False
+    for item, reference in zip(predicted, expected):
+        if not isinstance(reference, dict) or not same_value("text", item["description"], reference.get("description")):
+            return False
+        if any(not same_value("amount", item[name], reference.get(name)) for name in LINE_ITEM_NUMBERS):
+            return False
+    return True
+
+
+def get_stats(session: Session, counters: Dict[str, int]) -> dict:
+    """Plantillas aprendidas y resultado de cada intento de extracción local."""
+    templates, samples = session.exec(
+        select(func.count(SupplierTemplate.id), func.coalesce(func.sum(SupplierTemplate.samples), 0))
+    ).one()
+    hits = counters.get("supplier_templates:hit", 0)
+    shadow_hits = counters.get("supplier_templates:shadow_hit", 0)
+    attempts = (hits + shadow_hits + counters.get("supplier_templates:low_confidence", 0)
+                + counters.get("supplier_templates:no_template", 0))
+    return {
+        "mode": settings.supplier_template_mode,
+        "templates": templates,
+        "learned_samples": samples,
+        "hits": hits,
+        "shadow_hits": shadow_hits,
+        "low_confidence": counters.get("supplier_templates:low_confidence", 0),
+        "no_template": counters.get("supplier_templates:no_template", 0),
+        "hit_rate": round((hits + shadow_hits) / attempts, 4) if attempts else 0.0,
+        "audits_agreed": counters.get("supplier_templates:audit_agreed", 0),
+        "audits_mismatched": counters.get("supplier_templates:audit_mismatch", 0),
+    }
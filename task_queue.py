@@ -0,0 +1,345 @@
+# task_queue.py
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import update
+from sqlmodel import Session, select
+from models import ApiTrackingLog
+from database import engine
+from background_processor import process_invoice_task, load_owned_task
+from file_storage import read_upload, delete_upload
+from config import settings
+from events import hub
+from admission import admission
+from status_cache import status_cache
+import stats
+import task_results
+
+
+class TaskDispatcher:
+    """
+    Despachador de tareas persistente.
+
+    Reclama filas PENDING de ApiTrackingLog y las ejecuta en un conjunto
+    acotado de workers asíncronos (MAX_CONCURRENT_TASKS). Como la cola vive en
+    la base de datos, las tareas pendientes sobreviven a un reinicio.
+
+    Cada tarea reclamada lleva un lease que el despachador renueva mientras la
+    procesa. Si el proceso muere, el lease vence y cualquier despachador la
+    devuelve a PENDING (o la marca FAILED si agotó TASK_MAX_ATTEMPTS).
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, max_workers)
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._wakeup = asyncio.Event()
+        self._running = False
+        self._poller: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._active: Dict[asyncio.Task, uuid.UUID] = {}
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.processed_count = 0
+        self.requeued_count = 0
+        self._next_reap = datetime.min
+        self.warm_status_cache = False
+
+    async def start(self, warm_status_cache: bool = False) -> None:
+        """
+        Arranca el bucle de reclamación de tareas. Con warm_status_cache, la respuesta
+        de /status de cada tarea terminada se deja en la caché de este proceso.
+        """
+        if self._running:
+            return
+        self.warm_status_cache = warm_status_cache
+        self._running = True
+        self._poller = asyncio.create_task(self._poll_loop())
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        print(f"Despachador de tareas iniciado con {self.max_workers} workers")
+
+    async def stop(self) -> None:
+        """Detiene el despachador y espera a las tareas en curso."""
+        self._running = False
+        self._wakeup.set()
+        if self._poller:
+            await self._poller
+        if self._active:
+            await asyncio.gather(*self._active, return_exceptions=True)
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            try:
+                await self._heartbeat
+            except asyncio.CancelledError:
+                pass
+        print("Despachador de tareas detenido")
+
+    def notify(self) -> None:
+        """Avisa de que hay tareas nuevas para no esperar al siguiente sondeo."""
+        self._wakeup.set()
+
+    @property
+    def busy_workers(self) -> int:
+        return len(self._active)
+
+    def get_stats(self, counters: dict) -> dict:
+        """Profundidad de la cola y utilización de workers."""
+        return {
+            "running": self._running,
+            "queue_depth": counters.get("status:PENDING", 0),
+            "workers_total": self.max_workers,
+            "workers_busy": self.busy_workers,
+            "utilization": round(self.busy_workers / self.max_workers, 4),
+            "processed_since_start": self.processed_count,
+            "requeued_total": counters.get("tasks:requeued", 0),
+            "requeued_since_start": self.requeued_count,
+        }
+
+    async def _poll_loop(self) -> None:
+        # Las consultas síncronas van a un hilo: en el event loop bloquearían las peticiones
+        # HTTP durante toda la espera de la base de datos (busy_timeout de SQLite, SKIP LOCKED)
+        while self._running:
+            if datetime.utcnow() >= self._next_reap:
+                self._next_reap = datetime.utcnow() + timedelta(seconds=settings.reaper_interval_seconds)
+                try:
+                    await asyncio.to_thread(self._reap_expired_leases)
+                except Exception as e:
+                    print(f"ERROR al recuperar tareas con el lease vencido: {e}")
+
+            claimed = 0
+            while self._running and not self._slots.locked():
+                task_id = await asyncio.to_thread(self._claim_next)
+                if task_id is None:
+                    break
+                await self._slots.acquire()
+                worker = asyncio.create_task(self._run(task_id))
+                self._active[worker] = task_id
+                worker.add_done_callback(lambda done: self._active.pop(done, None))
+                claimed += 1
+
+            if self._slots.locked():
+                # Todos los workers ocupados: esperar a que se libere uno
+                await self._slots.acquire()
+                self._slots.release()
+                continue
+
+            if claimed:
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.queue_poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim_next(self) -> Optional[uuid.UUID]:
+        """
+        Reclama la tarea PENDING más antigua con una actualización condicional
+        PENDING -> PROCESSING, de modo que una tarea nunca se reclama dos veces,
+        aunque varios procesos o nodos compartan la misma base de datos.
+        """
+        with Session(engine) as session:
+            if session.get_bind().dialect.name == "postgresql":
+                task_id = self._claim_skip_locked(session)
+                if task_id is not None:
+                    stats.record_claim(session)
+                    session.commit()
+                return task_id
+
+            candidates = session.exec(
+                select(ApiTrackingLog.task_id)
+                .where(ApiTrackingLog.status == "PENDING")
+                .order_by(ApiTrackingLog.request_utc_timestamp)
+                .limit(self.max_workers)
+            ).all()
+            for task_id in candidates:
+                result = session.execute(
+                    update(ApiTrackingLog)
+                    .where(ApiTrackingLog.task_id == task_id, ApiTrackingLog.status == "PENDING")
+                    .values(**self._claim_values())
+                )
+                if result.rowcount == 1:
+                    stats.record_claim(session)
+                    session.commit()
+                    return task_id
+                session.rollback()
+        return None
+
+    def _claim_values(self) -> dict:
+        """Columnas que fija la reclamación: estado, lease de este despachador e intento."""
+        now = datetime.utcnow()
+        return {
+            "status": "PROCESSING",
+            "status_updated_utc_timestamp": now,
+            "lease_owner": self.worker_id,
+            "lease_expires_utc_timestamp": now + timedelta(seconds=settings.task_lease_seconds),
+            "attempts": ApiTrackingLog.attempts + 1,
+        }
+
+    def _claim_skip_locked(self, session: Session) -> Optional[uuid.UUID]:
+        """
+        En PostgreSQL, una sola sentencia: la subconsulta bloquea la fila PENDING más
+        antigua que no esté bloqueada por otro proceso (SKIP LOCKED) y el UPDATE la
+        pasa a PROCESSING. Los procesos concurrentes no esperan ni chocan entre sí.
+        """
+        oldest_pending = (
+            select(ApiTrackingLog.id)
+            .where(ApiTrackingLog.status == "PENDING")
+            .order_by(ApiTrackingLog.request_utc_timestamp, ApiTrackingLog.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        return session.execute(
+            update(ApiTrackingLog)
+            .where(ApiTrackingLog.id == oldest_pending)
+            .values(**self._claim_values())
+            .returning(ApiTrackingLog.task_id)
+        ).scalar_one_or_none()
+
+    async def _run(self, task_id: uuid.UUID) -> None:
+        try:
+            with Session(engine) as session:
+                log_entry = session.exec(
+                    select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)
+                ).first()
+                user_identifier = log_entry.user_identifier
+                filename = log_entry.filename or "unknown"
+                stored_path = log_entry.stored_path
+                render_profile = log_entry.render_profile
+
+            if stored_path is None:
+                # Fila PROCESSING de antes de guardar los archivos en disco: no hay nada que reprocesar
+                self._fail(task_id, "Archivo original no disponible: la tarea no tiene archivo guardado (creada con una versión anterior)",
+                           lease_owner=self.worker_id)
+                return
+
+            try:
+                file_size = os.path.getsize(stored_path)
+            except OSError as e:
+                self._fail(task_id, f"Archivo original no disponible: {e}", lease_owner=self.worker_id)
+                return
+
+            # El archivo se carga en memoria solo cuando cabe en el presupuesto de bytes
+            await admission.acquire_worker_bytes(file_size)
+            try:
+                try:
+                    file_bytes = read_upload(stored_path)
+                except OSError as e:
+                    self._fail(task_id, f"Archivo original no disponible: {e}", lease_owner=self.worker_id)
+                    return
+                finished = await process_invoice_task(task_id, file_bytes, user_identifier, filename,
+                                                      render_profile, lease_owner=self.worker_id)
+            finally:
+                admission.release_worker_bytes(file_size)
+            if not finished:
+                # Otro worker reclamó la tarea tras vencer el lease: el archivo y el estado son suyos
+                return
+            delete_upload(stored_path)
+            self.processed_count += 1
+            if self.warm_status_cache:
+                status_cache.warm(task_id)
+        except Exception as e:
+            print(f"ERROR en el worker para la tarea {task_id}: {e}")
+        finally:
+            self._slots.release()
+
+    async def _heartbeat_loop(self) -> None:
+        """Renueva el lease de las tareas en curso de este despachador."""
+        while True:
+            await asyncio.sleep(settings.task_heartbeat_seconds)
+            task_ids = list(self._active.values())
+            if not task_ids:
+                continue
+            try:
+                renewed = await asyncio.to_thread(self._renew_leases, task_ids)
+                if renewed < len(task_ids):
+                    print(f"AVISO: {len(task_ids) - renewed} tareas en curso ya no tienen el lease de {self.worker_id}")
+            except Exception as e:
+                print(f"ERROR al renovar los leases: {e}")
+
+    def _renew_leases(self, task_ids: List[uuid.UUID]) -> int:
+        """Alarga el lease de las tareas de este despachador que siguen PROCESSING. Devuelve cuántas."""
+        with Session(engine) as session:
+            result = session.execute(
+                update(ApiTrackingLog)
+                .where(
+                    ApiTrackingLog.task_id.in_(task_ids),
+                    ApiTrackingLog.status == "PROCESSING",
+                    ApiTrackingLog.lease_owner == self.worker_id
+                )
+                .values(lease_expires_utc_timestamp=datetime.utcnow() + timedelta(seconds=settings.task_lease_seconds))
+            )
+            session.commit()
+        return result.rowcount
+
+    def _reap_expired_leases(self) -> None:
+        """
+        Devuelve a PENDING las tareas PROCESSING cuyo lease venció (o que no tienen lease,
+        reclamadas por una versión anterior). Las que ya agotaron TASK_MAX_ATTEMPTS se
+        marcan FAILED. El archivo original sigue en disco hasta el estado final.
+        """
+        now = datetime.utcnow()
+        expired = (
+            (ApiTrackingLog.status == "PROCESSING")
+            & ((ApiTrackingLog.lease_expires_utc_timestamp < now) | (ApiTrackingLog.lease_expires_utc_timestamp.is_(None)))
+        )
+        with Session(engine) as session:
+            # Reintento: una sola actualización condicional (otro despachador puede estar recuperando a la vez)
+            requeued = session.execute(
+                update(ApiTrackingLog)
+                .where(expired, ApiTrackingLog.attempts < settings.task_max_attempts)
+                .values(
+                    status="PENDING",
+                    status_updated_utc_timestamp=now,
+                    lease_owner=None,
+                    lease_expires_utc_timestamp=None
+                )
+            ).rowcount or 0
+            stats.record_requeue(session, requeued)
+            session.commit()
+
+            exhausted = session.exec(
+                select(ApiTrackingLog).where(expired, ApiTrackingLog.attempts >= settings.task_max_attempts)
+            ).all()
+
+        if requeued:
+            # El bucle de sondeo reclama justo después de recuperar: no hace falta notify()
+            self.requeued_count += requeued
+            print(f"{requeued} tareas con el lease vencido devueltas a PENDING")
+        for log_entry in exhausted:
+            self._fail(
+                log_entry.task_id,
+                f"Tarea abandonada tras {log_entry.attempts} intentos sin terminar (lease vencido)",
+                only_if_expired=True
+            )
+
+    def _fail(self, task_id: uuid.UUID, message: str, only_if_expired: bool = False,
+              lease_owner: Optional[str] = None) -> None:
+        """
+        Marca la tarea FAILED. Con lease_owner solo si sigue teniendo ese lease; con
+        only_if_expired solo si su lease venció.
+        """
+        print(f"ERROR: Tarea {task_id}: {message}")
+        with Session(engine) as session:
+            log_entry = load_owned_task(session, task_id, lease_owner)
+            if not log_entry:
+                return
+            if only_if_expired and not (
+                log_entry.status == "PROCESSING"
+                and (log_entry.lease_expires_utc_timestamp is None
+                     or log_entry.lease_expires_utc_timestamp < datetime.utcnow())
+            ):
+                return
+            task_results.store_error(session, task_id, message)
+            log_entry.completion_utc_timestamp = datetime.utcnow()
+            stats.set_status(session, log_entry, "FAILED")
+            session.commit()
+            hub.publish_log_entry(log_entry)
+            stored_path = log_entry.stored_path
+        delete_upload(stored_path)
+
+
+# Instancia global del despachador
+dispatcher = TaskDispatcher(settings.max_concurrent_tasks)
@@ -0,0 +1,138 @@
+# task_results.py
+"""
+Resultados de las tareas (JSON extraído o mensaje de error) guardados fuera de
+ApiTrackingLog, en la tabla TaskResult. El JSON se comprime con zlib y solo se lee
+cuando el cliente lo necesita (tarea COMPLETED o FAILED).
+
+Al completar la tarea, la respuesta de Gemini se valida y se normaliza una sola
+vez a JSON compacto; las consultas la sirven sin volver a decodificarla (ver
+json_response.raw_json).
+"""
+
+import json
+import math
+import uuid
+import zlib
+from typing import Any, Optional
+from sqlalchemy import inspect, text
+from sqlmodel import Session
+from models import TaskResult
+from json_response import dumps, raw_json
+
+COMPRESSION_LEVEL = 6
+
+
+def compress_json(json_text: str) -> bytes:
+    return zlib.compress(json_text.encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def decompress_json(data: Optional[bytes]) -> Optional[str]:
+    if data is None:
+        return None
+    return zlib.decompress(data).decode("utf-8")
+
+
+def normalize_json(json_text: str) -> bytes:
+    """
+    Valida la respuesta de Gemini y la devuelve como JSON compacto en UTF-8.
+    Si no es JSON válido se guarda como cadena JSON (lo mismo que devolvía parse_result).
+    NaN, Infinity y los números que no caben en un float (1e400) se guardan como null:
+    el resultado se sirve sin decodificar y esos tokens no son JSON válido para los clientes.
+    """
+
+    def parse_float(value: str) -> Optional[float]:
+        number = float(value)
+        return number if math.isfinite(number) else None
+
+    def parse_constant(value: str) -> None:
+        return None
+
+    try:
+        document = json.loads(json_text, parse_float=parse_float, parse_constant=parse_constant)
+    except json.JSONDecodeError:
+        document = json_text
+    return dumps(document)
+
+
+def store_result(session: Session, task_id: uuid.UUID, json_text: str) -> None:
+    """Guarda, normalizado, el JSON extraído de una tarea COMPLETED."""
+    data = normalize_json(json_text)
+    session.merge(TaskResult(
+        task_id=task_id,
+        result_data=zlib.compress(data, COMPRESSION_LEVEL),
+        result_size_bytes=len(data),
+        normalized=True,
+    ))
+
+
+def store_error(session: Session, task_id: uuid.UUID, message: str) -> None:
+    """Guarda el mensaje de error de una tarea FAILED."""
+    session.merge(TaskResult(task_id=task_id, error_message=message))
+
+
+def parse_result(data: Optional[bytes]) -> Any:
+    """
+    Devuelve el JSON extraído como objeto; si no es JSON válido, como texto.
+    """
+    json_text = decompress_json(data)
+    if json_text is None:
+        return None
+    try:
+        return json.loads(json_text)
+    except json.JSONDecodeError:
+        return json_text
+
+
+def result_content(data: Optional[bytes], normalized: bool) -> Any:
+    """
+    Resultado listo para una FastJSONResponse: los normalizados pasan sin decodificar;
+    los guardados antes de la normalización se decodifican con parse_result.
+    """
+    if data is None:
+        return None
+    if normalized:
+        return raw_json(zlib.decompress(data))
+    return parse_result(data)
+
+
+def migrate_inline_payloads(engine, batch_size: int = 500) -> None:
+    """
+    Migración de bases de datos anteriores: mueve final_json_response y error_message
+    de ApiTrackingLog a TaskResult (comprimidos) y elimina las columnas antiguas.
+    No hace nada si las columnas ya no existen.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table("apitrackinglog"):
+        return
+    columns = {column["name"] for column in inspector.get_columns("apitrackinglog")}
+    if "final_json_response" not in columns:
+        return
+
+    print("Migrando resultados de apitrackinglog a taskresult...")
+    moved = 0
+    last_id = 0
+    with Session(engine) as session:
+        while True:
+            rows = session.execute(text(
+                "SELECT id, task_id, final_json_response, error_message FROM apitrackinglog "
+                "WHERE id > :last_id AND (final_json_response IS NOT NULL OR error_message IS NOT NULL) "
+                "ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": batch_size}).all()
+            if not rows:
+                break
+            for row in rows:
+                # Los UUID se guardan como texto hexadecimal en SQLite y como uuid en PostgreSQL
+                task_id = row.task_id if isinstance(row.task_id, uuid.UUID) else uuid.UUID(str(row.task_id))
+                result = TaskResult(task_id=task_id, error_message=row.error_message)
+                if row.final_json_response is not None:
+                    result.result_data = compress_json(row.final_json_response)
+                    result.result_size_bytes = len(row.final_json_response.encode("utf-8"))
+                session.merge(result)
+            session.commit()
+            moved += len(rows)
+            last_id = rows[-1].id
+
+    with engine.begin() as connection:
+        for column in ("final_json_response", "error_message"):
+            connection.execute(text(f"ALTER TABLE apitrackinglog DROP COLUMN {column}"))
+    print(f"Migración completada: {moved} resultados movidos a taskresult")
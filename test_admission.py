@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Pruebas del control de admisión (admission.py y su middleware en main.py): 413
+por Content-Length, 503 con Retry-After al agotar el presupuesto de tareas o de
+bytes, y liberación de los bytes de un worker cuando la tarea falla. No necesitan
+el servidor (base de datos temporal, ver conftest.py):
+
+    python test_admission.py    (o pytest test_admission.py)
+"""
+
+import asyncio
+import io
+import os
+
+import conftest  # noqa: F401  (entorno de pruebas antes de importar config)
+from fastapi.testclient import TestClient
+from sqlalchemy import update
+from sqlmodel import Session
+
+import stats
+import task_queue
+from admission import admission, AdmissionController, IN_FLIGHT_STATUSES
+from config import settings
+from database import engine, create_db_and_tables
+from file_storage import save_upload
+from main import app
+from models import ApiTrackingLog, StatsCounter
+
+PDF = b"%PDF-1.4\n1 0 obj<<>>endobj\ntrailer<<>>\n%%EOF"
+EXTRACT_URL = "/api/v1/invoices/extract"
+
+create_db_and_tables()
+with Session(engine) as _session:
+    stats.ensure_initialized(_session)
+client = TestClient(app)
+
+
+def _set_in_flight(pending: int) -> None:
+    """Fija los contadores de tareas PENDING + PROCESSING que lee el control de admisión."""
+    with Session(engine) as session:
+        for name in IN_FLIGHT_STATUSES:
+            session.exec(update(StatsCounter).where(StatsCounter.name == name).values(value=0))
+        session.exec(update(StatsCounter).where(StatsCounter.name == "status:PENDING").values(value=pending))
+        session.commit()
+
+
+def _upload(count: int = 1):
+    files = [("files", (f"f{i}.pdf", PDF, "application/pdf")) for i in range(count)]
+    return client.post(EXTRACT_URL, files=files)
+
+
+def _assert_overloaded(response) -> None:
+    assert response.status_code == 503, (response.status_code, response.text)
+    assert response.headers["retry-after"] == str(settings.admission_retry_after_seconds)
+
+
+def test_declared_body_too_large_is_413():
+    """El Content-Length declarado se rechaza antes de leer el cuerpo"""
+    headers = {"content-length": str(10 ** 12), "content-type": "multipart/form-data; boundary=x"}
+    for url in (EXTRACT_URL, "/api/v1/invoices/extract-archive"):
+        response = client.post(url, content=b"x", headers=headers)
+        assert response.status_code == 413, (url, response.status_code, response.text)
+
+
+def test_full_task_budget_is_503_with_retry_after():
+    """Con el presupuesto de tareas agotado, la subida recibe 503 y Retry-After"""
+    _set_in_flight(admission.max_tasks)
+    try:
+        _assert_overloaded(_upload())
+        _assert_overloaded(client.post("/api/v1/invoices/extract-archive", files=[("archive", ("a.zip", b"PK", "application/zip"))]))
+    finally:
+        _set_in_flight(0)
+
+
+def test_batch_that_does_not_fit_is_503():
+    """El endpoint repite la comprobación con el número real de archivos"""
+    _set_in_flight(admission.max_tasks - 1)
+    try:
+        _assert_overloaded(_upload(2))
+        assert admission.upload_bytes == 0
+    finally:
+        _set_in_flight(0)
+
+
+def test_full_byte_budget_is_503_with_retry_after():
+    """Con la memoria de subidas ocupada por otra petición, la nueva recibe 503"""
+    _set_in_flight(0)
+    admission.upload_bytes += admission.max_bytes
+    try:
+        _assert_overloaded(_upload())
+    finally:
+        admission.upload_bytes -= admission.max_bytes
+    assert admission.upload_bytes == 0
+
+
+def test_worker_bytes_released_when_processing_fails():
+    """Los bytes reservados por un worker se devuelven aunque el procesamiento falle"""
+    with Session(engine) as session:
+        log_entry = ApiTrackingLog(user_identifier="test_admission", filename="f.pdf", status="PROCESSING")
+        log_entry.stored_path = save_upload(log_entry.task_id, "f.pdf", io.BytesIO(PDF))
+        session.add(log_entry)
+        session.commit()
+        task_id, stored_path = log_entry.task_id, log_entry.stored_path
+
+    async def failing_process(*args, **kwargs):
+        assert admission.worker_bytes == len(PDF)
+        raise RuntimeError("fallo simulado")
+
+    original = task_queue.process_invoice_task
+    task_queue.process_invoice_task = failing_process
+    try:
+        asyncio.run(task_queue.TaskDispatcher(1)._run(task_id))
+    finally:
+        task_queue.process_invoice_task = original
+        os.remove(stored_path)
+    assert admission.worker_bytes == 0
+
+
+def test_waiting_worker_proceeds_after_release():
+    """Un worker que no cabe espera hasta que otro libera sus bytes"""
+    controller = AdmissionController(max_tasks=0, max_bytes=100)
+
+    async def scenario():
+        await controller.acquire_worker_bytes(80)
+        waiter = asyncio.create_task(controller.acquire_worker_bytes(50))
+        await asyncio.sleep(0.05)
+        assert not waiter.done() and controller.worker_bytes == 80
+        controller.release_worker_bytes(80)
+        await asyncio.wait_for(waiter, timeout=1)
+        assert controller.worker_bytes == 50
+
+    asyncio.run(scenario())
+
+
+def main():
+    tests = [
+        test_declared_body_too_large_is_413,
+        test_full_task_budget_is_503_with_retry_after,
+        test_batch_that_does_not_fit_is_503,
+        test_full_byte_budget_is_503_with_retry_after,
+        test_worker_bytes_released_when_processing_fails,
+        test_waiting_worker_proceeds_after_release,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            print(f"❌ {test.__name__}: {e!r}")
+            failed += 1
+    print(f"📊 {len(tests) - failed}/{len(tests)} pruebas pasadas")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -179,10 +179,21 @@ def test_batch_processing():
                 print(f"✅ Consulta por lotes exitosa")
                 for result in batch_data['results']:
                     print(f"  - Task {str(result['task_id'])[:8]}...: {result['status']}")
-                return True
             else:
                 print(f"❌ Error en consulta por lotes: {batch_response.status_code}")
                 return False
+            
+            # Consultar el lote por su batch_id (sin datos extraídos)
+            batch_id = response.json()['batch_id']
+            batch_response = requests.get(f"{API_BASE_URL}/api/v1/batches/{batch_id}?include_data=false")
+            
+            if batch_response.status_code == 200:
+                progress = batch_response.json()['progress']
+                print(f"✅ Consulta del lote {str(batch_id)[:8]}... exitosa: {progress}")
+                return True
+            else:
+                print(f"❌ Error consultando el lote: {batch_response.status_code}")
+                return False
         else:
             print(f"❌ Error enviando lote: {response.status_code}")
             print(f"📊 Respuesta: {response.text}")
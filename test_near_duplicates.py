@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Pruebas del índice de facturas casi duplicadas (near_duplicates.py). No necesitan
+el servidor: generan una factura, la «escanean» (PDF con la página como JPEG) y la
+«fotografían» (JPEG girado, con perspectiva, luz irregular y fondo), y buscan cada
+versión en una base de datos SQLite en memoria.
+
+    python test_near_duplicates.py    (o pytest test_near_duplicates.py)
+"""
+
+import io
+import uuid
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageEnhance, ImageFilter
+from sqlalchemy import text
+from sqlmodel import Session, SQLModel, create_engine
+
+import near_duplicates
+from models import DocumentFingerprint
+
+
+def _invoice(number: int) -> bytes:
+    """Factura nativa de un proveedor: cabecera, tabla de conceptos y totales."""
+    document = fitz.open()
+    page = document.new_page()
+    page.insert_text((50, 60), "ACME Servicios S.L.", fontsize=14)
+    page.insert_text((50, 80), "CIF: B-12345678")
+    page.insert_text((350, 60), f"Factura Nº: F2024-{number:04d}")
+    page.insert_text((350, 80), "Fecha: 01/03/2024")
+    page.insert_text((50, 140), "Cliente: Global Tech Inc.")
+    y = 200
+    for x, label in ((50, "Descripción"), (300, "Cantidad"), (380, "Precio"), (470, "Importe")):
+        page.insert_text((x, y), label)
+    for row in range(3):
+        y += 18
+        page.insert_text((50, y), f"Servicio mensual {row + number}")
+        page.insert_text((300, y), str(row + 1))
+        page.insert_text((380, y), f"{120 + number * 7 + row:.2f}")
+        page.insert_text((470, y), f"{(row + 1) * (120 + number * 7 + row):.2f}")
+    page.insert_text((380, y + 40), "Total")
+    page.insert_text((470, y + 40), f"{900 + number * 21:.2f} €")
+    page.insert_text((50, 780), "Forma de pago: transferencia bancaria. Gracias por su confianza.")
+    return document.tobytes()
+
+
+def _receipt() -> bytes:
+    """Otro proveedor con otra maquetación: ticket estrecho centrado."""
+    document = fitz.open()
+    page = document.new_page()
+    for row in range(25):
+        page.insert_text((220, 60 + 18 * row), f"Linea {row} ......... {row * 1.5 + 2:.2f}", fontsize=10)
+    page.insert_text((220, 60 + 18 * 27), "TOTAL", fontsize=14)
+    return document.tobytes()
+
+
+def _render(pdf_bytes: bytes, dpi: int) -> Image.Image:
+    pixmap = fitz.open(stream=pdf_bytes, filetype="pdf")[0].get_pixmap(dpi=dpi)
+    return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def _scan(pdf_bytes: bytes) -> bytes:
+    """PDF escaneado: la página como JPEG, algo girada, más oscura y desenfocada, sin capa de texto."""
+    image = _render(pdf_bytes, 200).convert("L").rotate(0.5, resample=Image.BICUBIC, fillcolor=255)
+    image = ImageEnhance.Brightness(image).enhance(0.93).filter(ImageFilter.GaussianBlur(0.6))
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, "JPEG", quality=80)
+    document = fitz.open()
+    page = document.new_page(width=595, height=842)
+    page.insert_image(page.rect, stream=buffer.getvalue())
+    return document.tobytes()
+
+
+def _phone_photo(pdf_bytes: bytes) -> bytes:
+    """Foto con el móvil: papel sobre una mesa, girado 2°, con perspectiva, luz irregular y JPEG de calidad 70."""
+    page = _render(pdf_bytes, 150)
+    width, height = page.size
+    margin = width // 14
+    photo = Image.new("RGB", (width + 2 * margin, height + 2 * margin), (95, 90, 85))
+    photo.paste(page, (margin + 10, margin - 15))
+    photo = photo.rotate(2, resample=Image.BICUBIC, fillcolor=(95, 90, 85))
+    width, height = photo.size
+    photo = photo.transform(photo.size, Image.QUAD, (width // 50, 0, 0, height, width, height, width - width // 100, 0),
+                            Image.BICUBIC)
+    light = Image.linear_gradient("L").resize(photo.size).rotate(30).point(lambda value: 180 + value * 75 // 255)
+    photo = Image.composite(photo, ImageEnhance.Brightness(photo).enhance(0.8), light)
+    photo = photo.filter(ImageFilter.GaussianBlur(1.2)).resize((width * 9 // 10, height * 9 // 10))
+    buffer = io.BytesIO()
+    photo.save(buffer, "JPEG", quality=70)
+    return buffer.getvalue()
+
+
+def _session() -> Session:
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine, tables=[DocumentFingerprint.__table__])
+    return Session(engine)
+
+
+def _index(session: Session, file_bytes: bytes, mime_type: str) -> uuid.UUID:
+    task_id = uuid.uuid4()
+    near_duplicates.index_task(session, task_id, near_duplicates.compute_fingerprint(file_bytes, mime_type))
+    session.commit()
+    return task_id
+
+
+def test_scan_and_phone_photo_match():
+    """El escaneo y la foto de la misma factura se encuentran en el índice (sin capa de texto)"""
+    invoice = _invoice(7)
+    with _session() as session:
+        scanned = _index(session, _scan(invoice), "application/pdf")
+        _index(session, _scan(_receipt()), "application/pdf")
+        photo = near_duplicates.compute_fingerprint(_phone_photo(invoice), "image/jpeg")
+        match = near_duplicates.find_match(session, photo)
+        assert match is not None and match["task_id"] == scanned, match
+        assert match["distance"] <= near_duplicates.settings.near_duplicate_max_distance
+        assert match["text_match"] is False
+
+
+def test_photo_and_native_pdf_match():
+    """La foto encuentra también la factura original subida como PDF nativo"""
+    invoice = _invoice(3)
+    with _session() as session:
+        native = _index(session, invoice, "application/pdf")
+        match = near_duplicates.find_match(session, near_duplicates.compute_fingerprint(_phone_photo(invoice), "image/jpeg"))
+        assert match is not None and match["task_id"] == native, match
+
+
+def test_other_layout_does_not_match():
+    """La foto de una factura no coincide con un ticket de otro proveedor"""
+    with _session() as session:
+        _index(session, _scan(_receipt()), "application/pdf")
+        photo = near_duplicates.compute_fingerprint(_phone_photo(_invoice(5)), "image/jpeg")
+        assert near_duplicates.find_match(session, photo) is None
+
+
+def test_same_text_layer_matches_and_different_text_does_not():
+    """Entre PDFs nativos decide la capa de texto, aunque el hash esté cerca"""
+    with _session() as session:
+        original = _index(session, _invoice(1), "application/pdf")
+        same = near_duplicates.find_match(session, near_duplicates.compute_fingerprint(_invoice(1), "application/pdf"))
+        assert same == {"task_id": original, "distance": 0, "text_match": True}
+        other = near_duplicates.compute_fingerprint(_invoice(2), "application/pdf")
+        assert near_duplicates.find_match(session, other) is None
+
+
+def test_band_search_is_exhaustive():
+    """Multi-index hashing: cualquier hash a distancia <= MAX_DISTANCE es candidato"""
+    base = 0x0123456789ABCDEF
+    with _session() as session:
+        near_duplicates.index_task(session, uuid.uuid4(), near_duplicates.Fingerprint(base))
+        session.commit()
+        for distance in range(near_duplicates.MAX_DISTANCE + 1):
+            # Bits consecutivos: se reparten entre las cuatro bandas (el caso justo del palomar)
+            flipped = base ^ ((1 << distance) - 1)
+            match = near_duplicates.find_match(session, near_duplicates.Fingerprint(flipped), distance)
+            assert match is not None and match["distance"] == distance, (distance, match)
+
+
+def test_legacy_fingerprints_are_purged():
+    """Las huellas de versiones anteriores se eliminan al migrar"""
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine, tables=[DocumentFingerprint.__table__])
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE perceptualhash (task_id CHAR(32) PRIMARY KEY, hash_value VARCHAR(16))"))
+        connection.execute(text("CREATE TABLE fingerprintband (task_id CHAR(32), band INTEGER, value INTEGER)"))
+        connection.execute(text("INSERT INTO documentfingerprint (task_id, hash_value, created_utc_timestamp) "
+                                "VALUES ('00000000000000000000000000000001', 'ff', '2024-01-01')"))
+    with Session(engine) as session:
+        current = _index(session, _invoice(4), "application/pdf")
+    near_duplicates.purge_legacy_fingerprints(engine)
+    with engine.connect() as connection:
+        tables = {row[0] for row in connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+        remaining = [row[0] for row in connection.execute(text("SELECT task_id FROM documentfingerprint"))]
+    assert "perceptualhash" not in tables and "fingerprintband" not in tables
+    assert remaining == [current.hex]
+
+
+def main():
+    tests = [
+        test_scan_and_phone_photo_match,
+        test_photo_and_native_pdf_match,
+        test_other_layout_does_not_match,
+        test_same_text_layer_matches_and_different_text_does_not,
+        test_band_search_is_exhaustive,
+        test_legacy_fingerprints_are_purged,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            print(f"❌ {test.__name__}: {e!r}")
+            failed += 1
+    print(f"📊 {len(tests) - failed}/{len(tests)} pruebas pasadas")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la cola en la base de datos (task_queue.py): reclamación condicional,
+recuperación de leases vencidos y tareas cuyo lease pasó a otro worker. No
+necesitan el servidor (base de datos temporal, ver conftest.py):
+
+    python test_task_queue.py    (o pytest test_task_queue.py)
+"""
+
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import conftest  # noqa: F401  (entorno de pruebas antes de importar config)
+from PIL import Image
+from sqlalchemy import delete, update
+from sqlmodel import Session, select
+
+import background_processor
+from config import settings
+from database import engine, create_db_and_tables
+from models import ApiTrackingLog, TaskResult
+from task_queue import TaskDispatcher
+
+create_db_and_tables()
+
+
+def _reset(pending: int) -> list:
+    """Deja en la base de datos solo `pending` tareas PENDING nuevas y devuelve sus task_id."""
+    with Session(engine) as session:
+        session.exec(delete(TaskResult))
+        session.exec(delete(ApiTrackingLog))
+        entries = [ApiTrackingLog(user_identifier="test_task_queue", filename=f"f{i}.png") for i in range(pending)]
+        session.add_all(entries)
+        session.commit()
+        return [entry.task_id for entry in entries]
+
+
+def _load(task_id) -> ApiTrackingLog:
+    with Session(engine) as session:
+        return session.exec(select(ApiTrackingLog).where(ApiTrackingLog.task_id == task_id)).one()
+
+
+def _error_message(task_id):
+    with Session(engine) as session:
+        result = session.get(TaskResult, task_id)
+        return result.error_message if result else None
+
+
+def _expire(task_id) -> None:
+    """Simula que el worker dejó de renovar el lease."""
+    with Session(engine) as session:
+        session.exec(
+            update(ApiTrackingLog)
+            .where(ApiTrackingLog.task_id == task_id)
+            .values(lease_expires_utc_timestamp=datetime.utcnow() - timedelta(seconds=1))
+        )
+        session.commit()
+
+
+def _steal(task_id, old: TaskDispatcher, new: TaskDispatcher) -> None:
+    """El lease de `old` vence, el reaper devuelve la tarea a PENDING y `new` la reclama."""
+    _expire(task_id)
+    old._reap_expired_leases()
+    assert new._claim_next() == task_id
+
+
+def test_two_claimers_never_share_a_task():
+    """Dos despachadores reclamando a la vez nunca obtienen la misma tarea PENDING"""
+    task_ids = _reset(40)
+    dispatchers = [TaskDispatcher(4), TaskDispatcher(4)]
+
+    def claim_all(dispatcher):
+        claimed = []
+        while (task_id := dispatcher._claim_next()) is not None:
+            claimed.append(task_id)
+        return claimed
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first, second = executor.map(claim_all, dispatchers)
+    assert not set(first) & set(second)
+    assert sorted(first + second) == sorted(task_ids)
+    for dispatcher, claimed in zip(dispatchers, (first, second)):
+        for task_id in claimed:
+            log_entry = _load(task_id)
+            assert log_entry.status == "PROCESSING" and log_entry.attempts == 1
+            assert log_entry.lease_owner == dispatcher.worker_id
+
+
+def test_expired_lease_is_requeued():
+    """El reaper devuelve a PENDING una tarea con el lease vencido; otro worker la reclama"""
+    [task_id] = _reset(1)
+    first, second = TaskDispatcher(1), TaskDispatcher(1)
+    assert first._claim_next() == task_id
+    first._reap_expired_leases()
+    assert _load(task_id).lease_owner == first.worker_id  # Lease vigente: no se toca
+    _steal(task_id, first, second)
+    log_entry = _load(task_id)
+    assert log_entry.lease_owner == second.worker_id and log_entry.attempts == 2
+
+
+def test_expired_lease_after_last_attempt_fails():
+    """Con TASK_MAX_ATTEMPTS agotados, el lease vencido deja la tarea FAILED"""
+    [task_id] = _reset(1)
+    dispatcher = TaskDispatcher(1)
+    with Session(engine) as session:
+        session.exec(update(ApiTrackingLog).values(attempts=settings.task_max_attempts - 1))
+        session.commit()
+    assert dispatcher._claim_next() == task_id
+    _expire(task_id)
+    dispatcher._reap_expired_leases()
+    assert _load(task_id).status == "FAILED"
+    assert "lease vencido" in _error_message(task_id)
+
+
+def test_stolen_lease_cannot_overwrite_terminal_state():
+    """El worker que perdió el lease no escribe encima del estado final del nuevo dueño"""
+    [task_id] = _reset(1)
+    old, new = TaskDispatcher(1), TaskDispatcher(1)
+    assert old._claim_next() == task_id
+    _steal(task_id, old, new)
+    new._fail(task_id, "fallo del nuevo dueño", lease_owner=new.worker_id)
+
+    finished = asyncio.run(background_processor.process_invoice_task(
+        task_id, b"", "test_task_queue", "f0.png", lease_owner=old.worker_id))
+    old._fail(task_id, "fallo del worker antiguo", lease_owner=old.worker_id)
+    assert finished is False
+    assert _load(task_id).status == "FAILED"
+    assert _error_message(task_id) == "fallo del nuevo dueño"
+
+
+def test_lease_stolen_during_extraction_discards_result():
+    """Si el lease cambia de dueño mientras Gemini responde, el resultado se descarta"""
+    [task_id] = _reset(1)
+    old, new = TaskDispatcher(1), TaskDispatcher(1)
+    assert old._claim_next() == task_id
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), "white").save(buffer, "PNG")
+
+    async def slow_gemini(prompt, pages):
+        _steal(task_id, old, new)
+        return {"json_text": '{"total": 1}', "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+
+    original = background_processor.get_invoice_data_from_gemini
+    background_processor.get_invoice_data_from_gemini = slow_gemini
+    try:
+        finished = asyncio.run(background_processor.process_invoice_task(
+            task_id, buffer.getvalue(), "test_task_queue", "f0.png", lease_owner=old.worker_id))
+    finally:
+        background_processor.get_invoice_data_from_gemini = original
+    log_entry = _load(task_id)
+    assert finished is False
+    assert log_entry.status == "PROCESSING" and log_entry.lease_owner == new.worker_id
+    with Session(engine) as session:
+        assert session.get(TaskResult, task_id) is None
+
+
+def main():
+    tests = [
+        test_two_claimers_never_share_a_task,
+        test_expired_lease_is_requeued,
+        test_expired_lease_after_last_attempt_fails,
+        test_stolen_lease_cannot_overwrite_terminal_state,
+        test_lease_stolen_during_extraction_discards_result,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            print(f"❌ {test.__name__}: {e!r}")
+            failed += 1
+    print(f"📊 {len(tests) - failed}/{len(tests)} pruebas pasadas")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
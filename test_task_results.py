@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la normalización de resultados (task_results.normalize_json) y de su
+paso directo a la respuesta de /status. No necesitan el servidor:
+
+    python test_task_results.py    (o pytest test_task_results.py)
+"""
+
+import json
+import zlib
+
+import task_results
+from json_response import dumps
+
+BIG_INT = 123456789012345678901234567890  # Más de 64 bits: orjson no lo admite
+
+
+def _served(json_text: str) -> bytes:
+    """Normaliza como store_result y codifica la respuesta como /status."""
+    data = zlib.compress(task_results.normalize_json(json_text))
+    return dumps({"data": task_results.result_content(data, normalized=True)})
+
+
+def test_big_int_is_preserved():
+    """Los enteros de más de 64 bits se guardan y se sirven sin perder dígitos"""
+    normalized = task_results.normalize_json('{"account": %d, "total": 10.5}' % BIG_INT)
+    assert json.loads(normalized) == {"account": BIG_INT, "total": 10.5}
+    assert json.loads(_served('{"account": %d}' % BIG_INT)) == {"data": {"account": BIG_INT}}
+
+
+def test_negative_big_int_in_list():
+    normalized = task_results.normalize_json('[1, -%d]' % BIG_INT)
+    assert json.loads(normalized) == [1, -BIG_INT]
+
+
+def test_big_int_in_response():
+    """dumps recurre al módulo json cuando orjson no puede codificar"""
+    assert json.loads(dumps({"id": BIG_INT, "ok": True})) == {"id": BIG_INT, "ok": True}
+
+
+def _reject_constant(value: str):
+    raise ValueError(f"{value} no es JSON válido")
+
+
+def test_non_finite_numbers_become_null():
+    """NaN, Infinity y 1e400 se guardan como null"""
+    for json_text in ('{"total": NaN}', '{"total": -Infinity}', '{"total": 1e400}'):
+        assert task_results.normalize_json(" " + json_text + "\n") == b'{"total":null}'
+
+
+def test_status_body_is_strict_json():
+    """La respuesta de /status se puede leer con un parser estricto"""
+    json_text = '{"lines": [{"amount": NaN}, {"amount": Infinity}], "id": %d, "rate": 1e400, "total": 2.5}' % BIG_INT
+    body = json.loads(_served(json_text), parse_constant=_reject_constant)
+    assert body == {"data": {"lines": [{"amount": None}, {"amount": None}], "id": BIG_INT, "rate": None, "total": 2.5}}
+
+
+def test_compacts_valid_json():
+    assert task_results.normalize_json('{ "a" : [1, 2.5, "ñ"] }') == '{"a":[1,2.5,"ñ"]}'.encode("utf-8")
+
+
+def test_invalid_json_is_stored_as_string():
+    assert json.loads(task_results.normalize_json("no es JSON")) == "no es JSON"
+
+
+def main():
+    tests = [
+        test_big_int_is_preserved,
+        test_negative_big_int_in_list,
+        test_big_int_in_response,
+        test_non_finite_numbers_become_null,
+        test_status_body_is_strict_json,
+        test_compacts_valid_json,
+        test_invalid_json_is_stored_as_string,
+    ]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            print(f"❌ {test.__name__}: {e!r}")
+            failed += 1
+    print(f"📊 {len(tests) - failed}/{len(tests)} pruebas pasadas")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
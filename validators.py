@@ -1,9 +1,40 @@
 # validators.py
+import hashlib
 import mimetypes
-from typing import List
+from dataclasses import dataclass
+from typing import BinaryIO, List, Optional
 from fastapi import UploadFile, HTTPException, status
 from config import settings
 
+# Firmas (magic bytes) de los formatos admitidos
+PDF_SIGNATURE = b"%PDF-"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Límite de archivos por lote y margen por archivo para cabeceras y campos del multipart
+MAX_FILES_PER_BATCH = 10
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+def max_request_bytes(max_files: int, max_file_mb: int) -> int:
+    """Tamaño máximo aceptable del cuerpo de una subida multipart (para Content-Length)."""
+    return max_files * (max_file_mb * 1024 * 1024 + MULTIPART_OVERHEAD_BYTES)
+
+@dataclass
+class ValidatedFile:
+    """
+    Archivo validado. El contenido sigue en el archivo temporal en que Starlette
+    recibió la subida (en disco si supera 1 MB), nunca en un objeto bytes.
+    """
+    filename: str
+    file: BinaryIO
+    size: int
+    sha256: str
+    mime_type: str
+
+    def close(self) -> None:
+        self.file.close()
+
 class FileValidator:
     """
     Validador de archivos para la API
@@ -16,12 +47,26 @@ class FileValidator:
         "image/jpg": ["jpg"]  # Some browsers send this
     }
     
+    @staticmethod
+    def sniff_mime_type(first_chunk: bytes) -> Optional[str]:
+        """
+        Detecta el tipo real del archivo a partir de sus primeros bytes
+        """
+        if first_chunk.startswith(PNG_SIGNATURE):
+            return "image/png"
+        if first_chunk.startswith(JPEG_SIGNATURE):
+            return "image/jpeg"
+        # La especificación PDF permite basura antes de la cabecera dentro del primer KB
+        if PDF_SIGNATURE in first_chunk[:1024]:
+            return "application/pdf"
+        return None
+    
     @staticmethod
     def validate_file(file: UploadFile) -> None:
         """
         Valida un archivo individual
         """
-        # Verificar tipo MIME
+        # Verificar tipo MIME declarado por el cliente (el tipo real se comprueba al leer el contenido)
         if file.content_type not in FileValidator.ALLOWED_MIME_TYPES:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -42,25 +87,78 @@ class FileValidator:
                 )
     
     @staticmethod
-    async def validate_file_size(file: UploadFile) -> bytes:
+    async def validate_file_content(file: UploadFile) -> ValidatedFile:
         """
-        Valida el tamaño del archivo y devuelve los bytes
+        Recorre por bloques el archivo recibido verificando el tipo real con el primer
+        bloque, el tamaño máximo y calculando su SHA-256. No se copia: las subidas que
+        declaran un Content-Length excesivo ya se rechazan antes de leer el cuerpo
+        (ver admission_control en main.py).
         """
-        content = await file.read()
         max_size = settings.max_file_size_mb * 1024 * 1024
+        chunk_size = settings.upload_chunk_size_kb * 1024
+        digest = hashlib.sha256()
+        size = 0
+        mime_type = None
+        
+        await file.seek(0)
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            
+            if mime_type is None:
+                mime_type = FileValidator.sniff_mime_type(chunk)
+                FileValidator._check_sniffed_type(file, mime_type)
+            
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"El archivo {file.filename} excede el tamaño máximo de {settings.max_file_size_mb}MB"
+                )
+            
+            digest.update(chunk)
+        
+        if size == 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"El archivo {file.filename} está vacío"
+            )
         
-        if len(content) > max_size:
+        await file.seek(0)
+        return ValidatedFile(
+            filename=file.filename or "unknown",
+            file=file.file,
+            size=size,
+            sha256=digest.hexdigest(),
+            mime_type=mime_type
+        )
+    
+    @staticmethod
+    def _check_sniffed_type(file: UploadFile, mime_type: Optional[str]) -> None:
+        """
+        Comprueba que el contenido real coincide con un tipo admitido y con la extensión
+        """
+        if mime_type is None:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"El archivo {file.filename} excede el tamaño máximo de {settings.max_file_size_mb}MB"
+                detail=f"El contenido de {file.filename} no es un PDF, JPEG o PNG válido"
             )
         
-        return content
+        if file.filename:
+            extension = file.filename.split('.')[-1].lower()
+            if extension not in FileValidator.ALLOWED_MIME_TYPES[mime_type]:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"El contenido de {file.filename} ({mime_type}) no coincide con su extensión .{extension}"
+                )
     
     @staticmethod
-    async def validate_files(files: List[UploadFile]) -> List[tuple]:
+    async def validate_files(files: List[UploadFile]) -> List[ValidatedFile]:
         """
-        Valida múltiples archivos y devuelve una lista de (filename, content)
+        Valida múltiples archivos y devuelve una lista de ValidatedFile.
+        El llamador puede cerrar los archivos temporales al terminar (si no, los
+        cierra Starlette al acabar la petición).
         """
         if not files:
             raise HTTPException(
@@ -68,17 +166,21 @@ class FileValidator:
                 detail="No se proporcionaron archivos"
             )
         
-        if len(files) > 10:  # Límite de archivos por lote
+        if len(files) > MAX_FILES_PER_BATCH:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Máximo 10 archivos por lote"
+                detail=f"Máximo {MAX_FILES_PER_BATCH} archivos por lote"
             )
         
         validated_files = []
         
-        for file in files:
-            FileValidator.validate_file(file)
-            content = await FileValidator.validate_file_size(file)
-            validated_files.append((file.filename or "unknown", content))
+        try:
+            for file in files:
+                FileValidator.validate_file(file)
+                validated_files.append(await FileValidator.validate_file_content(file))
+        except BaseException:
+            for validated in validated_files:
+                validated.close()
+            raise
         
         return validated_files
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Worker de cola: procesa las tareas PENDING sin servir HTTP.
+
+En producción (SERVER_MODE=production) los procesos HTTP solo reciben subidas y
+las tareas las procesan uno o varios de estos workers, en la misma máquina o en
+otros nodos que compartan la base de datos y UPLOAD_DIR. Cada tarea se reclama
+con una actualización condicional (SKIP LOCKED en PostgreSQL), así que ninguna
+factura se procesa dos veces.
+"""
+
+import asyncio
+import signal
+from sqlmodel import Session
+from database import create_db_and_tables, dispose_async_engine, engine
+from task_queue import dispatcher
+from convert_toimage import shutdown_render_pool
+from gedata import extraction_client
+from config import settings
+import stats
+
+
+async def run(init_db: bool = True) -> None:
+    if init_db and settings.db_migrate_on_startup:
+        create_db_and_tables()
+    with Session(engine) as session:
+        stats.ensure_initialized(session)
+    await extraction_client.start()
+    await dispatcher.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+    await dispatcher.stop()
+    await extraction_client.close()
+    shutdown_render_pool()
+    await dispose_async_engine()
+
+
+def main(init_db: bool = True) -> None:
+    asyncio.run(run(init_db))
+
+
+if __name__ == "__main__":
+    main()